@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""Synthetic OSM data and a benchmark runner for the project 3 pipeline.
+
+generate_osm writes an extract of any size around Centennial, with a skewed
+distribution of users and street names, and the abbreviations, misspellings,
+suites and city typos that the audit and cleaning steps look for. run_suite
+times the audit, the shaping to JSON, the load into MongoDB and each
+FixAndAnalyzeDB report, and optionally measures their peak Python memory
+with tracemalloc. The numbers are compared against the baselines stored in
+benchmark_baseline.json.
+
+    python benchmark.py [num_nodes] [save]
+
+By default the load goes to an in-memory mongomock collection, so that the
+suite runs anywhere and the time measures the pipeline rather than the server.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+from collections import deque
+from functools import lru_cache
+from itertools import accumulate
+from contextlib import redirect_stdout
+from xml.sax.saxutils import quoteattr
+from project3 import AuditXML, CleanXML, FixAndAnalyzeDB
+from loader import MongoLoader
+from interning import shared_size
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# Slowdown or memory growth over the baseline reported as a regression
+TIME_TOLERANCE = 1.5
+MEMORY_TOLERANCE = 1.2
+# Differences smaller than these are timer and allocator noise
+MIN_SECONDS = 0.05
+MIN_MB = 1.0
+
+# Street names, most common first. Picks are Zipf distributed over the list.
+STREET_NAMES = ["Arapahoe", "Dry Creek", "Orchard", "Broadway", "Holly", "Quebec", "Jordan", "Parker",
+                "Smoky Hill", "Yosemite", "Havana", "Peoria", "Belleview", "Colorado", "University",
+                "Clarkson", "Easter", "Caley", "Briarwood", "Fremont", "Geddes", "Costilla", "Otero",
+                "Lincoln", "Potomac", "Revere", "Chenango", "Mineral", "County Line", "Picadilly",
+                "Buckley", "Himalaya", "Gun Club", "Inverness", "Panorama", "Crestline", "Powers",
+                "Weaver", "Nobles", "Ida", "Hinsdale", "Progress", "Maplewood", "Fair", "Irish"]
+# (spelling, weight) of the street types, including the abbreviations and misspellings that get fixed
+STREET_TYPES = [("Street", 20), ("Avenue", 18), ("Drive", 14), ("Road", 10), ("Way", 8), ("Court", 8),
+                ("Place", 6), ("Lane", 5), ("Circle", 5), ("Boulevard", 3), ("Parkway", 3), ("Trail", 2),
+                ("St", 4), ("Ave", 4), ("Rd", 3), ("Dr", 3), ("Ct", 2), ("Pl", 1), ("Pkwy", 1), ("Ln", 1),
+                ("Cir", 1), ("Blvd", 1), ("Strret", 0.2), ("Raod", 0.2)]
+STREET_PREFIXES = [("", 60), ("East", 10), ("South", 10), ("West", 5), ("North", 5), ("E", 4), ("S", 4),
+                   ("W", 1), ("N", 1)]
+CITIES = [("Centennial", 80), ("Englewood", 8), ("Littleton", 6), ("Aurora", 4), ("Centenn", 2)]
+POSTCODES = ["80112", "80122", "80111", "80121", "80015", "80016"]
+AMENITIES = [("restaurant", 30), ("parking", 20), ("place_of_worship", 10), ("school", 8), ("fast_food", 8),
+             ("bank", 6), ("fuel", 6), ("bicycle_parking", 6), ("cafe", 6)]
+RELIGIONS = [("christian", 85), ("jewish", 5), ("buddhist", 3), (None, 7)]
+SHOPS = [("supermarket", 30), ("clothes", 25), ("hairdresser", 20), ("car_repair", 15), ("bicycle", 10)]
+HIGHWAYS = [("residential", 40), ("service", 20), ("footway", 12), ("cycleway", 6), ("tertiary", 5),
+            ("secondary", 4), ("primary", 3), ("path", 4), ("track", 2), ("unclassified", 4)]
+BICYCLE = [(None, 80), ("yes", 8), ("designated", 6), ("no", 3), ("permissive", 3)]
+
+
+def weighted(rng, choices):
+    """
+    Pick one value from (value, weight) pairs
+    :param rng: random.Random
+    :param choices: List of (value, weight) pairs
+    :return: The value
+    """
+    total = sum(weight for _, weight in choices)
+    target = rng.random() * total
+    for value, weight in choices:
+        target -= weight
+        if target < 0:
+            return value
+
+    return choices[-1][0]
+
+
+@lru_cache(maxsize=None)
+def zipf_cum_weights(n, s):
+    """
+    :return: Cumulative Zipf weights 1 / (i + 1) ** s of n items
+    """
+    return list(accumulate(1.0 / (i + 1) ** s for i in range(n)))
+
+
+def zipf_index(rng, n, s=1.1):
+    """
+    :return: An index into n items, 0 being the most likely, with Zipf weights 1 / (i + 1) ** s
+    """
+    return rng.choices(range(n), cum_weights=zipf_cum_weights(n, s))[0]
+
+
+def street_name(rng):
+    """
+    :return: A random street name, sometimes abbreviated, misspelled or with a suite
+    """
+    parts = [weighted(rng, STREET_PREFIXES), STREET_NAMES[zipf_index(rng, len(STREET_NAMES))],
+             weighted(rng, STREET_TYPES)]
+    if rng.random() < 0.02:
+        parts.append("Ste {0}".format(rng.randint(1, 400)))
+
+    return " ".join(part for part in parts if part)
+
+
+def element_tags(tags):
+    """
+    :param tags: List of (key, value) pairs, values of None are left out
+    :return: XML of the tag elements
+    """
+    return "".join('  <tag k={0} v={1}/>\n'.format(quoteattr(k), quoteattr(v)) for k, v in tags if v is not None)
+
+
+def node_tags(rng, extra_tags):
+    """
+    :param extra_tags: Mean number of free form tags besides the address and amenity
+    :return: List of (key, value) pairs of a tagged node
+    """
+    tags = []
+    kind = rng.random()
+    if kind < 0.6:
+        tags += [("addr:housenumber", str(rng.randint(1, 19999))), ("addr:street", street_name(rng)),
+                 ("addr:city", weighted(rng, CITIES)), ("addr:postcode", rng.choice(POSTCODES))]
+    if kind > 0.4:
+        amenity = weighted(rng, AMENITIES)
+        tags.append(("amenity", amenity))
+        if amenity == "place_of_worship":
+            tags.append(("religion", weighted(rng, RELIGIONS)))
+    elif kind > 0.3:
+        tags.append(("shop", weighted(rng, SHOPS)))
+    if rng.random() < 0.01:
+        tags.append(("FIXME", "check the location"))
+
+    # Free form keys, including ones with colons, upper case and problem characters
+    for i in range(int(rng.expovariate(1.0 / extra_tags)) if extra_tags else 0):
+        key = rng.choice(["name", "phone", "website", "opening_hours", "building", "source", "tiger:county",
+                          "gnis:feature_id", "contact:email", "Name", "name_1", "note key"])
+        tags.append((key, "value {0}".format(rng.randint(0, 99))))
+
+    return tags
+
+
+def generate_osm(filename, num_nodes=10000, num_ways=1000, num_relations=20, tagged_fraction=0.1,
+                 extra_tags=1.0, refs_per_way=8, num_users=200, seed=0):
+    """
+    Write a synthetic .osm extract
+    :param filename: Output .osm filename
+    :param num_nodes: Number of nodes
+    :param num_ways: Number of ways
+    :param num_relations: Number of relations
+    :param tagged_fraction: Fraction of the nodes that carry tags
+    :param extra_tags: Mean number of free form tags per tagged node
+    :param refs_per_way: Mean number of node references per way
+    :param num_users: Number of distinct users, picked Zipf distributed
+    :param seed: Random seed, the same arguments and seed give the same file
+    :return: None
+    """
+    rng = random.Random(seed)
+    min_lat, min_lon, max_lat, max_lon = 39.55, -104.95, 39.65, -104.75
+    users = ["ecarl65"] + ["user{0}".format(i) for i in range(1, num_users)]
+    first_id = 100000000
+
+    def attributes(element_id):
+        user = zipf_index(rng, num_users)
+        return 'id="{0}" version="{1}" changeset="{2}" timestamp="20{3:02d}-{4:02d}-{5:02d}T12:00:00Z" ' \
+               'user={6} uid="{7}"'.format(element_id, rng.randint(1, 12), rng.randint(1000000, 40000000),
+                                           rng.randint(8, 16), rng.randint(1, 12), rng.randint(1, 28),
+                                           quoteattr(users[user]), 100000 + user)
+
+    with open(filename, "w") as fo:
+        fo.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark.py">\n')
+        fo.write(' <bounds minlat="{0}" minlon="{1}" maxlat="{2}" maxlon="{3}"/>\n'.format(
+            min_lat, min_lon, max_lat, max_lon))
+
+        for i in range(num_nodes):
+            start = ' <node {0} lat="{1:.7f}" lon="{2:.7f}"'.format(
+                attributes(first_id + i), rng.uniform(min_lat, max_lat), rng.uniform(min_lon, max_lon))
+            if rng.random() < tagged_fraction:
+                fo.write(start + '>\n' + element_tags(node_tags(rng, extra_tags)) + ' </node>\n')
+            else:
+                fo.write(start + '/>\n')
+
+        for i in range(num_ways):
+            fo.write(' <way {0}>\n'.format(attributes(first_id + i)))
+            start = rng.randrange(num_nodes)
+            for j in range(max(2, int(rng.expovariate(1.0 / refs_per_way)))):
+                fo.write('  <nd ref="{0}"/>\n'.format(first_id + (start + j) % num_nodes))
+            highway = weighted(rng, HIGHWAYS)
+            tags = [("highway", highway), ("bicycle", weighted(rng, BICYCLE))]
+            if highway in ("residential", "tertiary", "secondary", "primary"):
+                tags.append(("name", street_name(rng)))
+            fo.write(element_tags(tags) + ' </way>\n')
+
+        for i in range(num_relations):
+            fo.write(' <relation {0}>\n'.format(attributes(first_id + i)))
+            for j in range(rng.randint(1, 5)):
+                fo.write('  <member type="way" ref="{0}" role=""/>\n'.format(first_id + rng.randrange(num_ways)))
+            fo.write(element_tags([("type", "route"), ("route", "bicycle")]) + ' </relation>\n')
+
+        fo.write('</osm>\n')
+
+    return
+
+
+def run_suite(filename, client=None, trace_memory=False):
+    """
+    Run each stage of the pipeline once over an extract
+    :param filename: Input .osm filename
+    :param client: MongoClient to load into, defaults to an in-memory mongomock client
+    :param trace_memory: True to record the peak Python memory of each stage, which slows it down
+    :return: Tuple of ({stage: seconds or peak MB}, results that must not change between runs)
+    """
+    if client is None:
+        import mongomock
+        client = mongomock.MongoClient()
+    database, collection = "benchmark", "benchmark"
+    client[database][collection].drop()
+
+    measurements = {}
+    results = {}
+
+    def measure(stage, func, *args):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            value = func(*args)
+        if trace_memory:
+            measurements[stage] = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        else:
+            measurements[stage] = time.time() - start
+        return value
+
+    street_types, _, _ = measure("audit", AuditXML(filename).audit)
+    results["street_types"] = len(street_types)
+
+    cleaner = CleanXML(filename)
+    measure("process_map", lambda: deque(cleaner.process_map(streaming=True), maxlen=0))
+    results["streets_corrected"] = len(cleaner.num_streets_corrected)
+
+    loader = MongoLoader(client[database][collection])
+    measure("load", loader.load_file, filename + ".json")
+    results["docs"] = loader.num_inserted
+
+    analyze = FixAndAnalyzeDB(database, collection, client=client)
+    measure("create_indexes", analyze.create_indexes)
+    measure("fix_cities", analyze.fix_cities, {"Centenn": "Centennial"})
+    measure("data_overview", analyze.data_overview)
+    measure("additional_ideas", analyze.additional_ideas)
+    results["overview"] = analyze.overview_counts()
+
+    return measurements, results
+
+
+def interning_savings(filename):
+    """
+    Memory held by the shaped documents of an extract, with and without string interning
+    :param filename: Input OSM filename
+    :return: Tuple of (MB without interning, MB with interning)
+    """
+    sizes = []
+    for intern_strings in (False, True):
+        data = list(CleanXML(filename, intern_strings=intern_strings).iter_elements())
+        sizes.append(shared_size(data) / 1e6)
+        del data
+
+    return tuple(sizes)
+
+
+def run_benchmark(num_nodes=10000, save=False, client=None, memory=True):
+    """
+    Generate an extract, run the suite on it, and compare against the stored baseline
+    :param num_nodes: Number of nodes of the extract, with a tenth as many ways
+    :param save: True to store the measurements as the new baseline
+    :param client: MongoClient to load into, defaults to mongomock
+    :param memory: True to also measure the peak memory of each stage, in a second run
+    :return: List of regression messages, empty if there are none
+    """
+    name = "nodes={0},ways={1}".format(num_nodes, num_nodes // 10)
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, "synthetic.osm")
+    generate_osm(filename, num_nodes=num_nodes, num_ways=num_nodes // 10)
+    print("Benchmark {0}, {1:.1f} MB of XML".format(name, os.path.getsize(filename) / 1e6))
+
+    seconds, results = run_suite(filename, client)
+    peak_mb = run_suite(filename, client, trace_memory=True)[0] if memory else {}
+    plain_mb, interned_mb = interning_savings(filename)
+    for path in (filename, filename + ".json"):
+        os.remove(path)
+    os.rmdir(tmp_dir)
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as fi:
+            baselines = json.load(fi)
+    baseline = baselines.get(name, {})
+
+    regressions = []
+    print("{0:18s} {1:>10s} {2:>10s} {3:>10s} {4:>10s}".format("Stage", "Seconds", "Baseline", "Peak MB",
+                                                                "Baseline"))
+    for stage in seconds:
+        base_seconds = baseline.get("seconds", {}).get(stage)
+        base_mb = baseline.get("peak_mb", {}).get(stage)
+        print("{0:18s} {1:10.3f} {2:>10s} {3:>10s} {4:>10s}".format(
+            stage, seconds[stage], "-" if base_seconds is None else "{0:.3f}".format(base_seconds),
+            "-" if stage not in peak_mb else "{0:.1f}".format(peak_mb[stage]),
+            "-" if base_mb is None else "{0:.1f}".format(base_mb)))
+        if base_seconds is not None and seconds[stage] > max(TIME_TOLERANCE * base_seconds,
+                                                             base_seconds + MIN_SECONDS):
+            regressions.append("{0} took {1:.3f} s, baseline {2:.3f} s".format(stage, seconds[stage], base_seconds))
+        if base_mb is not None and stage in peak_mb and peak_mb[stage] > max(MEMORY_TOLERANCE * base_mb,
+                                                                             base_mb + MIN_MB):
+            regressions.append("{0} peaked at {1:.1f} MB, baseline {2:.1f} MB".format(stage, peak_mb[stage], base_mb))
+    if "results" in baseline and baseline["results"] != results:
+        regressions.append("results changed from {0} to {1}".format(baseline["results"], results))
+
+    print("Shaped documents: {0:.1f} MB, {1:.1f} MB with interned strings ({2:.0%} saved)".format(
+        plain_mb, interned_mb, 1 - interned_mb / plain_mb))
+
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+
+    if save:
+        baselines[name] = {"seconds": seconds, "peak_mb": peak_mb or baseline.get("peak_mb", {}), "results": results}
+        with open(BASELINE_FILE, "w") as fo:
+            json.dump(baselines, fo, indent=2, sort_keys=True)
+            fo.write("\n")
+        print("Saved the baseline to {0}".format(BASELINE_FILE))
+
+    return regressions
+
+
+def test():
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, "synthetic.osm")
+    generate_osm(filename, num_nodes=2000, num_ways=200, tagged_fraction=0.5)
+    with open(filename) as fi:
+        first = fi.read()
+    generate_osm(filename, num_nodes=2000, num_ways=200, tagged_fraction=0.5)
+    with open(filename) as fi:
+        assert fi.read() == first
+
+    seconds, results = run_suite(filename)
+    assert set(seconds) == {"audit", "process_map", "load", "create_indexes", "fix_cities", "data_overview",
+                            "additional_ideas"}
+    assert results["docs"] == 1 + 2000 + 200
+    assert results["overview"]["nodes"] == 2000 and results["overview"]["ways"] == 200
+    assert results["overview"]["ecarl65"] > 0 and results["overview"]["churches_wo_religion"] > 0
+    assert results["streets_corrected"] > 0
+
+    peak_mb, _ = run_suite(filename, trace_memory=True)
+    assert all(mb > 0 for mb in peak_mb.values())
+    plain_mb, interned_mb = interning_savings(filename)
+    assert 0 < interned_mb < plain_mb
+    for path in (filename, filename + ".json"):
+        os.remove(path)
+    os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["test"]:
+        test()
+    else:
+        args = sys.argv[1:]
+        regressions = run_benchmark(int(args[0]) if args and args[0].isdigit() else 10000, save="save" in args)
+        sys.exit(1 if regressions else 0)
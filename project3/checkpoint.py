@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+"""Checkpointed, resumable shaping and loading of large extracts.
+
+ResumableCleanXML feeds the input to the parser in blocks that end on the
+start of a top level element, so after every block all earlier elements
+have been shaped and handed to the output. Every checkpoint_every elements,
+at the end of a block, the output is flushed and a checkpoint is written with
+the input byte offset, the type and id of the last element and the position
+of the output: the size of the JSON/BSON file, or the number of documents
+inserted into MongoDB. A restarted run seeks to the offset, parses the rest
+of the file wrapped in <osm> tags (as parallel.ChunkReader does), truncates
+the output file to the recorded size and carries on. The checkpoint is
+removed once the whole file has been processed.
+
+Documents loaded into MongoDB get a deterministic _id, eg. "node/261114295",
+so the documents inserted after the last checkpoint, or before the first one,
+are rejected as duplicate keys when they are inserted again and are counted
+as already loaded instead of being duplicated.
+"""
+
+import os
+import json
+import time
+from lxml import etree
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from project3 import CleanXML
+from loader import MongoLoader
+from serializers import BUFFER_SIZE, get_serializer
+from compressed import open_osm, is_compressed, uncompressed_name
+from parallel import ELEMENT_START_RE
+
+
+# Number of shaped elements between checkpoints
+CHECKPOINT_EVERY = 100000
+
+# Number of bytes read from the input at a time
+READ_SIZE = 1024 * 1024
+
+# MongoDB error code of an insert with an _id that already exists
+DUPLICATE_KEY = 11000
+
+# Start tags of the elements a block may end before. "<" is always escaped in attribute
+# values and text, so these only match real start tags.
+ELEMENT_STARTS = (b"<node", b"<way", b"<relation")
+
+
+def read_checkpoint(checkpoint_file):
+    """
+    :param checkpoint_file: Name of the checkpoint file
+    :return: Dictionary of the checkpoint state, None when there is no checkpoint
+    """
+    if not os.path.exists(checkpoint_file):
+        return None
+
+    with open(checkpoint_file) as fi:
+        return json.load(fi)
+
+
+def write_checkpoint(checkpoint_file, state):
+    """
+    Write a checkpoint atomically, a crash while writing leaves the previous one in place
+    :param checkpoint_file: Name of the checkpoint file
+    :param state: Dictionary of the checkpoint state
+    :return: None
+    """
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, "w") as fo:
+        json.dump(state, fo)
+        fo.flush()
+        os.fsync(fo.fileno())
+    os.replace(tmp_file, checkpoint_file)
+
+    return
+
+
+def skip_to(source, offset):
+    """
+    Move an input file to a byte offset. compressed.ParallelBZ2Reader cannot
+    seek, it is decompressed and discarded up to the offset instead.
+    :param source: Binary file object returned by compressed.open_osm
+    :param offset: Byte offset of the uncompressed data
+    :return: None
+    """
+    if hasattr(source, "seek"):
+        source.seek(offset)
+        return
+
+    remaining = offset
+    while remaining > 0:
+        block = source.read(min(READ_SIZE, remaining))
+        if not block:
+            raise IOError("Checkpoint offset {0} is past the end of the input".format(offset))
+        remaining -= len(block)
+
+    return
+
+
+class ResumableLoader(MongoLoader):
+    """MongoLoader for documents with deterministic ids. Documents rejected as
+    duplicate keys were inserted by an earlier, interrupted run and are counted
+    as already loaded rather than failed. Inserts are always unordered, so the
+    rest of a batch is inserted past the duplicates.
+    """
+
+    def __init__(self, collection, batch_size=1000, write_concern=None):
+        """
+        Initialize the loader
+        :param collection: pymongo (or mongomock) collection to insert into
+        :param batch_size: Number of documents sent per insert_many call
+        :param write_concern: Dictionary of write concern options, eg. {"w": 1, "j": True}
+        :return: None
+        """
+        super(ResumableLoader, self).__init__(collection, batch_size, False, write_concern)
+        self.num_existing = 0
+
+    def insert_batch(self, batch):
+        """
+        Insert a single batch, counting duplicate keys as already loaded
+        :param batch: List of documents with an _id
+        :return: None
+        """
+        try:
+            self.collection.insert_many(batch, ordered=False)
+            self.num_inserted += len(batch)
+        except BulkWriteError as e:
+            errors = [error for error in e.details["writeErrors"] if error["code"] != DUPLICATE_KEY]
+            num_existing = len(e.details["writeErrors"]) - len(errors)
+            self.num_inserted += e.details["nInserted"]
+            self.num_existing += num_existing
+            self.num_failed += len(batch) - e.details["nInserted"] - num_existing
+            self.write_errors.extend(errors)
+        self.num_batches += 1
+
+        return
+
+    def print_stats(self):
+        super(ResumableLoader, self).print_stats()
+        print("Number of documents already loaded: {0}".format(self.num_existing))
+
+        return
+
+
+class ResumableCleanXML(CleanXML):
+    """CleanXML that checkpoints its progress and resumes an interrupted
+    process_map or load_into_mongo from the last checkpoint.
+    """
+
+    def __init__(self, filename, checkpoint_every=CHECKPOINT_EVERY, checkpoint_file=None, instrument=None,
+                 intern_strings=None):
+        """
+        Initialize the object
+        :param filename: The input .osm filename to process, .osm.bz2 and .osm.gz are decompressed on the fly
+        :param checkpoint_every: Number of elements between checkpoints
+        :param checkpoint_file: Name of the checkpoint file, defaults to one named after the output
+        :param instrument: Optional instrument.Instrumentation to count the elements processed by this run
+                           and record the street fixing time
+        :param intern_strings: True to share repeated low cardinality values (see interning.StringInterner),
+                               None only when process_map keeps the documents in a list
+        :return: None
+        """
+        super(ResumableCleanXML, self).__init__(filename, instrument, intern_strings)
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_file = checkpoint_file
+
+        # Statistics
+        self.num_checkpoints = 0
+        self.resumed_from = None
+
+    def resume_state(self, checkpoint_file):
+        """
+        Read the checkpoint of an interrupted run and restore the statistics it recorded
+        :param checkpoint_file: Name of the checkpoint file
+        :return: Dictionary of the checkpoint state, None to start from the beginning
+        """
+        state = read_checkpoint(checkpoint_file)
+        if state is None:
+            return None
+
+        if state["filename"] != self.filename or state["input_size"] != os.path.getsize(self.filename):
+            raise ValueError("{0} is a checkpoint of a different input file".format(checkpoint_file))
+        self.extent = state["extent"]
+        self.num_streets_total.update(state["num_streets_total"])
+        self.num_streets_corrected.update(state["num_streets_corrected"])
+        self.resumed_from = state
+        print("Resuming from {0} {1} at byte {2}, {3} elements done".format(
+            state["last_type"], state["last_id"], state["offset"], state["num_elements"]))
+
+        return state
+
+    def iter_checkpointed(self, checkpoint_file, state, sync):
+        """
+        Generator over the shaped documents from the checkpointed offset on,
+        writing a checkpoint every checkpoint_every elements
+        :param checkpoint_file: Name of the checkpoint file
+        :param state: Checkpoint state to resume from, None to start at the beginning
+        :param sync: Function that makes the output of every document yielded so far
+                     durable, and returns a dictionary of the output position
+        :return: Generator of shaped dictionaries
+        """
+        offset = state["offset"] if state else 0
+        num_elements = state["num_elements"] if state else 0
+        last_type, last_id = (state["last_type"], state["last_id"]) if state else (None, None)
+        since_checkpoint = 0
+
+        parser = etree.XMLPullParser(events=("end",), tag=self.top_level_tags)
+        instrument = self.instrument
+        with open_osm(self.filename) as source:
+            if instrument is not None:
+                instrument.start(None if is_compressed(self.filename) else self.filename, source)
+            buf = b""
+            if offset:
+                skip_to(source, offset)
+                buf = source.read(READ_SIZE)
+                if not ELEMENT_START_RE.match(buf):
+                    raise ValueError("Checkpoint offset {0} is not the start of an element".format(offset))
+                parser.feed(b"<osm>")
+
+            while True:
+                block = source.read(READ_SIZE)
+                buf += block
+                # Feed up to the start of the last element in the buffer, or everything at the end
+                end = max(buf.rfind(start) for start in ELEMENT_STARTS) if block else len(buf)
+                if end > 0:
+                    parser.feed(buf[:end])
+                    offset += end
+                    buf = buf[end:]
+
+                for _, element in parser.read_events():
+                    el = self.shape_element(element)
+                    last_type, last_id = element.tag, element.get("id")
+                    if el and instrument is not None:
+                        instrument.element(len(element.findall("tag")))
+                    self.free_element(element)
+                    num_elements += 1
+                    since_checkpoint += 1
+                    if el:
+                        yield el
+
+                if not block:
+                    break
+
+                # Every element before the offset has been yielded, and processed by the consumer
+                if since_checkpoint >= self.checkpoint_every and end > 0:
+                    write_checkpoint(checkpoint_file, {
+                        "filename": self.filename,
+                        "input_size": os.path.getsize(self.filename),
+                        "offset": offset,
+                        "last_type": last_type,
+                        "last_id": last_id,
+                        "num_elements": num_elements,
+                        "output": sync(),
+                        "extent": self.extent,
+                        "num_streets_total": self.num_streets_total,
+                        "num_streets_corrected": self.num_streets_corrected,
+                    })
+                    self.num_checkpoints += 1
+                    since_checkpoint = 0
+            if instrument is not None:
+                instrument.stop()
+        parser.close()
+
+    def stream_map(self, pretty=False, output_format="json", geometry=None):
+        """
+        Resumable version of CleanXML.stream_map. A run interrupted after a
+        checkpoint resumes from it, the output file keeps the documents written
+        up to the checkpoint and the rest are appended.
+        :param pretty: True to indent the JSON output
+        :param output_format: Output serializer name, "json" or "bson" (see serializers.get_serializer)
+        :param geometry: Not supported, way geometry needs every node of the file
+        :return: Generator of the shaped dictionaries processed by this run
+        """
+        if geometry is not None:
+            raise ValueError("Way geometry needs every node of the file and cannot be resumed")
+
+        serializer = get_serializer(output_format, pretty)
+        file_out = serializer.output_name(uncompressed_name(self.filename))
+        checkpoint_file = self.checkpoint_file or file_out + ".checkpoint"
+        state = self.resume_state(checkpoint_file)
+        if state is None:
+            fo = serializer.open(uncompressed_name(self.filename))
+        else:
+            fo = open(file_out, "r+b", BUFFER_SIZE)
+            fo.seek(state["output"]["position"])
+            fo.truncate()
+
+        def sync():
+            fo.flush()
+            os.fsync(fo.fileno())
+            return {"position": fo.tell()}
+
+        with fo:
+            for el in self.iter_checkpointed(checkpoint_file, state, sync):
+                fo.write(serializer.dumps(el))
+                yield el
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+    def load_into_mongo(self, database, collection, batch_size=1000, ordered=False, write_concern=None,
+                        client=None, geometry=None, workers=None, queue_size=4):
+        """
+        Resumable version of CleanXML.load_into_mongo. Documents are inserted
+        unordered with an _id of "<type>/<id>", so documents loaded by an
+        interrupted run are not inserted twice. Use a write concern that
+        acknowledges the inserts, the checkpoint assumes they have been applied.
+        :param database: Name of the database to insert into
+        :param collection: Name of the collection to use
+        :param batch_size: Number of documents per insert_many call
+        :param ordered: Not supported, the inserts must go on past the documents that are already loaded
+        :param write_concern: Dictionary of write concern options, eg. {"w": 1, "j": True}
+        :param client: Optional MongoClient (or mongomock stand-in), defaults to localhost
+        :param geometry: Not supported, way geometry needs every node of the file
+        :param workers: Not supported, every insert must be applied before a checkpoint is written
+        :param queue_size: Unused without workers
+        :return: The ResumableLoader used, holding the load statistics
+        """
+        if ordered:
+            raise ValueError("Resumable loads insert unordered to skip the documents already loaded")
+        if geometry is not None:
+            raise ValueError("Way geometry needs every node of the file and cannot be resumed")
+        if workers:
+            raise ValueError("Resumable loads insert in the parsing thread, so checkpoints follow the inserts")
+
+        if client is None:
+            client = MongoClient('localhost:27017')
+        checkpoint_file = self.checkpoint_file or "{0}.{1}.{2}.checkpoint".format(
+            uncompressed_name(self.filename), database, collection)
+        state = self.resume_state(checkpoint_file)
+        loader = ResumableLoader(client[database][collection], batch_size, write_concern)
+        batch = []
+
+        def sync():
+            if batch:
+                loader.insert_batch(batch)
+                del batch[:]
+            return {"inserted": loader.num_inserted + (state["output"]["inserted"] if state else 0)}
+
+        start = time.time()
+        for el in self.iter_checkpointed(checkpoint_file, state, sync):
+            el["_id"] = "{0}/{1}".format(el["type"], el["id"]) if "id" in el else el["type"]
+            batch.append(el)
+            if len(batch) >= batch_size:
+                sync()
+        sync()
+        loader.seconds += time.time() - start
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        loader.print_stats()
+
+        return loader
+
+
+def test():
+    import mongomock
+    from geometry import WayGeometry
+    from instrument import Instrumentation
+    from fixtures import example_copy
+
+    with example_copy() as osm_file:
+        plain = CleanXML(osm_file)
+        expected = plain.process_map()
+        with open(osm_file + ".json", "rb") as fi:
+            expected_output = fi.read()
+        os.remove(osm_file + ".json")
+
+        # An uninterrupted run gives the output of CleanXML, and leaves no checkpoint behind
+        cleaner = ResumableCleanXML(osm_file, checkpoint_every=1)
+        assert cleaner.process_map() == expected
+        with open(osm_file + ".json", "rb") as fi:
+            assert fi.read() == expected_output
+        assert not os.path.exists(osm_file + ".json.checkpoint")
+
+        # Interrupted after a checkpoint, with documents written past it. Small reads give several checkpoints.
+        global READ_SIZE
+        read_size, READ_SIZE = READ_SIZE, 2048
+        try:
+            for compressed in (False, True):
+                input_file = osm_file
+                if compressed:
+                    import gzip
+                    input_file = osm_file + ".gz"
+                    with open(osm_file, "rb") as fi, gzip.open(input_file, "wb") as fo:
+                        fo.write(fi.read())
+                docs = ResumableCleanXML(input_file, checkpoint_every=5).process_map(streaming=True)
+                first = [next(docs) for _ in range(20)]
+                del docs
+                state = read_checkpoint(osm_file + ".json.checkpoint")
+                assert 0 < state["num_elements"] < 20 and state["last_id"] is not None
+                assert os.path.getsize(osm_file + ".json") >= state["output"]["position"]
+
+                cleaner = ResumableCleanXML(input_file, checkpoint_every=5)
+                rest = cleaner.process_map()
+                assert cleaner.resumed_from["offset"] == state["offset"]
+                done = len(expected) - len(rest)
+                assert 0 < done <= 20 and first[:done] + rest == expected
+                with open(osm_file + ".json", "rb") as fi:
+                    assert fi.read() == expected_output
+                assert cleaner.num_streets_total == plain.num_streets_total and cleaner.extent == plain.extent
+                assert not os.path.exists(osm_file + ".json.checkpoint")
+
+            # Interrupted load, the documents inserted after the checkpoint are not duplicated
+            client = mongomock.MongoClient()
+            docs = ResumableCleanXML(osm_file, checkpoint_every=5)
+            checkpoint_file = osm_file + ".test.osm.checkpoint"
+            docs.checkpoint_file = checkpoint_file
+            original = docs.iter_checkpointed
+
+            def interrupted(checkpoint_file, state, sync):
+                for i, el in enumerate(original(checkpoint_file, state, sync)):
+                    if i == 24:
+                        raise KeyboardInterrupt
+                    yield el
+            docs.iter_checkpointed = interrupted
+            try:
+                docs.load_into_mongo("test", "osm", batch_size=3, client=client)
+            except KeyboardInterrupt:
+                pass
+            assert read_checkpoint(checkpoint_file)["num_elements"] < 24
+            assert client["test"]["osm"].count_documents({}) > read_checkpoint(checkpoint_file)["output"]["inserted"]
+
+            loader = ResumableCleanXML(osm_file, checkpoint_every=5, checkpoint_file=checkpoint_file).load_into_mongo(
+                "test", "osm", batch_size=3, client=client)
+            assert loader.num_existing > 0 and loader.num_failed == 0
+            assert client["test"]["osm"].count_documents({}) == len(expected)
+            assert client["test"]["osm"].find_one({"_id": "node/261114295"})["pos"] == [41.9730791, -87.6866303]
+            assert not os.path.exists(checkpoint_file)
+
+            # The arguments of CleanXML.load_into_mongo keep their positions, the ones that cannot be resumed are rejected
+            loader = ResumableCleanXML(osm_file).load_into_mongo("test", "positional", 1000, False, {"w": 1}, client)
+            assert loader.num_inserted == client["test"]["positional"].count_documents({}) == len(expected)
+            for kwargs in ({"ordered": True}, {"geometry": WayGeometry()}, {"workers": 2}):
+                try:
+                    ResumableCleanXML(osm_file).load_into_mongo("test", "rejected", client=client, **kwargs)
+                    assert False
+                except ValueError:
+                    pass
+            assert client["test"]["rejected"].count_documents({}) == 0
+
+            # The instrumentation counts the elements of the run
+            instrument = Instrumentation()
+            ResumableCleanXML(osm_file, instrument=instrument).process_map()
+            assert instrument.elements == len(expected) and "street" in instrument.stages
+        finally:
+            READ_SIZE = read_size
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Reading .osm.bz2 and .osm.gz extracts directly.
+
+open_osm returns a binary file object for any extract, decompressing on the
+fly, so the parsers never need a decompressed copy on disk. bzip2 is slow to
+decompress, but the large extracts are written by parallel compressors
+(pbzip2, lbzip2) as many concatenated bzip2 streams. Those streams are found
+by their header and decompressed in a process pool by ParallelBZ2Reader,
+a bounded number of segments ahead of the parser and in their original order.
+"""
+
+import bz2
+import gzip
+import mmap
+import os
+import re
+import multiprocessing as mp
+from collections import deque
+
+
+# A bzip2 stream header "BZh" and block size, followed by the magic of the first
+# block, or of the end of stream for an empty stream
+BZ2_STREAM_RE = re.compile(br"BZh[1-9](?:\x31\x41\x59\x26\x53\x59|\x17\x72\x45\x38\x50\x90)")
+
+# Minimum number of compressed bytes handed to a worker at once
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+COMPRESSED_EXTENSIONS = (".bz2", ".gz")
+
+
+def is_compressed(filename):
+    """
+    :param filename: Input filename
+    :return: True if the file is read through a decompressor
+    """
+    return filename.endswith(COMPRESSED_EXTENSIONS)
+
+
+def uncompressed_name(filename):
+    """
+    :param filename: Input filename, eg. "centennial.osm.bz2"
+    :return: The name without the compression extension, eg. "centennial.osm"
+    """
+    for extension in COMPRESSED_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[:-len(extension)]
+
+    return filename
+
+
+def find_bz2_streams(filename):
+    """
+    Find the start offsets of the concatenated bzip2 streams of a file. A false
+    match inside compressed data would need 10 bytes to line up by chance.
+    :param filename: Input .bz2 filename
+    :return: List of byte offsets, the first one always 0
+    """
+    if not os.path.getsize(filename):
+        return [0]
+
+    with open(filename, "rb") as fi:
+        data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            offsets = [match.start() for match in BZ2_STREAM_RE.finditer(data)]
+        finally:
+            data.close()
+
+    if not offsets or offsets[0] != 0:
+        raise IOError("{0} is not a bzip2 file".format(filename))
+
+    return offsets
+
+
+def decompress_segment(args):
+    """
+    Worker that decompresses a byte range holding one or more whole bzip2 streams
+    :param args: Tuple of (filename, start, end)
+    :return: Decompressed bytes
+    """
+    filename, start, end = args
+    with open(filename, "rb") as fi:
+        fi.seek(start)
+        data = fi.read(end - start)
+
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise IOError("Truncated bzip2 stream in {0} at offset {1}".format(filename, start))
+        data = decompressor.unused_data
+
+    return b"".join(out)
+
+
+class ParallelBZ2Reader(object):
+    """File-like object over the decompressed content of a multi-stream bzip2
+    file. Groups of streams are decompressed in a process pool, at most
+    `ahead` segments in advance of the reader.
+    """
+
+    def __init__(self, filename, processes=None, segment_size=SEGMENT_SIZE, offsets=None):
+        """
+        Start the decompression
+        :param filename: Input .bz2 filename
+        :param processes: Number of worker processes, defaults to the number of cores
+        :param segment_size: Minimum number of compressed bytes per task
+        :param offsets: Stream offsets, when already found with find_bz2_streams
+        :return: None
+        """
+        self.filename = filename
+        self.processes = processes or mp.cpu_count()
+        self.ahead = 2 * self.processes
+
+        if offsets is None:
+            offsets = find_bz2_streams(filename)
+        file_size = os.path.getsize(filename)
+        boundaries = [0]
+        for offset in offsets[1:]:
+            if offset - boundaries[-1] >= segment_size:
+                boundaries.append(offset)
+        boundaries.append(file_size)
+        self.tasks = deque((filename, start, end) for start, end in zip(boundaries[:-1], boundaries[1:]))
+
+        self.pool = mp.Pool(self.processes)
+        self.pending = deque()
+        self.buffer = b""
+        self.position = 0
+        self.offset = 0
+        self.closed = False
+        self.submit()
+
+    def submit(self):
+        """
+        Keep up to `ahead` segments in flight
+        :return: None
+        """
+        while self.tasks and len(self.pending) < self.ahead:
+            self.pending.append(self.pool.apply_async(decompress_segment, (self.tasks.popleft(),)))
+
+        return
+
+    def read(self, size=-1):
+        """
+        Read up to size decompressed bytes
+        :param size: Maximum number of bytes to return, all of the rest if negative
+        :return: Bytes read, empty at the end of the file
+        """
+        if size is None or size < 0:
+            parts = [self.buffer[self.offset:]]
+            self.buffer, self.offset = b"", 0
+            while self.pending:
+                parts.append(self.pending.popleft().get())
+                self.submit()
+            out = b"".join(parts)
+            self.position += len(out)
+            return out
+
+        while self.offset >= len(self.buffer):
+            if not self.pending:
+                return b""
+            self.buffer, self.offset = self.pending.popleft().get(), 0
+            self.submit()
+
+        out = self.buffer[self.offset:self.offset + size]
+        self.offset += len(out)
+        self.position += len(out)
+
+        return out
+
+    def tell(self):
+        """
+        :return: Number of decompressed bytes read so far
+        """
+        return self.position
+
+    def close(self):
+        """
+        Stop the workers
+        :return: None
+        """
+        if not self.closed:
+            self.pool.terminate()
+            self.pool.join()
+            self.closed = True
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_osm(filename, processes=None):
+    """
+    Open an extract for binary reading, decompressing .bz2 and .gz files on the fly
+    :param filename: Input filename
+    :param processes: Number of processes to decompress a multi-stream .bz2 file with,
+                      defaults to the number of cores. 1 decompresses in this process.
+    :return: Binary file object
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+
+    if filename.endswith(".bz2"):
+        processes = processes or mp.cpu_count()
+        if processes > 1:
+            offsets = find_bz2_streams(filename)
+            if len(offsets) > 1:
+                return ParallelBZ2Reader(filename, processes, offsets=offsets)
+        return bz2.open(filename, "rb")
+
+    return open(filename, "rb")
+
+
+def test():
+    from project3 import AuditXML, CleanXML
+    from fixtures import example_copy
+
+    with example_copy() as osm_file:
+        with open(osm_file, "rb") as fi:
+            content = fi.read()
+
+        # Multi-stream bzip2 as written by pbzip2, one stream per 1000 bytes
+        with open(osm_file + ".bz2", "wb") as fo:
+            for start in range(0, len(content), 1000):
+                fo.write(bz2.compress(content[start:start + 1000]))
+        with gzip.open(osm_file + ".gz", "wb") as fo:
+            fo.write(content)
+
+        assert len(find_bz2_streams(osm_file + ".bz2")) == (len(content) + 999) // 1000
+        with ParallelBZ2Reader(osm_file + ".bz2", processes=2, segment_size=1) as reader:
+            assert len(reader.tasks) + len(reader.pending) == 7
+            parts = [reader.read(700) for _ in range(3)]
+            parts.append(reader.read())
+            assert b"".join(parts) == content and reader.tell() == len(content)
+            assert reader.read(10) == b""
+        for processes in (1, 2):
+            with open_osm(osm_file + ".bz2", processes) as fi:
+                assert fi.read() == content
+
+        # The parsers produce the same results, and the output is named after the uncompressed file
+        data = CleanXML(osm_file).process_map()
+        audit = AuditXML(osm_file).audit()
+        os.remove(osm_file + ".json")
+        for compressed_file in (osm_file + ".bz2", osm_file + ".gz"):
+            assert CleanXML(compressed_file).process_map() == data
+            assert os.path.exists(osm_file + ".json")
+            os.remove(osm_file + ".json")
+            assert AuditXML(compressed_file).audit() == audit
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Input files for the test functions of the modules.
+
+Most of the tests run CleanXML.process_map or another writer that puts its
+output next to the input file. example_copy gives them a copy of an example
+file in a temporary directory, so the tracked example5.osm.json and other
+outputs are left untouched, and removes the directory afterwards.
+"""
+
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def example_copy(filename="example5.osm"):
+    """
+    Copy an example file into a new temporary directory
+    :param filename: Example file to copy
+    :return: Context manager giving the name of the copy, the directory is removed on exit
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        osm_file = os.path.join(tmp_dir, os.path.basename(filename))
+        shutil.copy(filename, osm_file)
+        yield osm_file
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test():
+    with example_copy() as osm_file:
+        tmp_dir = os.path.dirname(osm_file)
+        assert os.path.basename(osm_file) == "example5.osm" and tmp_dir != os.path.abspath(".")
+        with open(osm_file, "rb") as fi, open("example5.osm", "rb") as original:
+            assert fi.read() == original.read()
+    assert not os.path.exists(tmp_dir)
+
+
+if __name__ == "__main__":
+    test()
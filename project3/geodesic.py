@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Vectorized geodesic distances and areas on the WGS-84 ellipsoid.
+
+geopy works on one pair of points at a time, which is fine for the corners
+of a bounding box but far too slow for the millions of node pairs in way
+lengths or nearest neighbour queries. The functions here take NumPy arrays
+(or scalars) of latitudes and longitudes in degrees and broadcast them.
+
+vincenty_km agrees with geopy's vincenty to within VINCENTY_TOLERANCE_KM,
+haversine_km is the faster spherical approximation (errors up to ~0.5%).
+"""
+
+import numpy as np
+
+
+# Mean radius of the earth in km
+EARTH_RADIUS_KM = 6371.0088
+
+# WGS-84 ellipsoid, in km
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+WGS84_B_KM = WGS84_A_KM * (1 - WGS84_F)
+WGS84_E = np.sqrt(WGS84_F * (2 - WGS84_F))
+
+# Agreement with geopy's vincenty, checked by test(), 1 mm
+VINCENTY_TOLERANCE_KM = 1e-6
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance between arrays of points
+    :param lat1: Latitudes of the first points in degrees
+    :param lon1: Longitudes of the first points in degrees
+    :param lat2: Latitudes of the second points in degrees
+    :param lon2: Longitudes of the second points in degrees
+    :return: Array of distances in km
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def vincenty_km(lat1, lon1, lat2, lon2, max_iterations=200, tolerance=1e-12):
+    """
+    Distance between arrays of points on the WGS-84 ellipsoid, by Vincenty's
+    inverse formula. All pairs are iterated together until every one converges.
+    :param lat1: Latitudes of the first points in degrees
+    :param lon1: Longitudes of the first points in degrees
+    :param lat2: Latitudes of the second points in degrees
+    :param lon2: Longitudes of the second points in degrees
+    :param max_iterations: Iteration limit, pairs that have not converged by then
+                           (nearly antipodal points) are NaN
+    :param tolerance: Convergence threshold on lambda in radians
+    :return: Array of distances in km
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*(np.radians(np.asarray(v, dtype=np.float64))
+                                                   for v in (lat1, lon1, lat2, lon2)))
+    a, b, f = WGS84_A_KM, WGS84_B_KM, WGS84_F
+
+    big_l = lon2 - lon1
+    u1 = np.arctan((1 - f) * np.tan(lat1))
+    u2 = np.arctan((1 - f) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = big_l.copy()
+    converged = np.zeros(lam.shape, dtype=bool)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.sqrt((cos_u2 * sin_lam) ** 2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam) ** 2)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha == 0
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+            c = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+            lam_prev = lam
+            lam = big_l + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) <= tolerance
+            if converged.all():
+                break
+
+        u_sq = cos_sq_alpha * (a ** 2 - b ** 2) / b ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        distance = b * big_a * (sigma - delta_sigma)
+
+    # Coincident points give 0 / 0 above
+    distance = np.where(sin_sigma == 0, 0.0, distance)
+
+    return np.where(converged, distance, np.nan)
+
+
+def authalic_q(lat):
+    """
+    The q function of the ellipsoidal area formula, proportional to the area
+    between the equator and a latitude
+    :param lat: Latitudes in degrees
+    :return: Array of q values
+    """
+    e = WGS84_E
+    sin_lat = np.sin(np.radians(lat))
+
+    return (1 - e ** 2) * (sin_lat / (1 - (e * sin_lat) ** 2) -
+                           1 / (2 * e) * np.log((1 - e * sin_lat) / (1 + e * sin_lat)))
+
+
+def cell_area_km2(min_lat, min_lon, max_lat, max_lon):
+    """
+    Exact area of latitude/longitude quadrangles on the WGS-84 ellipsoid
+    :param min_lat: Southern edges in degrees
+    :param min_lon: Western edges in degrees
+    :param max_lat: Northern edges in degrees
+    :param max_lon: Eastern edges in degrees
+    :return: Array of areas in square km
+    """
+    dlon = np.radians(np.asarray(max_lon, dtype=np.float64) - min_lon)
+
+    return WGS84_A_KM ** 2 / 2.0 * dlon * np.abs(authalic_q(max_lat) - authalic_q(min_lat))
+
+
+def grid_cell_areas(lat_edges, lon_edges):
+    """
+    Area of every cell of a latitude/longitude grid
+    :param lat_edges: Increasing latitudes of the cell edges in degrees, length n + 1
+    :param lon_edges: Increasing longitudes of the cell edges in degrees, length m + 1
+    :return: Array of shape (n, m) of areas in square km, row i is between lat_edges[i] and lat_edges[i + 1]
+    """
+    lat_edges = np.asarray(lat_edges, dtype=np.float64)
+    lon_edges = np.asarray(lon_edges, dtype=np.float64)
+
+    return cell_area_km2(lat_edges[:-1, np.newaxis], lon_edges[np.newaxis, :-1],
+                         lat_edges[1:, np.newaxis], lon_edges[np.newaxis, 1:])
+
+
+def test():
+    import warnings
+    from geopy.distance import vincenty, great_circle
+
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    rng = np.random.RandomState(0)
+    n = 2000
+    lat1, lat2 = rng.uniform(-80, 80, n), rng.uniform(-80, 80, n)
+    lon1, lon2 = rng.uniform(-180, 180, n), rng.uniform(-180, 180, n)
+    # Short distances, as in way segments, and the special cases
+    lat2[:500], lon2[:500] = lat1[:500] + rng.normal(0, 1e-3, 500), lon1[:500] + rng.normal(0, 1e-3, 500)
+    lat2[500], lon2[500] = lat1[500], lon1[500]
+    lat1[501], lat2[501] = 0.0, 0.0
+
+    distances = vincenty_km(lat1, lon1, lat2, lon2)
+    expected = np.array([vincenty((a, b), (c, d)).km for a, b, c, d in zip(lat1, lon1, lat2, lon2)])
+    assert np.abs(distances - expected).max() < VINCENTY_TOLERANCE_KM
+    assert distances[500] == 0.0
+
+    great = haversine_km(lat1, lon1, lat2, lon2)
+    expected = np.array([great_circle((a, b), (c, d)).km for a, b, c, d in zip(lat1, lon1, lat2, lon2)])
+    # geopy's great circle radius is 6371.009 km
+    assert np.abs(great / EARTH_RADIUS_KM - expected / 6371.009).max() < 1e-12
+
+    # Scalars broadcast, nearly antipodal points do not converge
+    assert abs(float(vincenty_km(39.5, -105.0, 39.6, -105.0)) - vincenty((39.5, -105.0), (39.6, -105.0)).km) < 1e-9
+    assert np.isnan(vincenty_km(0.0, 0.0, 0.5, 179.7))
+
+    # FixAndAnalyzeDB.compute_area matches its former geopy implementation
+    from project3 import FixAndAnalyzeDB
+    area_km, dist_lat_km, dist_lon_km = FixAndAnalyzeDB.compute_area(39.7, -104.7, 39.5, -105.0)
+    assert abs(dist_lat_km - vincenty((39.6, -105.0), (39.6, -104.7)).km) < VINCENTY_TOLERANCE_KM
+    assert abs(dist_lon_km - vincenty((39.5, -104.85), (39.7, -104.85)).km) < VINCENTY_TOLERANCE_KM
+
+    # The cells of a grid add up to the area of the whole grid, and the
+    # whole ellipsoid is 510065622 km^2
+    areas = grid_cell_areas(np.linspace(39.5, 39.7, 5), np.linspace(-105.0, -104.7, 7))
+    assert areas.shape == (4, 6)
+    assert abs(areas.sum() - cell_area_km2(39.5, -105.0, 39.7, -104.7)) < 1e-9
+    assert abs(cell_area_km2(-90, -180, 90, 180) - 510065621.7) < 1.0
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""Way geometry materialization during ingest.
+
+Shaped ways only hold the ids of their nodes, so computing the length or the
+bounding box of a way in MongoDB needs a join per way. Here the node positions
+are collected into a sorted id -> (lat, lon) index while the nodes stream past,
+either in RAM or memory mapped on disk, and the ways that follow are resolved
+against the index in batches. Each way gets a length_km and a bbox field.
+"""
+
+import os
+from array import array
+import numpy as np
+from geodesic import haversine_km
+
+
+class NodeIndex(object):
+    """Sorted index of node id to position. Nodes are appended as they are
+    parsed and the index is frozen before the first lookup.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialize an empty index
+        :param path: Base filename to memory map the index on disk, or None to keep it in RAM
+        :return: None
+        """
+        self.path = path
+        self.ids = array("q")
+        self.lat = array("d")
+        self.lon = array("d")
+        self.frozen = False
+        self.late_nodes = []
+        self.files = None
+        if path:
+            self.files = [open("{0}.{1}".format(path, name), "wb") for name in ("ids", "lat", "lon")]
+
+    def add(self, node_id, lat, lon):
+        """
+        Add one node position
+        :param node_id: Integer node id
+        :param lat: Latitude
+        :param lon: Longitude
+        :return: None
+        """
+        if self.frozen:
+            # Nodes after the first way are merged into the index on the next lookup
+            self.late_nodes.append((node_id, lat, lon))
+            return
+
+        self.ids.append(node_id)
+        self.lat.append(lat)
+        self.lon.append(lon)
+
+        # Spill to disk so that only a small buffer is held in memory
+        if self.files and len(self.ids) >= 65536:
+            self.spill()
+
+        return
+
+    def spill(self):
+        """
+        Write the buffered positions to the index files
+        :return: None
+        """
+        for column, fo in zip((self.ids, self.lat, self.lon), self.files):
+            column.tofile(fo)
+        self.ids, self.lat, self.lon = array("q"), array("d"), array("d")
+
+        return
+
+    def freeze(self):
+        """
+        Sort the index by node id. Extracts are normally already sorted, in which
+        case no sorting is needed.
+        :return: None
+        """
+        if self.frozen:
+            if self.late_nodes:
+                ids, lat, lon = zip(*self.late_nodes)
+                self.late_nodes = []
+                self.ids = np.concatenate((self.ids, np.array(ids, dtype=np.int64)))
+                self.lat = np.concatenate((self.lat, np.array(lat, dtype=np.float64)))
+                self.lon = np.concatenate((self.lon, np.array(lon, dtype=np.float64)))
+                self.sort()
+            return
+
+        if self.files:
+            self.spill()
+            for fo in self.files:
+                fo.close()
+            self.files = None
+            size = os.path.getsize(self.path + ".ids") // 8
+            if size:
+                self.ids = np.memmap(self.path + ".ids", dtype=np.int64, mode="r+", shape=(size,))
+                self.lat = np.memmap(self.path + ".lat", dtype=np.float64, mode="r+", shape=(size,))
+                self.lon = np.memmap(self.path + ".lon", dtype=np.float64, mode="r+", shape=(size,))
+            else:
+                self.ids, self.lat, self.lon = np.zeros(0, np.int64), np.zeros(0), np.zeros(0)
+        else:
+            self.ids = np.frombuffer(self.ids, dtype=np.int64).copy()
+            self.lat = np.frombuffer(self.lat, dtype=np.float64).copy()
+            self.lon = np.frombuffer(self.lon, dtype=np.float64).copy()
+
+        self.sort()
+        self.frozen = True
+
+        return
+
+    def sort(self):
+        """
+        Sort the columns by node id if they are not already sorted
+        :return: None
+        """
+        if len(self.ids) > 1 and np.any(self.ids[1:] < self.ids[:-1]):
+            order = np.argsort(self.ids, kind="stable")
+            self.ids[:] = self.ids[order]
+            self.lat[:] = self.lat[order]
+            self.lon[:] = self.lon[order]
+
+        return
+
+    def lookup(self, node_ids):
+        """
+        Look up the positions of many nodes at once
+        :param node_ids: Array of integer node ids
+        :return: Tuple of (lat, lon) arrays, NaN where the node is not in the index
+        """
+        self.freeze()
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if not len(self.ids):
+            missing = np.full(len(node_ids), np.nan)
+            return missing, missing.copy()
+
+        found = np.minimum(np.searchsorted(self.ids, node_ids), len(self.ids) - 1)
+        hit = self.ids[found] == node_ids
+        lat = np.where(hit, self.lat[found], np.nan)
+        lon = np.where(hit, self.lon[found], np.nan)
+
+        return lat, lon
+
+    def __len__(self):
+        return len(self.ids) + len(self.late_nodes)
+
+
+class WayGeometry(object):
+    """Ingest stage that attaches length_km and bbox to the ways of a stream
+    of shaped documents. Node positions are indexed as the nodes go past, and
+    ways are resolved in batches. The order of the documents is preserved.
+    """
+
+    def __init__(self, index=None, batch_size=1000):
+        """
+        Initialize the stage
+        :param index: NodeIndex to fill, defaults to a new one in RAM
+        :param batch_size: Number of ways resolved per batch
+        :return: None
+        """
+        self.index = index if index is not None else NodeIndex()
+        self.batch_size = batch_size
+        self.num_ways = 0
+        self.num_missing_refs = 0
+
+    def resolve(self, ways):
+        """
+        Compute and attach the geometry of a batch of ways
+        :param ways: List of shaped way dictionaries
+        :return: None
+        """
+        refs = [[int(ref) for ref in way.get("node_refs", ())] for way in ways]
+        counts = np.array([len(r) for r in refs], dtype=np.int64)
+        if not counts.sum():
+            return
+        lat, lon = self.index.lookup(np.fromiter((ref for r in refs for ref in r), dtype=np.int64))
+        self.num_missing_refs += int(np.isnan(lat).sum())
+
+        # Segment lengths, excluding the segments that join one way to the next
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        segments = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        same_way = np.ones(len(segments), dtype=bool)
+        # Ways without node_refs at either end of the batch put a boundary before the first or after the last node
+        boundaries = offsets[1:-1] - 1
+        same_way[boundaries[(boundaries >= 0) & (boundaries < len(segments))]] = False
+        segments = np.where(same_way & ~np.isnan(segments), segments, 0.0)
+        cumulative = np.concatenate(([0.0], np.cumsum(segments)))
+
+        for i, way in enumerate(ways):
+            start, end = offsets[i], offsets[i + 1]
+            way_lat, way_lon = lat[start:end], lon[start:end]
+            known = ~np.isnan(way_lat)
+            if not known.any():
+                continue
+            way["length_km"] = float(cumulative[end - 1] - cumulative[start]) if end > start else 0.0
+            way["bbox"] = {"minlat": float(way_lat[known].min()), "minlon": float(way_lon[known].min()),
+                           "maxlat": float(way_lat[known].max()), "maxlon": float(way_lon[known].max())}
+
+        return
+
+    def process(self, docs):
+        """
+        Attach geometry to the ways of a stream of shaped documents
+        :param docs: Iterable of shaped dictionaries in file order, eg. CleanXML.iter_elements()
+        :return: Generator of the same documents
+        """
+        ways = []
+        for doc in docs:
+            if doc["type"] == "way":
+                ways.append(doc)
+                self.num_ways += 1
+                if len(ways) >= self.batch_size:
+                    self.resolve(ways)
+                    for way in ways:
+                        yield way
+                    ways = []
+                continue
+
+            # Keep the original order if anything other than a way follows the ways
+            if ways:
+                self.resolve(ways)
+                for way in ways:
+                    yield way
+                ways = []
+
+            if doc["type"] == "node" and "pos" in doc:
+                self.index.add(int(doc["id"]), doc["pos"][0], doc["pos"][1])
+            yield doc
+
+        if ways:
+            self.resolve(ways)
+            for way in ways:
+                yield way
+
+    def print_stats(self):
+        """
+        Print the results of the geometry stage
+        :return: None
+        """
+        print("Nodes indexed: {0}".format(len(self.index)))
+        print("Ways resolved: {0}".format(self.num_ways))
+        print("Missing node references: {0}".format(self.num_missing_refs))
+
+        return
+
+
+def test():
+    import tempfile
+    import shutil
+    from project3 import CleanXML
+
+    data = list(CleanXML("example5.osm").iter_elements())
+    positions = dict((doc["id"], doc["pos"]) for doc in data if doc["type"] == "node")
+
+    tmp_dir = tempfile.mkdtemp()
+    for index in (NodeIndex(), NodeIndex(os.path.join(tmp_dir, "nodes"))):
+        stage = WayGeometry(index, batch_size=1)
+        out = list(stage.process(CleanXML("example5.osm").iter_elements()))
+        stage.print_stats()
+        assert [doc.get("id") for doc in out] == [doc.get("id") for doc in data]
+
+        for way in (doc for doc in out if doc["type"] == "way"):
+            pts = [positions[ref] for ref in way["node_refs"] if ref in positions]
+            if not pts:
+                assert "length_km" not in way
+                continue
+            assert way["bbox"]["minlat"] == min(p[0] for p in pts)
+            assert way["bbox"]["maxlon"] == max(p[1] for p in pts)
+            # Segments with a node outside the extract do not count towards the length
+            refs = way["node_refs"]
+            expected = sum(haversine_km(positions[a][0], positions[a][1], positions[b][0], positions[b][1])
+                           for a, b in zip(refs[:-1], refs[1:]) if a in positions and b in positions)
+            assert abs(way["length_km"] - expected) < 1e-9
+    shutil.rmtree(tmp_dir)
+
+    # A way around a square of 0.01 degrees at the equator, from unsorted nodes
+    index = NodeIndex()
+    for node_id, lat, lon in ((3, 0.01, 0.01), (1, 0.0, 0.0), (4, 0.01, 0.0), (2, 0.0, 0.01)):
+        index.add(node_id, lat, lon)
+    square = {"type": "way", "id": "1", "node_refs": ["1", "2", "3", "4", "1"]}
+    line = {"type": "way", "id": "2", "node_refs": ["1", "9"]}
+    WayGeometry(index).resolve([square, line])
+    assert abs(square["length_km"] - 4 * 1.11195) < 1e-3
+    assert square["bbox"] == {"minlat": 0.0, "minlon": 0.0, "maxlat": 0.01, "maxlon": 0.01}
+    assert line["length_km"] == 0.0
+
+    # Nodes arriving after the first way are still found
+    index.add(9, 0.0, -0.01)
+    WayGeometry(index).resolve([line])
+    assert abs(line["length_km"] - 1.11195) < 1e-3
+
+    # Ways without node_refs at the start, in the middle and at the end of a batch
+    def empty(way_id):
+        return {"type": "way", "id": way_id}
+    for batch in ([empty("e1"), square, line], [square, empty("e1"), line], [square, line, empty("e1")],
+                  [empty("e1"), square, empty("e2"), line, empty("e3")]):
+        for way in batch:
+            way.pop("length_km", None)
+        WayGeometry(index).resolve(batch)
+        assert abs(square["length_km"] - 4 * 1.11195) < 1e-3
+        assert abs(line["length_km"] - 1.11195) < 1e-3
+        assert all("length_km" not in way for way in batch if "node_refs" not in way)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""Stage level throughput instrumentation for AuditXML and CleanXML.
+
+An Instrumentation object passed as instrument= records the wall time of each
+stage of a run (parsing, tag iteration, street fixing, serialization, ...),
+the number of elements, tags and bytes processed, and calls an optional
+progress callback every progress_every elements. Without one the classes run
+their original loops, and the only remaining cost is an `is None` check per
+street name.
+
+    instrument = Instrumentation(progress=print_progress)
+    CleanXML("centennial.osm", instrument=instrument).process_map(streaming=True)
+    instrument.print_stats()
+    instrument.to_json("centennial.osm.stats.json")
+"""
+
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+# Monotonic high resolution clock used for every measurement
+clock = time.perf_counter
+
+
+def print_progress(snapshot):
+    """
+    Progress callback that prints one line per call
+    :param snapshot: Dictionary from Instrumentation.snapshot
+    :return: None
+    """
+    fraction = snapshot["fraction"]
+    print("{0} elements, {1:.1f} MB{2}, {3:.0f} elements/s".format(
+        snapshot["elements"], snapshot["bytes_read"] / 1e6,
+        "" if fraction is None else " ({0:.1f}%)".format(100.0 * fraction), snapshot["elements_per_sec"]))
+
+    return
+
+
+class Instrumentation(object):
+    """Collects per stage wall times and element, tag and byte counts"""
+
+    def __init__(self, progress=None, progress_every=10000):
+        """
+        Initialize the counters
+        :param progress: Optional callable taking a snapshot dictionary, eg. print_progress
+        :param progress_every: Number of elements between progress calls
+        :return: None
+        """
+        self.progress = progress
+        self.progress_every = progress_every
+        self.stages = OrderedDict()
+        self.elements = 0
+        self.tags = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.total_bytes = None
+        self.source = None
+        self.started = None
+        self.seconds = 0.0
+
+    def start(self, filename=None, source=None):
+        """
+        Start timing a run
+        :param filename: Input filename, to report the fraction of it that has been read
+        :param source: File object being parsed, its position is the number of bytes read
+        :return: None
+        """
+        if filename is not None and os.path.exists(filename):
+            self.total_bytes = os.path.getsize(filename)
+        self.source = source
+        self.started = clock()
+
+        return
+
+    def stop(self):
+        """
+        Stop timing the run
+        :return: None
+        """
+        if self.started is not None:
+            self.update_bytes_read()
+            self.seconds += clock() - self.started
+            self.started = None
+        self.source = None
+
+        return
+
+    def update_bytes_read(self):
+        """
+        Take the number of bytes read from the position of the parsed file
+        :return: None
+        """
+        if self.source is not None and not self.source.closed:
+            self.bytes_read = self.source.tell()
+
+        return
+
+    def add(self, stage, seconds):
+        """
+        Add time to a stage
+        :param stage: Stage name
+        :param seconds: Wall time in seconds
+        :return: None
+        """
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+        return
+
+    def element(self, num_tags):
+        """
+        Count one processed element, and call the progress callback when due
+        :param num_tags: Number of tags of the element
+        :return: None
+        """
+        self.elements += 1
+        self.tags += num_tags
+        if self.progress is not None and self.elements % self.progress_every == 0:
+            self.update_bytes_read()
+            self.progress(self.snapshot())
+
+        return
+
+    def elapsed(self):
+        """
+        :return: Wall time of the runs so far, including the one in progress
+        """
+        return self.seconds + (clock() - self.started if self.started is not None else 0.0)
+
+    def snapshot(self):
+        """
+        :return: Dictionary of the progress so far
+        """
+        elapsed = self.elapsed()
+        return {
+            "elements": self.elements,
+            "tags": self.tags,
+            "bytes_read": self.bytes_read,
+            "fraction": float(self.bytes_read) / self.total_bytes if self.total_bytes else None,
+            "seconds": elapsed,
+            "elements_per_sec": self.elements / elapsed if elapsed else 0.0,
+        }
+
+    def report(self):
+        """
+        :return: Dictionary of the totals, rates and per stage times
+        """
+        elapsed = self.elapsed()
+
+        def rate(count, seconds):
+            return count / seconds if seconds else 0.0
+
+        return {
+            "seconds": elapsed,
+            "elements": self.elements,
+            "tags": self.tags,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "elements_per_sec": rate(self.elements, elapsed),
+            "tags_per_sec": rate(self.tags, elapsed),
+            "bytes_per_sec": rate(self.bytes_read, elapsed),
+            "stages": OrderedDict((stage, {
+                "seconds": seconds,
+                "share": seconds / elapsed if elapsed else 0.0,
+                "elements_per_sec": rate(self.elements, seconds),
+            }) for stage, seconds in self.stages.items()),
+        }
+
+    def to_json(self, filename):
+        """
+        Write the report to a JSON file
+        :param filename: Output filename
+        :return: None
+        """
+        with open(filename, "w") as fo:
+            json.dump(self.report(), fo, indent=2)
+            fo.write("\n")
+
+        return
+
+    def print_stats(self):
+        """
+        Print the report
+        :return: None
+        """
+        report = self.report()
+        print("Elements: {0}, {1:.0f} per second".format(report["elements"], report["elements_per_sec"]))
+        print("Tags: {0}, {1:.0f} per second".format(report["tags"], report["tags_per_sec"]))
+        print("Bytes read: {0}, {1:.1f} MB per second".format(report["bytes_read"], report["bytes_per_sec"] / 1e6))
+        if report["bytes_written"]:
+            print("Bytes written: {0}".format(report["bytes_written"]))
+        for stage, stats in report["stages"].items():
+            print("Stage {0:12s}: {1:8.3f} s ({2:5.1f}%)".format(stage, stats["seconds"], 100.0 * stats["share"]))
+
+        return
+
+
+def test():
+    from project3 import AuditXML, CleanXML
+    from fixtures import example_copy
+
+    with example_copy() as osm_file:
+
+        snapshots = []
+        instrument = Instrumentation(progress=snapshots.append, progress_every=10)
+        data = CleanXML(osm_file, instrument=instrument).process_map()
+        assert data == CleanXML(osm_file).process_map()
+        report = instrument.report()
+        assert report["elements"] == len(data)
+        assert report["tags"] > 0 and report["bytes_read"] == os.path.getsize(osm_file)
+        assert report["bytes_written"] == os.path.getsize(osm_file + ".json")
+        assert list(report["stages"]) == ["parse", "shape", "street", "free", "serialize"]
+        assert sum(stage["seconds"] for stage in report["stages"].values()) <= report["seconds"]
+        assert len(snapshots) == len(data) // 10 and 0 < snapshots[-1]["fraction"] <= 1.0
+
+        instrument.to_json(osm_file + ".stats.json")
+        with open(osm_file + ".stats.json") as fi:
+            assert json.load(fi)["elements"] == len(data)
+        instrument.print_stats()
+
+        instrument = Instrumentation()
+        results = AuditXML(osm_file, instrument=instrument).audit()
+        assert results == AuditXML(osm_file).audit()
+        assert list(instrument.report()["stages"]) == ["parse", "audit"]
+        assert instrument.elements == sum(1 for doc in data if doc["type"] in ("node", "way"))
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Interning of repeated strings in the shaped documents.
+
+lxml returns a new string object for every attribute value it is asked for,
+so when shaped documents are kept in memory every copy of a user name, a
+version number or a value such as "residential" is a separate object.
+StringInterner keeps one canonical copy per distinct value and field. Fields
+are only interned while they are low cardinality: a field stops being
+interned, and its table is dropped, as soon as it has more distinct values
+than max_distinct, which rules out ids, timestamps, names and the like.
+
+Tag keys need no interning here, the field names come from the key
+classifier (tagkeys.KEY_CLASSIFIER) which already returns one shared string
+per distinct key.
+"""
+
+import sys
+
+
+class StringInterner(object):
+    """Per field tables of canonical string values"""
+
+    def __init__(self, max_distinct=4096):
+        """
+        Initialize empty tables
+        :param max_distinct: Number of distinct values above which a field is no longer interned
+        :return: None
+        """
+        self.max_distinct = max_distinct
+        # Field to table of value -> canonical value, None once the field is high cardinality
+        self.tables = {}
+
+    def value(self, field, s):
+        """
+        :param field: Shaped field name, eg. "highway" or "created.user"
+        :param s: String value
+        :return: The canonical copy of the value
+        """
+        table = self.tables.get(field)
+        if table is not None:
+            canonical = table.get(s)
+            if canonical is not None:
+                return canonical
+            if len(table) >= self.max_distinct:
+                self.tables[field] = None
+                return s
+        elif field in self.tables:
+            return s
+        else:
+            table = self.tables[field] = {}
+        table[s] = s
+
+        return s
+
+    def interned_fields(self):
+        """
+        :return: Sorted list of the fields that are interned
+        """
+        return sorted(field for field, table in self.tables.items() if table is not None)
+
+    def print_stats(self):
+        """
+        Print the interning statistics
+        :return: None
+        """
+        fields = self.interned_fields()
+        print("Interned fields: {0}, distinct values: {1}".format(
+            len(fields), sum(len(self.tables[field]) for field in fields)))
+        print("High cardinality fields not interned: {0}".format(
+            ", ".join(sorted(field for field, table in self.tables.items() if table is None))))
+
+        return
+
+
+def shared_size(obj, seen=None):
+    """
+    Size in bytes of an object and everything it contains, counting objects
+    referenced more than once only once
+    :param obj: Object, eg. the list of shaped documents
+    :param seen: Set of the ids of the objects already counted
+    :return: Size in bytes
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set)):
+            stack.extend(obj)
+
+    return size
+
+
+def test():
+    from project3 import CleanXML
+    from fixtures import example_copy
+
+    interner = StringInterner(max_distinct=2)
+    a, b = "".join(["resi", "dential"]), "".join(["resid", "ential"])
+    assert a is not b and interner.value("highway", a) is a and interner.value("highway", b) is a
+    interner.value("id", "1")
+    interner.value("id", "2")
+    third = "".join(["3"])
+    assert interner.value("id", third) is third
+    assert interner.interned_fields() == ["highway"] and interner.tables["id"] is None
+
+    # Interned and plain shaping give the same documents, with shared values
+    plain = CleanXML("example5.osm", intern_strings=False)
+    interned = CleanXML("example5.osm", intern_strings=True)
+    data = list(interned.iter_elements())
+    assert data == list(plain.iter_elements())
+    users = [doc["created"]["user"] for doc in data if doc.get("created", {}).get("user") == "bbmiller"]
+    assert len(users) > 1 and all(user is users[0] for user in users)
+    interned.interner.print_stats()
+
+    # By default only the documents kept in a list are interned, streaming has no tables.
+    # Work on a copy so the example output file is left untouched.
+    with example_copy() as osm_file:
+        cleaner = CleanXML(osm_file)
+        assert sum(1 for _ in cleaner.process_map(streaming=True)) == len(data) and cleaner.interner is None
+        assert cleaner.process_map() == data and cleaner.interner.interned_fields()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""In-process batched loader for shaped OpenStreetMap documents.
+
+Shaped documents are sent straight to MongoDB with insert_many instead of
+being written to a JSON file and imported with the mongoimport command line
+tool. Batch size, ordered/unordered writes and the write concern are
+configurable, and the loader reports its throughput once it is finished.
+"""
+
+import json
+import time
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError
+
+
+class MongoLoader(object):
+    """Batched loader for any iterable of documents into a MongoDB collection.
+    Works with a pymongo collection or a mongomock stand-in.
+    """
+
+    def __init__(self, collection, batch_size=1000, ordered=False, write_concern=None):
+        """
+        Initialize the loader
+        :param collection: pymongo (or mongomock) collection to insert into
+        :param batch_size: Number of documents sent per insert_many call
+        :param ordered: True to stop each batch at the first failed insert
+        :param write_concern: Dictionary of write concern options, eg. {"w": 1, "j": False}
+        :return: None
+        """
+        if write_concern:
+            collection = collection.with_options(write_concern=WriteConcern(**write_concern))
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ordered = ordered
+
+        # Statistics
+        self.num_inserted = 0
+        self.num_failed = 0
+        self.num_batches = 0
+        self.seconds = 0.0
+        self.write_errors = []
+
+    def insert_batch(self, batch):
+        """
+        Insert a single batch, recording any write errors
+        :param batch: List of documents
+        :return: None
+        """
+        try:
+            self.collection.insert_many(batch, ordered=self.ordered)
+            self.num_inserted += len(batch)
+        except BulkWriteError as e:
+            self.num_inserted += e.details["nInserted"]
+            self.num_failed += len(batch) - e.details["nInserted"]
+            self.write_errors.extend(e.details["writeErrors"])
+        self.num_batches += 1
+
+        return
+
+    def load(self, documents):
+        """
+        Insert all documents in batches
+        :param documents: Iterable of dictionaries, eg. the output of CleanXML.iter_elements
+        :return: Number of documents inserted
+        """
+        start = time.time()
+        batch = []
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) >= self.batch_size:
+                self.insert_batch(batch)
+                batch = []
+        if batch:
+            self.insert_batch(batch)
+        self.seconds += time.time() - start
+
+        return self.num_inserted
+
+    def load_file(self, filename):
+        """
+        Insert the documents of a newline delimited JSON file, eg. the output of process_map
+        :param filename: Name of the JSON file
+        :return: Number of documents inserted
+        """
+        with open(filename) as fi:
+            return self.load(json.loads(line) for line in fi if line.strip())
+
+    def docs_per_sec(self):
+        """
+        Insert rate of the documents loaded so far
+        :return: Documents per second
+        """
+        return self.num_inserted / (self.seconds + 1e-7)
+
+    def print_stats(self):
+        """
+        Print the results of the load
+        :return: None
+        """
+        print("Number of documents inserted: {0}".format(self.num_inserted))
+        print("Number of documents failed: {0}".format(self.num_failed))
+        print("Number of batches: {0}".format(self.num_batches))
+        print("Load time: {0:.2f} (s), {1:.0f} docs/sec".format(self.seconds, self.docs_per_sec()))
+
+        return
+
+
+def test():
+    import mongomock
+    from project3 import CleanXML
+    from fixtures import example_copy
+
+    collection = mongomock.MongoClient()["test"]["test"]
+    loader = MongoLoader(collection, batch_size=10, write_concern={"w": 1})
+    num_docs = loader.load(CleanXML("example5.osm").iter_elements())
+    loader.print_stats()
+
+    assert num_docs == 26
+    assert loader.num_batches == 3
+    assert collection.count_documents({"type": "node"}) == 23
+    assert collection.find_one({"id": "261114295"})["pos"] == [41.9730791, -87.6866303]
+
+    # Unordered inserts keep going past duplicate keys
+    docs = [{"_id": 1}, {"_id": 1}, {"_id": 2}]
+    loader = MongoLoader(collection, batch_size=10)
+    loader.load(docs)
+    assert loader.num_inserted == 2
+    assert loader.num_failed == 1
+
+    # The JSON output of process_map, through the insert_into_mongo entry point
+    with example_copy() as osm_file:
+        CleanXML(osm_file).process_map()
+        client = mongomock.MongoClient()
+        loader = CleanXML.insert_into_mongo("test", "from_file", osm_file[:-len(".osm")], client=client)
+        assert loader.num_inserted == 26 and client["test"]["from_file"].count_documents({"type": "node"}) == 23
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Offline columnar analytics backend for FixAndAnalyzeDB.
+
+The reports of FixAndAnalyzeDB need a running MongoDB. OfflineAnalyzeDB
+answers the same queries from the shaped output of CleanXML.process_map
+(<filename>.json, or <filename>.bson) without a database. Only the fields
+used by the analyses are loaded, one pandas column per field, and every
+query is a vectorized filter or group-by over those columns.
+"""
+
+import json
+import numpy as np
+import pandas as pd
+from bson import decode_file_iter
+from project3 import FixAndAnalyzeDB
+
+
+# Fields loaded as columns, nested fields as "address.city"
+COLUMNS = ["type", "id", "created.user", "FIXME", "amenity", "religion", "address.city", "address.postcode",
+           "address.street", "highway", "bicycle", "shop", "shop_1", "length_km"]
+
+
+def iter_docs(filename):
+    """
+    Read the shaped documents of a process_map output file
+    :param filename: Newline delimited .json file, or .bson file
+    :return: Generator of dictionaries
+    """
+    if filename.endswith(".bson"):
+        with open(filename, "rb") as fi:
+            for doc in decode_file_iter(fi):
+                yield doc
+    else:
+        with open(filename) as fi:
+            for line in fi:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def get_path(doc, path):
+    """
+    Get a nested field of a document
+    :param doc: Dictionary
+    :param path: Field path, eg. "address.city"
+    :return: The value, or None if the field does not exist
+    """
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return None
+        doc = doc[key]
+
+    return doc
+
+
+class OfflineAnalyzeDB(FixAndAnalyzeDB):
+    """FixAndAnalyzeDB backed by in-memory columns instead of a MongoDB collection"""
+
+    def __init__(self, filename, columns=None):
+        """
+        Load the shaped documents into columns
+        :param filename: Output file of CleanXML.process_map, eg. "centennial.osm.json"
+        :param columns: Extra field paths to load as columns, eg. for apply_corrections
+        :return: None
+        """
+        self.collection = None
+        self.area_km = 0
+        self.num_ways = 0
+        self.bounds = None
+
+        self.columns = COLUMNS + [c for c in (columns or []) if c not in COLUMNS]
+        values = dict((column, []) for column in self.columns)
+        lat = []
+        lon = []
+        for doc in iter_docs(filename):
+            if doc.get("type") == "bounds" and self.bounds is None:
+                self.bounds = doc
+            for column in self.columns:
+                values[column].append(get_path(doc, column))
+            pos = doc.get("pos")
+            lat.append(pos[0] if pos else np.nan)
+            lon.append(pos[1] if pos else np.nan)
+
+        self.frame = pd.DataFrame(values, columns=self.columns)
+        self.frame["length_km"] = pd.to_numeric(self.frame["length_km"])
+        self.frame["lat"] = np.array(lat, dtype=np.float64)
+        self.frame["lon"] = np.array(lon, dtype=np.float64)
+
+        return
+
+    def column(self, field):
+        """
+        :param field: Field path
+        :return: The column of the field
+        """
+        if field not in self.frame:
+            raise ValueError("Field {0} is not loaded, pass it in columns".format(field))
+
+        return self.frame[field]
+
+    @staticmethod
+    def sorted_counts(series, dropna=True):
+        """
+        Count the values of a column, most common first. Ties are broken by value.
+        :param series: Column to count
+        :param dropna: False to count missing values as None
+        :return: List of (value, count) pairs
+        """
+        counts = series.value_counts(dropna=dropna, sort=False)
+        order = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))
+
+        return [(None if pd.isnull(value) else value, int(count)) for value, count in order]
+
+    def city_counts(self):
+        return self.sorted_counts(self.column("address.city"))
+
+    def apply_corrections(self, corrections):
+        """
+        Correct erroneous values of any loaded fields
+        :param corrections: Map of field path (eg. "address.city") to a map of erroneous to correct value
+        :return: number of documents matched, number of documents modified
+        """
+        num_matched = 0
+        num_modified = 0
+        for field, mapping in corrections.items():
+            column = self.column(field)
+            matched = column.isin(list(mapping.keys()))
+            corrected = column[matched].map(mapping)
+            num_matched += int(matched.sum())
+            num_modified += int((corrected != column[matched]).sum())
+            self.frame.loc[matched, field] = corrected
+
+        return num_matched, num_modified
+
+    def create_indexes(self):
+        return []
+
+    def overview_counts(self):
+        frame = self.frame
+        place_of_worship = frame["amenity"] == "place_of_worship"
+
+        return {
+            "docs": len(frame),
+            "nodes": int((frame["type"] == "node").sum()),
+            "ways": int((frame["type"] == "way").sum()),
+            "ecarl65": int((frame["created.user"] == "ecarl65").sum()),
+            "users": int(frame["created.user"].nunique()),
+            "fixme": int(frame["FIXME"].notnull().sum()),
+            "churches": int(place_of_worship.sum()),
+            "churches_wo_religion": int((place_of_worship & frame["religion"].isnull()).sum()),
+        }
+
+    def postcode_counts(self, limit=6):
+        postcodes = self.frame.loc[self.frame["type"] == "node", "address.postcode"].dropna()
+
+        return sorted(self.sorted_counts(postcodes))[:limit]
+
+    def reported_bounds(self):
+        return self.bounds
+
+    def highway_counts(self, limit=12):
+        return self.sorted_counts(self.frame.loc[self.frame["type"] == "way", "highway"])[:limit]
+
+    def bicycle_counts(self):
+        return self.sorted_counts(self.frame.loc[self.frame["type"] == "way", "bicycle"], dropna=False)
+
+    def bike_way_mask(self):
+        """
+        :return: Boolean mask of the ways in which bicycling is allowed
+        """
+        frame = self.frame
+        return (frame["type"] == "way") & ((frame["highway"] == "cycleway") |
+                                           frame["bicycle"].isin(self.bicycle_allowed))
+
+    def num_bike_ways(self):
+        return int(self.bike_way_mask().sum())
+
+    def bike_way_lengths(self):
+        ways = self.frame[self.bike_way_mask() & self.frame["length_km"].notnull()]
+        lengths = ways.groupby(ways["highway"].fillna("None"), sort=True)["length_km"].sum()
+        order = sorted(lengths.items(), key=lambda item: -item[1])
+
+        return [(None if highway == "None" else highway, float(length_km)) for highway, length_km in order]
+
+    def num_bike_shops(self):
+        return int(((self.frame["shop"] == "bicycle") | (self.frame["shop_1"] == "bicycle")).sum())
+
+    def measured_extent(self):
+        lat = self.frame["lat"]
+        lon = self.frame["lon"]
+
+        return float(lat.min()), float(lat.max()), float(lon.min()), float(lon.max())
+
+
+def test():
+    import mongomock
+    from project3 import CleanXML
+    from geometry import WayGeometry
+    from fixtures import example_copy
+
+    with example_copy() as osm_file:
+
+        # A few extra fields so that every report has something to count
+        data = CleanXML(osm_file).process_map(geometry=WayGeometry())
+        ways = [doc for doc in data if doc["type"] == "way"]
+        ways[0]["highway"] = "cycleway"
+        ways[0]["length_km"] = 1.5
+        ways[1]["bicycle"] = "yes"
+        data[1]["address"] = {"city": "Centenn", "postcode": "80122"}
+        data[2]["address"] = {"city": "Centennial", "postcode": "80112"}
+        data[3]["shop"] = "bicycle"
+        with open(osm_file + ".json", "w") as fo:
+            for doc in data:
+                fo.write(json.dumps(doc) + "\n")
+
+        client = mongomock.MongoClient()
+        client["test"]["test"].insert_many([dict(doc) for doc in data])
+        online = FixAndAnalyzeDB("test", "test", client=client)
+        offline = OfflineAnalyzeDB(osm_file + ".json")
+
+        assert offline.city_counts() == online.city_counts()
+        assert offline.overview_counts() == online.overview_counts()
+        assert offline.postcode_counts() == online.postcode_counts()
+        assert offline.highway_counts() == online.highway_counts()
+        assert sorted(offline.bicycle_counts(), key=str) == sorted(online.bicycle_counts(), key=str)
+        assert offline.num_bike_ways() == online.num_bike_ways() == 2
+        assert offline.bike_way_lengths() == online.bike_way_lengths()
+        assert offline.num_bike_shops() == online.num_bike_shops() == 1
+        assert offline.reported_bounds()["maxlon"] == online.reported_bounds()["maxlon"]
+        assert offline.measured_extent() == online.measured_extent()
+        cleaner = CleanXML(osm_file)
+        list(cleaner.iter_elements())
+        assert tuple(cleaner.extent) == online.measured_extent()
+
+        corrections = {"address.city": {"Centenn": "Centennial"}}
+        assert offline.apply_corrections(corrections) == online.apply_corrections(corrections) == (1, 1)
+        assert offline.city_counts() == online.city_counts()
+        assert dict(offline.city_counts())["Centennial"] == 2
+
+        # The reports run unchanged on the offline backend
+        offline.fix_cities({"Centenn": "Centennial"})
+        offline.data_overview()
+        offline.additional_ideas()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""Incremental ingest of OpenStreetMap change files (.osc).
+
+An osmChange file lists the nodes, ways and relations created, modified and
+deleted since an extract was made, inside <create>, <modify> and <delete>
+blocks. Created and modified elements are shaped with the same rules as
+CleanXML.shape_element and upserted, deleted elements are removed. The
+operations are sent with bulk_write in batches, keyed on the element type and
+id since node and way ids are allocated independently.
+
+A replaced document loses the fields derived at load time, so the changed
+ways get their length_km and bbox again (see geometry.WayGeometry), from the
+node positions of the change file and of the collection, and the field
+corrections applied with FixAndAnalyzeDB.apply_corrections can be applied to
+the changed documents before they are written.
+"""
+
+from lxml import etree
+from pymongo import DeleteOne, ReplaceOne
+from project3 import CleanXML
+from compressed import open_osm
+from geometry import NodeIndex, WayGeometry
+
+
+def correct_document(doc, corrections):
+    """
+    Apply field corrections to a shaped document, as FixAndAnalyzeDB.apply_corrections does on the server
+    :param doc: Shaped dictionary
+    :param corrections: Map of field path (eg. "address.city") to a map of erroneous to correct value
+    :return: None
+    """
+    for field, mapping in corrections.items():
+        parent = doc
+        path = field.split(".")
+        for key in path[:-1]:
+            parent = parent.get(key)
+            if not isinstance(parent, dict):
+                break
+        else:
+            value = parent.get(path[-1])
+            if isinstance(value, str) and value in mapping:
+                parent[path[-1]] = mapping[value]
+
+    return
+
+
+class ChangeIngester(object):
+    """Applies an osmChange file to a collection of shaped documents"""
+
+    def __init__(self, filename, collection, batch_size=1000, geometry=None, corrections=None):
+        """
+        Initialize the ingester
+        :param filename: Input .osc filename, or .osc.gz (the format of the replication diffs)
+        :param collection: pymongo (or mongomock) collection holding the shaped documents
+        :param batch_size: Number of operations per bulk_write call
+        :param geometry: True to attach length_km and bbox to the created and modified ways, None to
+                         do so when the ways of the collection have them
+        :param corrections: Optional map of field path to a map of erroneous to correct value, as
+                            given to FixAndAnalyzeDB.apply_corrections, applied to the changed documents
+        :return: None
+        """
+        self.filename = filename
+        self.collection = collection
+        self.batch_size = batch_size
+        self.geometry = geometry
+        self.corrections = corrections
+        self.cleaner = CleanXML(filename)
+        self.actions = ("create", "modify", "delete")
+
+        # Positions of the nodes changed by the file, None for the deleted ones
+        self.positions = {}
+
+        # Statistics
+        self.num_upserted = 0
+        self.num_modified = 0
+        self.num_deleted = 0
+        self.num_skipped = 0
+
+    def change(self, action, element):
+        """
+        Shape one changed element
+        :param action: "create", "modify" or "delete"
+        :param element: Changed node, way or relation element
+        :return: Tuple of (key, shaped dictionary or None for a delete), or None if the element is not stored
+        """
+        if element.tag not in ("node", "way"):
+            return None
+
+        key = {"type": element.tag, "id": element.attrib["id"]}
+        doc = None if action == "delete" else self.cleaner.shape_element(element)
+        if element.tag == "node":
+            self.positions[int(key["id"])] = doc.get("pos") if doc else None
+        if doc and self.corrections:
+            correct_document(doc, self.corrections)
+
+        return key, doc
+
+    @staticmethod
+    def operation(key, doc):
+        """
+        :param key: Type and id of the element
+        :param doc: Shaped dictionary, None to delete the element
+        :return: ReplaceOne or DeleteOne operation
+        """
+        if doc is None:
+            return DeleteOne(key)
+
+        return ReplaceOne(key, doc, upsert=True)
+
+    def resolve_ways(self, ways):
+        """
+        Attach length_km and bbox to changed ways. Nodes changed by the file take
+        precedence over the nodes stored in the collection.
+        :param ways: List of shaped way dictionaries
+        :return: None
+        """
+        refs = set(int(ref) for way in ways for ref in way.get("node_refs", ()))
+        index = NodeIndex()
+        stored = [str(ref) for ref in refs if ref not in self.positions]
+        for node in self.collection.find({"type": "node", "id": {"$in": stored}, "pos": {"$exists": True}},
+                                         {"id": 1, "pos": 1}):
+            index.add(int(node["id"]), node["pos"][0], node["pos"][1])
+        for ref in refs:
+            pos = self.positions.get(ref)
+            if pos:
+                index.add(ref, pos[0], pos[1])
+        WayGeometry(index).resolve(ways)
+
+        return
+
+    def write_batch(self, changes):
+        """
+        Send one batch of changes. The batch is ordered so that repeated changes
+        to the same element in one file are applied in sequence.
+        :param changes: List of (key, shaped dictionary or None) from change
+        :return: None
+        """
+        if self.geometry:
+            ways = [doc for _, doc in changes if doc is not None and doc["type"] == "way"]
+            if ways:
+                self.resolve_ways(ways)
+
+        result = self.collection.bulk_write([self.operation(key, doc) for key, doc in changes], ordered=True)
+        self.num_upserted += result.upserted_count
+        self.num_modified += result.modified_count
+        self.num_deleted += result.deleted_count
+
+        return
+
+    def apply(self):
+        """
+        Parse the change file and apply all of its changes
+        :return: Total number of documents upserted, modified or deleted
+        """
+
+        # Without an index on the key every upsert and delete scans the collection
+        self.collection.create_index([("type", 1), ("id", 1)])
+        if self.geometry is None:
+            self.geometry = self.collection.find_one({"type": "way", "length_km": {"$exists": True}}) is not None
+
+        changes = []
+        source = open_osm(self.filename)
+        for _, element in etree.iterparse(source, events=("end",),
+                                          tag=self.cleaner.top_level_tags + self.actions):
+            if element.tag in self.actions:
+                # The block is empty by now, its elements have already been freed
+                self.cleaner.free_element(element)
+                continue
+
+            action = element.getparent().tag
+            if action not in self.actions:
+                self.num_skipped += 1
+            else:
+                change = self.change(action, element)
+                if change is None:
+                    self.num_skipped += 1
+                else:
+                    changes.append(change)
+            self.cleaner.free_element(element)
+
+            if len(changes) >= self.batch_size:
+                self.write_batch(changes)
+                changes = []
+
+        source.close()
+
+        if changes:
+            self.write_batch(changes)
+
+        return self.num_upserted + self.num_modified + self.num_deleted
+
+    def print_stats(self):
+        """
+        Print the results of applying the change file
+        :return: None
+        """
+        print("Documents created: {0}".format(self.num_upserted))
+        print("Documents modified: {0}".format(self.num_modified))
+        print("Documents deleted: {0}".format(self.num_deleted))
+        print("Changes skipped: {0}".format(self.num_skipped))
+
+        return
+
+
+def test():
+    import mongomock
+    from loader import MongoLoader
+    from geodesic import haversine_km
+
+    collection = mongomock.MongoClient()["test"]["test"]
+    MongoLoader(collection).load(CleanXML("example5.osm").iter_elements())
+    num_docs = collection.count_documents({})
+
+    ingester = ChangeIngester("example5.osc", collection, batch_size=2)
+    ingester.apply()
+    ingester.print_stats()
+
+    assert (ingester.num_upserted, ingester.num_modified, ingester.num_deleted) == (1, 2, 1)
+    assert ingester.num_skipped == 1
+    assert collection.count_documents({}) == num_docs
+    assert collection.find_one({"id": "261114296"}) is None
+    assert collection.find_one({"id": "261114295"})["amenity"] == "bicycle_parking"
+    assert collection.find_one({"id": "4000000001"})["address"]["street"] == "North Lincoln Avenue"
+    assert collection.find_one({"id": "209809850"})["node_refs"] == ["2199822281", "2199822390", "2199822281"]
+
+    # Applying the same changes again is idempotent
+    ChangeIngester("example5.osc", collection).apply()
+    assert collection.count_documents({}) == num_docs
+    assert "length_km" not in collection.find_one({"id": "209809850"})
+
+    # A collection loaded with way geometry and corrected keeps both on the changed documents
+    nodes = [{"type": "node", "id": "2199822281", "pos": [41.9731, -87.6868]},
+             {"type": "node", "id": "2199822390", "pos": [41.9733, -87.6868]}]
+    collection = mongomock.MongoClient()["test"]["geometry"]
+    MongoLoader(collection).load(WayGeometry().process(nodes + list(CleanXML("example5.osm").iter_elements())))
+    way = collection.find_one({"id": "209809850"})
+    bbox = {"minlat": 41.9731, "minlon": -87.6868, "maxlat": 41.9733, "maxlon": -87.6868}
+    assert way["bbox"] == bbox and way["length_km"] > 0
+    corrections = {"amenity": {"bicycle_parking": "bicycle_rack"}}
+    ingester = ChangeIngester("example5.osc", collection, batch_size=2, corrections=corrections)
+    ingester.apply()
+    way = collection.find_one({"id": "209809850"})
+    assert ingester.geometry and way["building"] == "garage" and way["bbox"] == bbox
+    assert abs(way["length_km"] - 2 * haversine_km(41.9731, -87.6868, 41.9733, -87.6868)) < 1e-9
+    assert collection.find_one({"id": "261114295"})["amenity"] == "bicycle_rack"
+
+    # A node changed by the file is used instead of the stored one
+    ingester.positions[2199822390] = [41.9735, -87.6868]
+    ingester.resolve_ways([way])
+    assert way["bbox"]["maxlat"] == 41.9735
+
+    correct_document(way, {"address.city": {"x": "y"}, "building": {"garage": "garages"}})
+    assert way["building"] == "garages" and "address" not in way
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""Multi-process parsing of OpenStreetMap .osm files.
+
+The input file is split into byte ranges that each start on a top level
+<node, <way or <relation element. Each range is parsed independently in a
+process pool, so shaping and auditing of large extracts is spread across all
+available cores. The shaped output of each range is written to a part file
+and the parts are concatenated in their original order at the end, so the
+NDJSON output is identical to the single process version.
+"""
+
+import io
+import os
+import re
+import sys
+import shutil
+import multiprocessing as mp
+from collections import defaultdict
+from contextlib import redirect_stdout
+from lxml import etree
+import json
+from project3 import AuditXML, CleanXML
+from geometry import WayGeometry
+from serializers import BUFFER_SIZE, get_serializer
+from compressed import is_compressed
+
+
+# Regular expression for the start of a top level element that a chunk may begin on
+ELEMENT_START_RE = re.compile(br'<(?:node|way|relation)[\s/>]')
+
+# Default size of each byte range handed to a worker
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def find_chunk_ranges(filename, chunk_size=CHUNK_SIZE):
+    """
+    Split the file into byte ranges that start on element boundaries
+    :param filename: Input .osm filename
+    :param chunk_size: Approximate size of each range in bytes
+    :return: List of (start, end) byte offsets covering the whole file
+    """
+    file_size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as fi:
+        offset = chunk_size
+        while offset < file_size:
+            fi.seek(offset)
+            # Read forward until the next element start is found
+            buf = b""
+            start = None
+            while start is None:
+                block = fi.read(64 * 1024)
+                if not block:
+                    break
+                buf += block
+                match = ELEMENT_START_RE.search(buf)
+                if match:
+                    start = offset + match.start()
+            if start is None:
+                break
+            if start > boundaries[-1]:
+                boundaries.append(start)
+            offset = start + chunk_size
+
+    boundaries.append(file_size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class ChunkReader(object):
+    """File-like object that reads one byte range of an .osm file. The range
+    is wrapped in <osm> tags where needed so that it parses as a complete
+    document on its own.
+    """
+
+    def __init__(self, filename, start, end, file_size):
+        """
+        Initialize the reader
+        :param filename: Input .osm filename
+        :param start: Start byte offset of the range
+        :param end: End byte offset of the range
+        :param file_size: Total size of the file
+        :return: None
+        """
+        self.fi = open(filename, "rb")
+        self.fi.seek(start)
+        self.remaining = end - start
+        self.prefix = b"<osm>" if start > 0 else b""
+        self.suffix = b"</osm>" if end < file_size else b""
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes of the wrapped range
+        :param size: Maximum number of bytes to return
+        :return: Bytes read, empty at the end of the range
+        """
+        if size is None or size < 0:
+            size = self.remaining + len(self.prefix) + len(self.suffix)
+
+        if self.prefix:
+            out, self.prefix = self.prefix, b""
+            return out
+
+        if self.remaining > 0:
+            out = self.fi.read(min(size, self.remaining))
+            self.remaining -= len(out)
+            return out
+
+        out, self.suffix = self.suffix, b""
+        return out
+
+    def close(self):
+        """
+        Close the underlying file
+        :return: None
+        """
+        self.fi.close()
+
+
+def shape_chunk(args):
+    """
+    Worker that shapes one byte range and writes it to a part file
+    :param args: Tuple of (filename, start, end, part filename, pretty, output format)
+    :return: Tuple of (number of documents, num_streets_total, num_streets_corrected, extent)
+    """
+    filename, start, end, part_file, pretty, output_format = args
+    cleaner = CleanXML(filename)
+    serializer = get_serializer(output_format, pretty)
+    reader = ChunkReader(filename, start, end, os.path.getsize(filename))
+    num_docs = 0
+    with open(part_file, "wb", BUFFER_SIZE) as fo:
+        for _, element in etree.iterparse(reader, events=("end",), tag=cleaner.top_level_tags):
+            el = cleaner.shape_element(element)
+            cleaner.free_element(element)
+            if el:
+                num_docs += 1
+                fo.write(serializer.dumps(el))
+    reader.close()
+
+    return num_docs, dict(cleaner.num_streets_total), dict(cleaner.num_streets_corrected), cleaner.extent
+
+
+def audit_chunk(args):
+    """
+    Worker that audits one byte range. The FIXME, place of worship and street
+    lines AuditXML prints are returned instead, for the parent to print in order.
+    :param args: Tuple of (filename, start, end)
+    :return: Tuple of (street types, street prefixes, street suites, fixme, no_religion, printed report)
+    """
+    filename, start, end = args
+    auditor = AuditXML(filename)
+    street_types = defaultdict(set)
+    street_prefixes = defaultdict(set)
+    street_suites = defaultdict(set)
+    fixme = []
+    no_religion = []
+    report = io.StringIO()
+    reader = ChunkReader(filename, start, end, os.path.getsize(filename))
+    with redirect_stdout(report):
+        for _, elem in etree.iterparse(reader, events=("end",), tag=("node", "way", "relation")):
+            if elem.tag != "relation":
+                auditor.audit_element(elem, street_types, street_prefixes, street_suites, fixme, no_religion)
+            CleanXML.free_element(elem)
+    reader.close()
+
+    return dict(street_types), dict(street_prefixes), dict(street_suites), fixme, no_religion, report.getvalue()
+
+
+def merge_counts(total, counts):
+    """
+    Add the counts of one worker into the running total
+    :param total: defaultdict(int) of merged counts
+    :param counts: Dictionary of counts from one worker
+    :return: None
+    """
+    for key, count in counts.items():
+        total[key] += count
+
+    return
+
+
+def merge_sets(total, sets):
+    """
+    Union the sets of one worker into the running total
+    :param total: defaultdict(set) of merged sets
+    :param sets: Dictionary of sets from one worker
+    :return: None
+    """
+    for key, values in sets.items():
+        total[key] |= values
+
+    return
+
+
+class ParallelCleanXML(CleanXML):
+    """Process pool version of CleanXML. process_map_parallel writes the same
+    output file, with the same street correction statistics, as the single
+    process version. The inherited process_map is the single process version.
+    """
+
+    def __init__(self, filename, processes=None, chunk_size=CHUNK_SIZE, instrument=None):
+        """
+        Initialize the object
+        :param filename: The input .osm filename to process
+        :param processes: Number of worker processes, defaults to the number of cores
+        :param chunk_size: Approximate size in bytes of the range given to each task
+        :param instrument: Optional instrument.Instrumentation, which makes process_map_parallel
+                           run in a single process so that every stage is measured
+        :return: None
+        """
+        super(ParallelCleanXML, self).__init__(filename, instrument)
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    def process_map_parallel(self, pretty=False, output_format="json"):
+        """
+        Shape the whole file in parallel and write it to <filename>.json, or
+        <filename>.bson for the BSON output format. Shaped documents are not kept
+        in memory, only the number written is returned.
+        :param pretty: True to indent the JSON output
+        :param output_format: Output serializer name, "json" or "bson" (see serializers.get_serializer)
+        :return: Number of documents written
+        """
+        # Compressed input cannot be split into byte ranges, it is parsed in one process
+        # while compressed.ParallelBZ2Reader spreads the decompression over the cores.
+        # The stage timings of the instrumentation are only recorded in a single process.
+        if is_compressed(self.filename) or self.instrument is not None:
+            return sum(1 for _ in self.stream_map(pretty, output_format))
+
+        file_out = get_serializer(output_format).output_name(self.filename)
+        ranges = find_chunk_ranges(self.filename, self.chunk_size)
+        part_files = ["{0}.part{1:05d}".format(file_out, i) for i in range(len(ranges))]
+        tasks = [(self.filename, start, end, part_file, pretty, output_format)
+                 for (start, end), part_file in zip(ranges, part_files)]
+
+        num_docs = 0
+        pool = mp.Pool(self.processes)
+        try:
+            for count, streets_total, streets_corrected, extent in pool.imap(shape_chunk, tasks):
+                num_docs += count
+                merge_counts(self.num_streets_total, streets_total)
+                merge_counts(self.num_streets_corrected, streets_corrected)
+                self.merge_extent(extent)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Concatenate the parts in their original order
+        with open(file_out, "wb") as fo:
+            for part_file in part_files:
+                with open(part_file, "rb") as fi:
+                    shutil.copyfileobj(fi, fo)
+                os.remove(part_file)
+
+        return num_docs
+
+
+class ParallelAuditXML(AuditXML):
+    """Process pool version of AuditXML"""
+
+    def __init__(self, filename, processes=None, chunk_size=CHUNK_SIZE):
+        """
+        Initialize the object
+        :param filename: Input filename
+        :param processes: Number of worker processes, defaults to the number of cores
+        :param chunk_size: Approximate size in bytes of the range given to each task
+        :return: None
+        """
+        super(ParallelAuditXML, self).__init__(filename)
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    def audit(self, approximate=False, top_k=20):
+        """
+        Perform the auditing function across a process pool
+        :param approximate: True for the fixed memory audit of AuditXML.audit, which runs in a single process
+        :param top_k: Number of most frequent street types, prefixes and suites kept when approximate
+        :return: street_types dictionary, street prefixes dictionary, street suites dictionary
+        """
+        if is_compressed(self.osmfile) or approximate:
+            return super(ParallelAuditXML, self).audit(approximate, top_k)
+
+        street_types = defaultdict(set)
+        street_prefixes = defaultdict(set)
+        street_suites = defaultdict(set)
+
+        tasks = [(self.osmfile, start, end) for start, end in find_chunk_ranges(self.osmfile, self.chunk_size)]
+        reports = []
+        pool = mp.Pool(self.processes)
+        try:
+            for types, prefixes, suites, _, _, report in pool.imap(audit_chunk, tasks):
+                merge_sets(street_types, types)
+                merge_sets(street_prefixes, prefixes)
+                merge_sets(street_suites, suites)
+                reports.append(report)
+        finally:
+            pool.close()
+            pool.join()
+
+        # The chunks are in file order, so the lines come out as in the single process audit
+        for report in reports:
+            sys.stdout.write(report)
+
+        return street_types, street_prefixes, street_suites
+
+
+def test():
+    from fixtures import example_copy
+
+    # Work on a copy so the example output file is left untouched, and use a tiny
+    # chunk size so that the example file is split into many ranges
+    with example_copy() as osm_file:
+        serial = CleanXML(osm_file)
+        data = serial.process_map()
+
+        parallel = ParallelCleanXML(osm_file, processes=2, chunk_size=512)
+        num_docs = parallel.process_map_parallel()
+        with open(osm_file + ".json") as fi:
+            parallel_data = [json.loads(line) for line in fi]
+
+        assert num_docs == len(data)
+        assert parallel_data == data
+        assert parallel.num_streets_total == serial.num_streets_total
+        assert parallel.num_streets_corrected == serial.num_streets_corrected
+        assert parallel.extent == serial.extent
+
+        # The inherited process_map keeps the contract of CleanXML
+        assert ParallelCleanXML(osm_file, processes=2).process_map(geometry=WayGeometry()) == \
+            CleanXML(osm_file).process_map(geometry=WayGeometry())
+
+        # The workers' lines are printed by the parent, in the order of the single process audit
+        auditor = ParallelAuditXML(osm_file, processes=2, chunk_size=512)
+        parallel_report = io.StringIO()
+        with redirect_stdout(parallel_report):
+            st_types, _, _ = auditor.audit()
+        serial_report = io.StringIO()
+        with redirect_stdout(serial_report):
+            serial_types, _, _ = AuditXML(osm_file).audit()
+        assert "Before: " in serial_report.getvalue() and parallel_report.getvalue() == serial_report.getvalue()
+        assert st_types == serial_types and set(st_types) == {"Ave", "Rd.", "St."}
+        approx_types, _, _ = auditor.audit(approximate=True, top_k=5)
+        assert set(key for key, _, _ in approx_types.most_common()) == set(st_types)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""Single pass analysis framework for OpenStreetMap .osm files.
+
+The audit, cleaning and statistics steps of the project each used to parse
+the whole file on their own. Here each analysis is a visitor that registers
+the element tags it is interested in, and all registered visitors are run
+from a single iterparse traversal of the file. The results are returned per
+visitor, keyed by the visitor name.
+"""
+
+import os
+from collections import defaultdict
+from pprint import pprint
+from lxml import etree
+from project3 import AuditXML, CleanXML
+from serializers import get_serializer
+from compressed import open_osm, uncompressed_name
+from tagkeys import KEY_CLASSIFIER
+from sketches import HeavyHitters
+
+
+class Visitor(object):
+    """Base class of an analysis run by SinglePass. Subclasses set name and
+    tags, and implement visit and result. visit is called on the end event of
+    every element whose tag is in tags, or of every element when tags is None.
+    """
+
+    name = None
+    tags = None
+
+    def begin(self):
+        """
+        Called once before the traversal starts
+        :return: None
+        """
+        return
+
+    def visit(self, element):
+        """
+        Called for each matching element, after all of its children have been parsed
+        :param element: XML element
+        :return: None
+        """
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        Called once after the traversal ends
+        :return: None
+        """
+        return
+
+    def result(self):
+        """
+        :return: The result of the analysis
+        """
+        raise NotImplementedError
+
+
+class TagCountVisitor(Visitor):
+    """Count of every element tag in the file, as in mapparser.count_tags"""
+
+    name = "tag_counts"
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def visit(self, element):
+        self.counts[element.tag] += 1
+
+    def result(self):
+        return dict(self.counts)
+
+
+class KeyTypeVisitor(Visitor):
+    """Classification of the <tag> keys, as in tags.key_type"""
+
+    name = "key_types"
+    tags = ("tag",)
+
+    def __init__(self):
+        self.keys = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+        self.key_type = KEY_CLASSIFIER.key_type
+
+    def visit(self, element):
+        self.keys[self.key_type(element.get('k'))] += 1
+
+    def result(self):
+        return self.keys
+
+
+class UserVisitor(Visitor):
+    """Set of unique users, as in users.process_map"""
+
+    name = "users"
+
+    def __init__(self):
+        self.users = set()
+
+    def visit(self, element):
+        user = element.get('user')
+        if user:
+            self.users.add(user)
+
+    def result(self):
+        return self.users
+
+
+class AuditVisitor(Visitor):
+    """Street name audit, as in AuditXML.audit, exact or approximate"""
+
+    name = "audit"
+    tags = ("node", "way")
+
+    def __init__(self, filename, approximate=False, top_k=20):
+        self.auditor = AuditXML(filename)
+        if approximate:
+            self.street_types = HeavyHitters(top_k)
+            self.street_prefixes = HeavyHitters(top_k)
+            self.street_suites = HeavyHitters(top_k)
+            self.fixme = HeavyHitters(top_k)
+            self.no_religion = HeavyHitters(top_k)
+        else:
+            self.street_types = defaultdict(set)
+            self.street_prefixes = defaultdict(set)
+            self.street_suites = defaultdict(set)
+            self.fixme = []
+            self.no_religion = []
+
+    def visit(self, element):
+        self.auditor.audit_element(element, self.street_types, self.street_prefixes, self.street_suites,
+                                   self.fixme, self.no_religion)
+
+    def result(self):
+        return self.street_types, self.street_prefixes, self.street_suites
+
+
+class CleanVisitor(Visitor):
+    """Shaping and JSON output, as in CleanXML.process_map. The street correction
+    statistics are available from the cleaner attribute afterwards.
+    """
+
+    name = "clean"
+
+    def __init__(self, filename, pretty=False, keep_data=False, output_format="json"):
+        """
+        Initialize the visitor
+        :param filename: The input .osm filename, output goes to <filename>.json or <filename>.bson
+        :param pretty: True to indent the JSON output
+        :param keep_data: True to keep and return the shaped documents, otherwise only count them
+        :param output_format: Output serializer name, "json" or "bson" (see serializers.get_serializer)
+        :return: None
+        """
+        self.cleaner = CleanXML(filename)
+        self.serializer = get_serializer(output_format, pretty)
+        self.tags = self.cleaner.top_level_tags
+        self.keep_data = keep_data
+        self.data = []
+        self.num_docs = 0
+        self.fo = None
+
+    def begin(self):
+        self.fo = self.serializer.open(uncompressed_name(self.cleaner.filename))
+
+    def visit(self, element):
+        el = self.cleaner.shape_element(element)
+        if el:
+            self.num_docs += 1
+            if self.keep_data:
+                self.data.append(el)
+            self.fo.write(self.serializer.dumps(el))
+
+    def finish(self):
+        self.fo.close()
+
+    def result(self):
+        if self.keep_data:
+            return self.data
+        return self.num_docs
+
+
+class SinglePass(object):
+    """Runs any number of registered visitors over one traversal of the file"""
+
+    def __init__(self, filename):
+        """
+        Initialize the object
+        :param filename: Input .osm filename, .osm.bz2 and .osm.gz are decompressed on the fly
+        :return: None
+        """
+        self.filename = filename
+        self.visitors = []
+        self.top_level_tags = ("bounds", "node", "way", "relation")
+
+    def register(self, visitor):
+        """
+        Register a visitor to be run in the pass
+        :param visitor: Visitor instance, its name must be unique
+        :return: self, so that calls can be chained
+        """
+        if any(v.name == visitor.name for v in self.visitors):
+            raise ValueError("Visitor {0} is already registered".format(visitor.name))
+        self.visitors.append(visitor)
+
+        return self
+
+    def run(self):
+        """
+        Parse the file once and dispatch every element to the interested visitors
+        :return: Dictionary of visitor name to visitor result
+        """
+        for visitor in self.visitors:
+            visitor.begin()
+
+        # Pre-compute the visitors of each tag, visitors of every tag are looked up separately
+        by_tag = defaultdict(list)
+        every_tag = []
+        for visitor in self.visitors:
+            if visitor.tags is None:
+                every_tag.append(visitor)
+            else:
+                for tag in visitor.tags:
+                    by_tag[tag].append(visitor)
+
+        with open_osm(self.filename) as source:
+            for _, element in etree.iterparse(source, events=("end",)):
+                for visitor in every_tag:
+                    visitor.visit(element)
+                for visitor in by_tag.get(element.tag, ()):
+                    visitor.visit(element)
+
+                # Children have all been visited by the time their parent ends
+                if element.tag in self.top_level_tags:
+                    CleanXML.free_element(element)
+
+        for visitor in self.visitors:
+            visitor.finish()
+
+        return dict((visitor.name, visitor.result()) for visitor in self.visitors)
+
+
+def test():
+    results = SinglePass("example.osm").register(TagCountVisitor()).run()
+    assert results["tag_counts"] == {'bounds': 1, 'member': 3, 'nd': 4, 'node': 20, 'osm': 1,
+                                     'relation': 1, 'tag': 7, 'way': 1}
+
+    results = SinglePass("example2.osm").register(KeyTypeVisitor()).run()
+    assert results["key_types"] == {'lower': 5, 'lower_colon': 0, 'other': 1, 'problemchars': 1}
+
+    results = SinglePass("example3.osm").register(UserVisitor()).run()
+    assert len(results["users"]) == 6
+
+    # All analyses together on one file
+    single_pass = SinglePass("example4.osm")
+    single_pass.register(TagCountVisitor()).register(KeyTypeVisitor()).register(UserVisitor())
+    single_pass.register(AuditVisitor("example4.osm"))
+    single_pass.register(CleanVisitor("example4.osm", keep_data=True))
+    results = single_pass.run()
+    pprint(results)
+
+    st_types, _, _ = results["audit"]
+    assert set(st_types) == {"Ave", "Rd.", "St."}
+
+    approx_results = SinglePass("example4.osm").register(AuditVisitor("example4.osm", approximate=True)).run()
+    approx_types, _, _ = approx_results["audit"]
+    assert set(key for key, _, _ in approx_types.most_common()) == set(st_types)
+    assert results["clean"] == CleanXML("example4.osm").process_map()
+    os.remove("example4.osm.json")
+
+
+if __name__ == "__main__":
+    test()
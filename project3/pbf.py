@@ -0,0 +1,827 @@
+#!/usr/bin/env python
+"""Native reader of OpenStreetMap .osm.pbf files.
+
+A PBF file is a sequence of blobs, each a length prefixed BlobHeader followed
+by a (normally zlib compressed) Blob holding either the HeaderBlock or a
+PrimitiveBlock of nodes, dense nodes, ways and relations. Strings are stored
+once per block in a string table and referenced by index, and ids,
+coordinates and metadata of dense nodes are delta coded. The protocol buffer
+wire format is decoded here directly, so no protobuf package or external
+converter is needed, and the packed arrays are decoded with NumPy.
+
+Decoded elements are handed to CleanXML.shape_element through a small element
+class with the same interface as the lxml elements, so the shaped documents
+are the same as those of the equivalent .osm file. Blobs are independent, so
+PBFCleanXML decodes and shapes them in a process pool, in file order.
+"""
+
+import os
+import struct
+import time
+import zlib
+import multiprocessing as mp
+from collections import deque
+import numpy as np
+from project3 import CleanXML
+from instrument import clock
+
+
+# Protocol buffer wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Packed fields shorter than this many bytes are decoded without NumPy
+SHORT_PACKED_SIZE = 64
+
+# Features of the HeaderBlock that the reader supports
+SUPPORTED_FEATURES = ("OsmSchema-V0.6", "DenseNodes", "HistoricalInformation")
+
+# Only history files carry the visible flag, every element of any other file is visible
+DEFAULT_VISIBLE = "true"
+
+
+def read_varint(buf, pos):
+    """
+    Decode one varint
+    :param buf: Bytes
+    :param pos: Offset of the varint
+    :return: Tuple of (value, offset after the varint)
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def zigzag(value):
+    """
+    :param value: Unsigned varint holding a zigzag encoded sint
+    :return: The signed integer
+    """
+    return (value >> 1) ^ -(value & 1)
+
+
+def signed(value):
+    """
+    :param value: Unsigned varint holding a two's complement int64
+    :return: The signed integer
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def iter_fields(buf):
+    """
+    Iterate over the fields of a message
+    :param buf: Bytes of the message
+    :return: Generator of (field number, value), the value an int for varints and
+             fixed width fields, bytes for length delimited fields
+    """
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            value, pos = read_varint(buf, pos)
+        elif wire_type == LENGTH_DELIMITED:
+            size, pos = read_varint(buf, pos)
+            value = buf[pos:pos + size]
+            pos += size
+        elif wire_type == FIXED64:
+            value = struct.unpack_from("<Q", buf, pos)[0]
+            pos += 8
+        elif wire_type == FIXED32:
+            value = struct.unpack_from("<I", buf, pos)[0]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protocol buffer wire type {0}".format(wire_type))
+        yield field, value
+
+
+def decode_packed(buf, zigzag_coded=False, delta=False):
+    """
+    Decode a packed repeated varint field into an array
+    :param buf: Bytes of the packed field
+    :param zigzag_coded: True for sint32/sint64 fields
+    :param delta: True to undo delta coding
+    :return: List of int
+    """
+    if len(buf) < SHORT_PACKED_SIZE:
+        return decode_packed_short(buf, zigzag_coded, delta)
+
+    data = np.frombuffer(buf, dtype=np.uint8)
+
+    # Each varint ends on a byte below 0x80, its bytes hold 7 bits each, least significant first
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    payload = (data & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    values = np.add.reduceat(payload, starts)
+
+    if zigzag_coded:
+        values = (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+    else:
+        values = values.astype(np.int64)
+    if delta:
+        values = np.cumsum(values)
+
+    return values.tolist()
+
+
+def decode_packed_short(buf, zigzag_coded=False, delta=False):
+    """
+    decode_packed for short fields, such as the tags and node references of a
+    way, where the NumPy call overhead costs more than a Python loop
+    :return: List of int
+    """
+    values = []
+    pos = 0
+    end = len(buf)
+    total = 0
+    while pos < end:
+        value, pos = read_varint(buf, pos)
+        if zigzag_coded:
+            value = (value >> 1) ^ -(value & 1)
+        if delta:
+            total += value
+            value = total
+        values.append(value)
+
+    return values
+
+
+def nanodegrees_to_str(nano):
+    """
+    :param nano: Integer coordinate in nanodegrees
+    :return: Decimal string of the coordinate in degrees, which parses to the same float as the XML value
+    """
+    sign = "-" if nano < 0 else ""
+    nano = abs(nano)
+    return "{0}{1}.{2:09d}".format(sign, nano // 1000000000, nano % 1000000000)
+
+
+def timestamp_to_str(milliseconds):
+    """
+    :param milliseconds: Milliseconds since the epoch
+    :return: Timestamp in the XML format, eg. "2012-03-28T18:31:23Z"
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(milliseconds // 1000))
+
+
+class PBFTag(object):
+    """Stand-in for a <tag> or <nd> child element"""
+
+    __slots__ = ("attrib",)
+
+    def __init__(self, attrib):
+        self.attrib = attrib
+
+
+class PBFElement(object):
+    """Stand-in for a top level lxml element, with the parts of the lxml
+    interface used by CleanXML.shape_element
+    """
+
+    __slots__ = ("tag", "attrib", "tags", "refs")
+
+    def __init__(self, tag, attrib, tags=(), refs=()):
+        """
+        :param tag: "bounds", "node" or "way"
+        :param attrib: Dictionary of string attributes, as in the XML
+        :param tags: List of (key, value) strings
+        :param refs: List of node ids of a way
+        """
+        self.tag = tag
+        self.attrib = attrib
+        self.tags = tags
+        self.refs = refs
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def findall(self, tag):
+        return list(self.iter(tag))
+
+    def iter(self, tag):
+        if tag == "tag":
+            for k, v in self.tags:
+                yield PBFTag({"k": k, "v": v})
+        elif tag == "nd":
+            for ref in self.refs:
+                yield PBFTag({"ref": str(ref)})
+
+
+def iter_blobs(filename):
+    """
+    Find the blobs of a PBF file without decompressing them
+    :param filename: Input .osm.pbf filename
+    :return: Generator of (blob type, offset of the Blob, size of the Blob)
+    """
+    with open(filename, "rb") as fi:
+        while True:
+            prefix = fi.read(4)
+            if len(prefix) < 4:
+                return
+            header = fi.read(struct.unpack(">I", prefix)[0])
+            blob_type, size = None, 0
+            for field, value in iter_fields(header):
+                if field == 1:
+                    blob_type = bytes(value).decode("utf-8")
+                elif field == 3:
+                    size = value
+            offset = fi.tell()
+            fi.seek(size, os.SEEK_CUR)
+            yield blob_type, offset, size
+
+
+def read_blob(filename, offset, size):
+    """
+    Read and decompress one blob
+    :param filename: Input .osm.pbf filename
+    :param offset: Offset of the Blob
+    :param size: Size of the Blob
+    :return: Bytes of the HeaderBlock or PrimitiveBlock
+    """
+    with open(filename, "rb") as fi:
+        fi.seek(offset)
+        blob = fi.read(size)
+
+    for field, value in iter_fields(blob):
+        if field == 1:
+            return bytes(value)
+        if field == 3:
+            return zlib.decompress(value)
+        # lzma, obsolete bzip2, lz4 and zstd
+        if field in (4, 5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression (field {0})".format(field))
+
+    return b""
+
+
+def decode_header(data):
+    """
+    Decode a HeaderBlock into a bounds element
+    :param data: Bytes of the HeaderBlock
+    :return: PBFElement for the bounds, or None if the file has no bounding box
+    """
+    bounds = None
+    for field, value in iter_fields(data):
+        if field == 1:
+            bbox = dict((f, zigzag(v)) for f, v in iter_fields(value))
+            bounds = PBFElement("bounds", {"minlon": nanodegrees_to_str(bbox.get(1, 0)),
+                                           "maxlon": nanodegrees_to_str(bbox.get(2, 0)),
+                                           "maxlat": nanodegrees_to_str(bbox.get(3, 0)),
+                                           "minlat": nanodegrees_to_str(bbox.get(4, 0))})
+        elif field == 4:
+            feature = bytes(value).decode("utf-8")
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError("Unsupported PBF feature {0}".format(feature))
+
+    return bounds
+
+
+class PrimitiveBlockDecoder(object):
+    """Decodes the elements of one PrimitiveBlock"""
+
+    def __init__(self, data):
+        """
+        Read the string table and the coordinate and date scales of the block
+        :param data: Bytes of the PrimitiveBlock
+        :return: None
+        """
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, value in iter_fields(data):
+            if field == 1:
+                self.strings = [bytes(s).decode("utf-8") for f, s in iter_fields(value) if f == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 18:
+                self.date_granularity = value
+            elif field == 19:
+                self.lat_offset = signed(value)
+            elif field == 20:
+                self.lon_offset = signed(value)
+
+    def coordinates(self, lat, lon):
+        """
+        :return: Tuple of the lat and lon attribute strings of raw coordinates
+        """
+        return (nanodegrees_to_str(self.lat_offset + self.granularity * int(lat)),
+                nanodegrees_to_str(self.lon_offset + self.granularity * int(lon)))
+
+    def info(self, buf):
+        """
+        Decode the Info of a node or way into XML attributes
+        :param buf: Bytes of the Info message
+        :return: Dictionary of attribute strings
+        """
+        attrib = {}
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib["version"] = str(value)
+            elif field == 2:
+                attrib["timestamp"] = timestamp_to_str(signed(value) * self.date_granularity)
+            elif field == 3:
+                attrib["changeset"] = str(signed(value))
+            elif field == 4:
+                attrib["uid"] = str(signed(value))
+            elif field == 5:
+                attrib["user"] = self.strings[value]
+            elif field == 6:
+                attrib["visible"] = "true" if value else "false"
+
+        return attrib
+
+    def tags(self, keys, vals):
+        """
+        :return: List of (key, value) strings from string table indexes
+        """
+        strings = self.strings
+        return [(strings[k], strings[v]) for k, v in zip(keys, vals)]
+
+    def node(self, buf):
+        """
+        Decode a (non dense) Node
+        :return: PBFElement
+        """
+        attrib = {"visible": DEFAULT_VISIBLE}
+        keys = vals = ()
+        lat = lon = 0
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib["id"] = str(zigzag(value))
+            elif field == 2:
+                keys = decode_packed(value)
+            elif field == 3:
+                vals = decode_packed(value)
+            elif field == 4:
+                attrib.update(self.info(value))
+            elif field == 8:
+                lat = zigzag(value)
+            elif field == 9:
+                lon = zigzag(value)
+        attrib["lat"], attrib["lon"] = self.coordinates(lat, lon)
+
+        return PBFElement("node", attrib, self.tags(keys, vals))
+
+    def dense_nodes(self, buf):
+        """
+        Decode a DenseNodes message
+        :return: List of PBFElement
+        """
+        ids = lat = lon = keys_vals = None
+        info = {}
+        for field, value in iter_fields(buf):
+            if field == 1:
+                ids = decode_packed(value, zigzag_coded=True, delta=True)
+            elif field == 5:
+                info = self.dense_info(value)
+            elif field == 8:
+                lat = decode_packed(value, zigzag_coded=True, delta=True)
+            elif field == 9:
+                lon = decode_packed(value, zigzag_coded=True, delta=True)
+            elif field == 10:
+                keys_vals = decode_packed(value)
+        if ids is None:
+            return []
+
+        lat_offset, lon_offset, granularity = self.lat_offset, self.lon_offset, self.granularity
+
+        # Tags of all the nodes in one list, each node's (key, value) pairs end with a 0
+        tag_lists = [()] * len(ids)
+        if keys_vals:
+            strings = self.strings
+            tag_lists = []
+            tags = []
+            values = iter(keys_vals)
+            for k in values:
+                if k == 0:
+                    tag_lists.append(tags)
+                    tags = []
+                else:
+                    tags.append((strings[k], strings[next(values)]))
+
+        nodes = []
+        for i, node_id in enumerate(ids):
+            attrib = {"id": str(node_id), "visible": DEFAULT_VISIBLE}
+            for name, column in info.items():
+                attrib[name] = column[i]
+            attrib["lat"] = nanodegrees_to_str(lat_offset + granularity * lat[i])
+            attrib["lon"] = nanodegrees_to_str(lon_offset + granularity * lon[i])
+            nodes.append(PBFElement("node", attrib, tag_lists[i]))
+
+        return nodes
+
+    def dense_info(self, buf):
+        """
+        Decode a DenseInfo message into attribute string columns
+        :return: Dictionary of attribute name to list of strings
+        """
+        info = {}
+        for field, value in iter_fields(buf):
+            if field == 1:
+                info["version"] = [str(v) for v in decode_packed(value)]
+            elif field == 2:
+                info["timestamp"] = [timestamp_to_str(int(t) * self.date_granularity)
+                                     for t in decode_packed(value, zigzag_coded=True, delta=True)]
+            elif field == 3:
+                info["changeset"] = [str(v) for v in decode_packed(value, zigzag_coded=True, delta=True)]
+            elif field == 4:
+                info["uid"] = [str(v) for v in decode_packed(value, zigzag_coded=True, delta=True)]
+            elif field == 5:
+                info["user"] = [self.strings[v] for v in decode_packed(value, zigzag_coded=True, delta=True)]
+            elif field == 6:
+                info["visible"] = ["true" if v else "false" for v in decode_packed(value)]
+
+        return info
+
+    def way(self, buf):
+        """
+        Decode a Way
+        :return: PBFElement
+        """
+        attrib = {"visible": DEFAULT_VISIBLE}
+        keys = vals = refs = ()
+        for field, value in iter_fields(buf):
+            if field == 1:
+                attrib["id"] = str(value)
+            elif field == 2:
+                keys = decode_packed(value)
+            elif field == 3:
+                vals = decode_packed(value)
+            elif field == 4:
+                attrib.update(self.info(value))
+            elif field == 8:
+                refs = decode_packed(value, zigzag_coded=True, delta=True)
+
+        return PBFElement("way", attrib, self.tags(keys, vals), refs)
+
+    def elements(self):
+        """
+        Decode the nodes and ways of the block in their stored order. Relations
+        are skipped, shape_element does not keep them.
+        :return: Generator of PBFElement
+        """
+        for group in self.groups:
+            for field, value in iter_fields(group):
+                if field == 1:
+                    yield self.node(value)
+                elif field == 2:
+                    for node in self.dense_nodes(value):
+                        yield node
+                elif field == 3:
+                    yield self.way(value)
+
+
+def shape_blob(args):
+    """
+    Worker that decodes and shapes one blob
+    :param args: Tuple of (filename, offset, size, intern_strings)
+    :return: Tuple of (shaped documents, number of tags of each, num_streets_total, num_streets_corrected, extent)
+    """
+    filename, offset, size, intern_strings = args
+    # Interning in the worker lets pickle send each repeated value of the blob once
+    cleaner = CleanXML(filename, intern_strings=intern_strings)
+    docs = []
+    num_tags = []
+    for element in PrimitiveBlockDecoder(read_blob(filename, offset, size)).elements():
+        docs.append(cleaner.shape_element(element))
+        num_tags.append(len(element.tags))
+
+    return docs, num_tags, dict(cleaner.num_streets_total), dict(cleaner.num_streets_corrected), cleaner.extent
+
+
+class PBFCleanXML(CleanXML):
+    """CleanXML over a .osm.pbf file. process_map, stream_map and
+    load_into_mongo produce the same documents as for the equivalent .osm file.
+    """
+
+    def __init__(self, filename, processes=None, instrument=None, intern_strings=None):
+        """
+        Initialize the object
+        :param filename: The input .osm.pbf filename
+        :param processes: Number of processes decoding blobs, defaults to the number of cores.
+                          1 decodes in this process.
+        :param instrument: Optional instrument.Instrumentation to record the decode and shape times. With
+                           several processes both happen in the workers and are recorded as decode.
+        :param intern_strings: True to share repeated low cardinality values (see interning.StringInterner),
+                               None only when process_map keeps the documents in a list
+        :return: None
+        """
+        super(PBFCleanXML, self).__init__(filename, instrument, intern_strings)
+        self.processes = processes or mp.cpu_count()
+
+    def intern_document(self, doc):
+        """
+        Replace the values of a document shaped in a worker with their canonical
+        copies, using the same fields as shape_element
+        :param doc: Shaped dictionary
+        :return: The document
+        """
+        interner = self.interner
+        for key, value in doc.items():
+            if key == "created" or key == "address":
+                for field, v in value.items():
+                    value[field] = interner.value(field, v)
+            elif isinstance(value, str) and key != "id" and key != "type":
+                doc[key] = interner.value(key, value)
+
+        return doc
+
+    def iter_elements(self):
+        """
+        Generator over the shaped documents of the input file, in file order
+        :return: Generator of shaped dictionaries
+        """
+        instrument = self.instrument
+        if instrument is not None:
+            instrument.start(self.filename)
+
+        tasks = deque()
+        for blob_type, offset, size in iter_blobs(self.filename):
+            if blob_type == "OSMHeader":
+                bounds = decode_header(read_blob(self.filename, offset, size))
+                if bounds is not None:
+                    if instrument is not None:
+                        instrument.element(0)
+                    yield self.shape_element(bounds)
+            elif blob_type == "OSMData":
+                tasks.append((self.filename, offset, size, self.interner is not None))
+
+        if self.processes == 1:
+            for doc in self.iter_blobs_serial(tasks):
+                yield doc
+        else:
+            for doc in self.iter_blobs_parallel(tasks):
+                yield doc
+
+        if instrument is not None:
+            instrument.stop()
+
+    def iter_blobs_serial(self, tasks):
+        """
+        Decode and shape the blobs in this process
+        :param tasks: Deque of shape_blob arguments
+        :return: Generator of shaped dictionaries
+        """
+        instrument = self.instrument
+        for filename, offset, size, _ in tasks:
+            elements = PrimitiveBlockDecoder(read_blob(filename, offset, size)).elements()
+            if instrument is None:
+                for element in elements:
+                    yield self.shape_element(element)
+                continue
+
+            # As in CleanXML.iter_elements_instrumented, street fixing is not included in the shape time
+            last = clock()
+            for element in elements:
+                decoded = clock()
+                instrument.add("decode", decoded - last)
+                street = instrument.stages.get("street", 0.0)
+                el = self.shape_element(element)
+                instrument.add("shape", clock() - decoded - (instrument.stages.get("street", 0.0) - street))
+                instrument.element(len(element.tags))
+                yield el
+                last = clock()
+            instrument.bytes_read = offset + size
+
+    def iter_blobs_parallel(self, tasks):
+        """
+        Decode and shape the blobs in a process pool
+        :param tasks: Deque of shape_blob arguments
+        :return: Generator of shaped dictionaries, in file order
+        """
+        instrument = self.instrument
+        # Keep a bounded number of blobs in flight so that memory does not grow with the file
+        pool = mp.Pool(self.processes)
+        pending = deque()
+        try:
+            while tasks or pending:
+                while tasks and len(pending) < 2 * self.processes:
+                    task = tasks.popleft()
+                    pending.append((task, pool.apply_async(shape_blob, (task,))))
+                task, result = pending.popleft()
+                start = clock()
+                docs, num_tags, streets_total, streets_corrected, extent = result.get()
+                if instrument is not None:
+                    instrument.add("decode", clock() - start)
+                    instrument.bytes_read = task[1] + task[2]
+                for street, count in streets_total.items():
+                    self.num_streets_total[street] += count
+                for street, count in streets_corrected.items():
+                    self.num_streets_corrected[street] += count
+                self.merge_extent(extent)
+                # The workers share values within a blob, the interner of this process shares them between blobs
+                for doc, tags in zip(docs, num_tags):
+                    if self.interner is not None:
+                        doc = self.intern_document(doc)
+                    if instrument is not None:
+                        instrument.element(tags)
+                    yield doc
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+def encode_varint(value):
+    """
+    :param value: Non negative integer
+    :return: Bytes of the varint
+    """
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_field(field, value):
+    """
+    :param field: Field number
+    :param value: Non negative int for a varint, bytes for a length delimited field
+    :return: Bytes of the field
+    """
+    if isinstance(value, bytes):
+        return encode_varint(field << 3 | LENGTH_DELIMITED) + encode_varint(len(value)) + value
+
+    return encode_varint(field << 3 | VARINT) + encode_varint(value)
+
+
+def encode_packed(field, values, zigzag_coded=False, delta=False):
+    """
+    :return: Bytes of a packed repeated varint field
+    """
+    previous = 0
+    out = []
+    for value in values:
+        value, previous = (value - previous, value) if delta else (value, previous)
+        out.append(encode_varint((value << 1) ^ (value >> 63) if zigzag_coded else value))
+
+    return encode_field(field, b"".join(out))
+
+
+def write_pbf(osm_file, pbf_file, block_size=8000):
+    """
+    Convert an .osm file to .osm.pbf, writing the nodes as dense nodes and the ways
+    and relations with their tags and metadata. Intended for building test fixtures.
+    :param osm_file: Input .osm filename
+    :param pbf_file: Output .osm.pbf filename
+    :param block_size: Maximum number of elements per PrimitiveBlock
+    :return: None
+    """
+    import calendar
+    import itertools
+    from lxml import etree
+
+    def write_blob(fo, blob_type, data):
+        blob = encode_field(2, len(data)) + encode_field(3, zlib.compress(data))
+        header = encode_field(1, blob_type.encode("utf-8")) + encode_field(3, len(blob))
+        fo.write(struct.pack(">I", len(header)) + header + blob)
+
+    def nano(value):
+        return int(round(float(value) * 1e9))
+
+    def seconds(timestamp):
+        return calendar.timegm(time.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+
+    def write_block(fo, elements):
+        strings = {"": 0}
+
+        def sid(s):
+            return strings.setdefault(s, len(strings))
+
+        # (field, attribute, conversion, delta and zigzag coded in DenseInfo) of the metadata
+        info_fields = ((1, "version", int, False), (2, "timestamp", seconds, True), (3, "changeset", int, True),
+                       (4, "uid", int, True), (5, "user", sid, True))
+
+        def dense_group(nodes):
+            keys_vals = []
+            for node in nodes:
+                for k, v in node["tags"]:
+                    keys_vals += [sid(k), sid(v)]
+                keys_vals.append(0)
+            a = [node["attrib"] for node in nodes]
+            # Metadata columns are only written when every node has them
+            dense_info = b"".join(encode_packed(field, [convert(x[name]) for x in a], coded, coded)
+                                  for field, name, convert, coded in info_fields
+                                  if all(name in x for x in a))
+            dense = (encode_packed(1, [int(x["id"]) for x in a], True, True) + encode_field(5, dense_info) +
+                     encode_packed(8, [nano(x["lat"]) // 100 for x in a], True, True) +
+                     encode_packed(9, [nano(x["lon"]) // 100 for x in a], True, True) +
+                     encode_packed(10, keys_vals))
+            return encode_field(2, dense)
+
+        def group(element):
+            x = element["attrib"]
+            info = b"".join(encode_field(field, convert(x[name]))
+                            for field, name, convert, _ in info_fields if name in x)
+            message = (encode_field(1, int(x["id"])) + encode_packed(2, [sid(k) for k, v in element["tags"]]) +
+                       encode_packed(3, [sid(v) for k, v in element["tags"]]) + encode_field(4, info))
+            if element["tag"] == "way":
+                return encode_field(3, message + encode_packed(8, element["refs"], True, True))
+            return encode_field(4, message)
+
+        # A group holds one kind of element, a new one starts whenever the kind changes
+        groups = []
+        for tag, run in itertools.groupby(elements, key=lambda e: e["tag"]):
+            run = list(run)
+            groups.append(dense_group(run) if tag == "node" else b"".join(group(e) for e in run))
+
+        table = b"".join(encode_field(1, s.encode("utf-8")) for s in sorted(strings, key=strings.get))
+        write_blob(fo, "OSMData", encode_field(1, table) + b"".join(encode_field(2, g) for g in groups))
+
+    with open(pbf_file, "wb") as fo:
+        elements = []
+        header = encode_field(4, b"OsmSchema-V0.6") + encode_field(4, b"DenseNodes")
+        for _, element in etree.iterparse(osm_file, events=("end",), tag=("bounds", "node", "way", "relation")):
+            if element.tag == "bounds":
+                a = element.attrib
+                bbox = b"".join(encode_field(f, (nano(a[k]) << 1) ^ (nano(a[k]) >> 63))
+                                for f, k in ((1, "minlon"), (2, "maxlon"), (3, "maxlat"), (4, "minlat")))
+                header = encode_field(1, bbox) + header
+            else:
+                elements.append({"tag": element.tag, "attrib": dict(element.attrib),
+                                 "tags": [(t.attrib["k"], t.attrib["v"]) for t in element.iter("tag")],
+                                 "refs": [int(nd.attrib["ref"]) for nd in element.iter("nd")]})
+            element.clear()
+        write_blob(fo, "OSMHeader", header)
+        for start in range(0, len(elements), block_size):
+            write_block(fo, elements[start:start + block_size])
+
+    return
+
+
+def test():
+    from instrument import Instrumentation
+    from fixtures import example_copy
+
+    # The NumPy and the short field decoders agree
+    values = [0, 1, 300, 2 ** 40, -5, -(2 ** 40)] * 20
+    for size in (6, len(values)):
+        packed = b"".join(encode_varint(v) for v in values[:size] if v >= 0)
+        assert decode_packed(packed) == [v for v in values[:size] if v >= 0]
+        _, packed = next(iter_fields(encode_packed(1, values[:size], True, True)))
+        assert decode_packed(packed, True, True) == values[:size]
+    assert float(nanodegrees_to_str(-87686630300)) == -87.6866303
+
+    with example_copy() as osm_file:
+        serial = CleanXML(osm_file)
+        data = serial.process_map()
+        # PBF cannot leave out the visible flag, elements without one in the XML are visible
+        missing_visible = [doc for doc in data if doc.get("type") != "bounds" and doc["visible"] is None]
+        assert len(missing_visible) == 1
+        for doc in missing_visible:
+            doc["visible"] = DEFAULT_VISIBLE
+
+        pbf_file = osm_file + ".pbf"
+        block_size = 7
+        write_pbf(osm_file, pbf_file, block_size=block_size)
+        assert sum(1 for blob_type, _, _ in iter_blobs(pbf_file) if blob_type == "OSMData") > 2
+        for processes in (1, 2):
+            instrument = Instrumentation()
+            cleaner = PBFCleanXML(pbf_file, processes=processes, instrument=instrument)
+            pbf_data = cleaner.process_map()
+            assert pbf_data == data
+            assert cleaner.num_streets_corrected == serial.num_streets_corrected
+            assert cleaner.extent == serial.extent
+            assert instrument.elements == len(data) and instrument.bytes_read == os.path.getsize(pbf_file)
+            assert "decode" in instrument.stages
+            # Values are shared between the documents of different blobs
+            users = [doc["created"]["user"] for doc in pbf_data if doc.get("created", {}).get("user") == "bbmiller"]
+            assert len(users) > block_size and all(user is users[0] for user in users)
+            streaming = PBFCleanXML(pbf_file, processes=processes, intern_strings=False)
+            assert list(streaming.process_map()) == data and streaming.interner is None
+        assert os.path.exists(pbf_file + ".json")
+
+        # Blobs with an unsupported compression are rejected rather than read as empty
+        blob_file = osm_file + ".blob"
+        for field in (4, 5, 6, 7):
+            with open(blob_file, "wb") as fo:
+                fo.write(encode_field(2, 3) + encode_field(field, b"abc"))
+            try:
+                read_blob(blob_file, 0, os.path.getsize(blob_file))
+                assert False
+            except ValueError:
+                pass
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""Overlapped parsing and inserting of shaped documents.
+
+MongoLoader.load alternates between shaping a batch of documents and waiting
+for insert_many to return. PipelinedLoader shapes in the calling thread and
+hands full batches through a bounded queue to a pool of insert threads, so
+the parser keeps working while earlier batches are in flight. pymongo
+releases the GIL while it waits on the server, so the inserts overlap with
+the parsing even though the parsing itself holds the GIL. The queue size
+bounds the number of batches held in memory: when the inserts fall behind the
+parser blocks on the full queue (backpressure) instead of buffering the
+whole extract.
+"""
+
+import sys
+import time
+import threading
+from queue import Queue
+from bson import BSON
+from loader import MongoLoader
+
+
+class PipelinedLoader(object):
+    """Batched loader with the inserts done by worker threads. Has the same
+    load/print_stats interface as loader.MongoLoader.
+    """
+
+    def __init__(self, collection, batch_size=1000, ordered=False, write_concern=None, workers=2, queue_size=4):
+        """
+        Initialize the loader
+        :param collection: pymongo (or mongomock) collection to insert into
+        :param batch_size: Number of documents sent per insert_many call
+        :param ordered: True to stop each batch at the first failed insert
+        :param write_concern: Dictionary of write concern options, eg. {"w": 1, "j": False}
+        :param workers: Number of insert threads
+        :param queue_size: Maximum number of batches waiting for an insert thread
+        :return: None
+        """
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        # One MongoLoader per thread, so the statistics need no locking
+        self.loaders = [MongoLoader(collection, batch_size, ordered, write_concern) for _ in range(workers)]
+
+        # Statistics
+        self.num_parsed = 0
+        self.seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.idle_seconds = [0.0] * workers
+
+    def insert_worker(self, i, queue, errors):
+        """
+        Insert the batches of the queue until the None sentinel. After an
+        error the remaining batches are drained so the parser never blocks.
+        :param i: Index of the worker
+        :param queue: Queue of batches
+        :param errors: List the exception of a failed insert is appended to
+        :return: None
+        """
+        loader = self.loaders[i]
+        while True:
+            start = time.time()
+            batch = queue.get()
+            self.idle_seconds[i] += time.time() - start
+            if batch is None:
+                return
+            if errors:
+                continue
+            try:
+                start = time.time()
+                loader.insert_batch(batch)
+                loader.seconds += time.time() - start
+            except Exception:
+                errors.append(sys.exc_info()[1])
+
+    def load(self, documents):
+        """
+        Insert all documents in batches, overlapping the inserts with the
+        iteration over documents
+        :param documents: Iterable of dictionaries, eg. the output of CleanXML.iter_elements
+        :return: Number of documents inserted
+        """
+        queue = Queue(self.queue_size)
+        errors = []
+        threads = [threading.Thread(target=self.insert_worker, args=(i, queue, errors))
+                   for i in range(len(self.loaders))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        def put(item):
+            start = time.time()
+            queue.put(item)
+            self.blocked_seconds += time.time() - start
+
+        start = time.time()
+        try:
+            batch = []
+            for doc in documents:
+                batch.append(doc)
+                if len(batch) >= self.batch_size:
+                    self.num_parsed += len(batch)
+                    put(batch)
+                    batch = []
+                    if errors:
+                        break
+            if batch and not errors:
+                self.num_parsed += len(batch)
+                put(batch)
+        finally:
+            for _ in threads:
+                put(None)
+            for thread in threads:
+                thread.join()
+            self.seconds += time.time() - start
+
+        if errors:
+            raise errors[0]
+
+        return self.num_inserted
+
+    @property
+    def num_inserted(self):
+        return sum(loader.num_inserted for loader in self.loaders)
+
+    @property
+    def num_failed(self):
+        return sum(loader.num_failed for loader in self.loaders)
+
+    @property
+    def num_batches(self):
+        return sum(loader.num_batches for loader in self.loaders)
+
+    @property
+    def write_errors(self):
+        return [error for loader in self.loaders for error in loader.write_errors]
+
+    def docs_per_sec(self):
+        """
+        End to end rate, from the first document parsed to the last one inserted
+        :return: Documents per second
+        """
+        return self.num_inserted / (self.seconds + 1e-7)
+
+    def print_stats(self):
+        """
+        Print the results of the load
+        :return: None
+        """
+        print("Number of documents inserted: {0}".format(self.num_inserted))
+        print("Number of documents failed: {0}".format(self.num_failed))
+        print("Number of batches: {0}, {1} insert threads, queue of {2}".format(
+            self.num_batches, len(self.loaders), self.queue_size))
+        print("Load time: {0:.2f} (s), {1:.0f} docs/sec end to end".format(self.seconds, self.docs_per_sec()))
+        print("Parser blocked on a full queue: {0:.2f} (s)".format(self.blocked_seconds))
+        print("Insert time per thread: {0} (s), idle: {1} (s)".format(
+            ", ".join("{0:.2f}".format(loader.seconds) for loader in self.loaders),
+            ", ".join("{0:.2f}".format(idle) for idle in self.idle_seconds)))
+
+        return
+
+
+class DelayedCollection(object):
+    """Collection wrapper that waits before each insert_many, standing in for
+    the time a MongoDB server takes to apply the inserts. Without a collection
+    the documents are only BSON encoded, the work pymongo does in the client,
+    and dropped.
+    """
+
+    def __init__(self, collection, seconds_per_doc):
+        self.collection = collection
+        self.seconds_per_doc = seconds_per_doc
+        self.lock = threading.Lock()
+
+    def insert_many(self, docs, ordered=True):
+        if self.collection is None:
+            for doc in docs:
+                BSON.encode(doc)
+        time.sleep(self.seconds_per_doc * len(docs))
+        if self.collection is not None:
+            with self.lock:
+                return self.collection.insert_many(docs, ordered=ordered)
+
+
+def benchmark(filename, seconds_per_doc=20e-6, batch_size=1000, workers=2, queue_size=4):
+    """
+    Compare the serial and the pipelined load of an extract into a simulated server
+    :param filename: Input OSM filename
+    :param seconds_per_doc: Simulated insert time per document
+    :param batch_size: Number of documents per insert_many call
+    :param workers: Number of insert threads of the pipelined load
+    :param queue_size: Maximum number of batches waiting for an insert thread
+    :return: None
+    """
+    from project3 import CleanXML
+
+    for name, make_loader in (
+            ("serial", lambda collection: MongoLoader(collection, batch_size)),
+            ("pipelined", lambda collection: PipelinedLoader(collection, batch_size, workers=workers,
+                                                             queue_size=queue_size))):
+        collection = DelayedCollection(None, seconds_per_doc)
+        loader = make_loader(collection)
+        start = time.time()
+        loader.load(CleanXML(filename).iter_elements())
+        seconds = time.time() - start
+        print("{0:10s} {1} docs in {2:.2f} s, {3:.0f} docs/sec".format(
+            name, loader.num_inserted, seconds, loader.num_inserted / seconds))
+
+    return
+
+
+def test():
+    import mongomock
+    from pymongo.errors import PyMongoError
+    from project3 import CleanXML
+
+    docs = list(CleanXML("example5.osm").iter_elements())
+    collection = mongomock.MongoClient()["test"]["test"]
+    loader = PipelinedLoader(DelayedCollection(collection, 1e-3), batch_size=3, workers=3, queue_size=1)
+    assert loader.load(iter(docs)) == len(docs) == 26
+    loader.print_stats()
+    assert loader.num_batches == 9 and loader.num_parsed == 26 and loader.num_failed == 0
+    assert collection.count_documents({"type": "node"}) == 23
+    assert collection.find_one({"id": "261114295"})["pos"] == [41.9730791, -87.6866303]
+
+    # Duplicate keys are counted per thread as in MongoLoader
+    loader = PipelinedLoader(collection, batch_size=2)
+    loader.load([{"_id": 1}, {"_id": 1}, {"_id": 2}])
+    assert loader.num_inserted == 2 and loader.num_failed == 1
+
+    # An insert error stops the load instead of blocking the parser
+    class FailingCollection(object):
+        def insert_many(self, docs, ordered=True):
+            raise PyMongoError("server went away")
+    loader = PipelinedLoader(FailingCollection(), batch_size=1, queue_size=1)
+    try:
+        loader.load(iter(docs))
+        assert False
+    except PyMongoError:
+        assert loader.num_parsed < len(docs)
+
+    # The direct load can use the pipeline
+    client = mongomock.MongoClient()
+    loader = CleanXML("example5.osm").load_into_mongo("test", "pipelined", batch_size=5, client=client, workers=2)
+    assert type(loader).__name__ == "PipelinedLoader"
+    assert client["test"]["pipelined"].count_documents({}) == 26
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(sys.argv[2])
+    else:
+        test()
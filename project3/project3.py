@@ -15,11 +15,18 @@ import re
 from collections import defaultdict
 from pprint import pprint
 from lxml import etree
-import codecs
-import json
-import subprocess as sp
-from pymongo import MongoClient
-from geopy.distance import vincenty
+from pymongo import MongoClient, UpdateMany
+from loader import MongoLoader
+from pipeline import PipelinedLoader
+from streets import StreetNormalizer
+from serializers import get_serializer
+from geometry import WayGeometry
+from geodesic import vincenty_km
+from instrument import clock
+from compressed import open_osm, is_compressed, uncompressed_name
+from tagkeys import KEY_CLASSIFIER, FIELD, ADDRESS, STREET
+from interning import StringInterner
+from sketches import HeavyHitters
 
 
 class AuditXML(object):
@@ -30,13 +37,15 @@ class AuditXML(object):
     mostly be used in finding issues that need to be fixed.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, instrument=None):
         """
         Pass in the filename to work on to initialize the object
-        :param filename: Input filename
+        :param filename: Input filename, .osm.bz2 and .osm.gz are decompressed on the fly
+        :param instrument: Optional instrument.Instrumentation to record the parse and audit times
         :return: None
         """
         self.osmfile = filename
+        self.instrument = instrument
         self.street_type_re = re.compile(r'\b(\S+\.?)$', re.IGNORECASE)
         self.street_pre_re = re.compile(r'^([SENW]\.?)\s+', re.IGNORECASE)
         self.suite_re = re.compile(r'\b(ste\.?)\s\d+$', re.IGNORECASE)
@@ -60,7 +69,8 @@ class AuditXML(object):
     def find_religion(element, no_religion):
         """
         Test if element has a name or not
-        :param no_religion: List of node id's that are places of worship without religion
+        :param no_religion: List of node id's that are places of worship without religion, or
+                            sketches.HeavyHitters counting them by element type in fixed memory
         :param element: node level
         :return: True if has name, False if not
         """
@@ -78,8 +88,11 @@ class AuditXML(object):
                 has_religion = True
 
         if is_place_of_worship and not has_religion:
-            print("No religion for place_of_worship {0} with id {1}".format(element.tag, element.attrib["id"]))
-            no_religion.append(element.attrib["id"])
+            if isinstance(no_religion, HeavyHitters):
+                no_religion.add(element.tag, element.attrib["id"])
+            else:
+                print("No religion for place_of_worship {0} with id {1}".format(element.tag, element.attrib["id"]))
+                no_religion.append(element.attrib["id"])
 
         return
 
@@ -88,21 +101,25 @@ class AuditXML(object):
         """
         Find the tags that have fixme as a key
         :param elem: Input element (node or way)
-        :param fixme: List containing node ID's that have FIXMEs
+        :param fixme: List containing node ID's that have FIXMEs, or sketches.HeavyHitters counting
+                      them by element type in fixed memory
         :return: None
         """
         for tag in elem.findall("tag"):
             if tag.attrib["k"].lower() == "fixme":
-                print("FIXME in {0} with id {1}".format(elem.tag, elem.attrib["id"]))
-                fixme.append(elem.attrib["id"])
+                if isinstance(fixme, HeavyHitters):
+                    fixme.add(elem.tag, elem.attrib["id"])
+                else:
+                    print("FIXME in {0} with id {1}".format(elem.tag, elem.attrib["id"]))
+                    fixme.append(elem.attrib["id"])
 
         return
 
     def audit_street_type(self, street_types, street_prefixes, street_suites, street_name):
         """
-        :param street_types: Dictionary of street type by suffix (eg. Rd)
-        :param street_prefixes: Dictionary of street type by prefix (eg. N)
-        :param street_suites: Dictionary of street names that correspond to suites
+        :param street_types: Dictionary of street type by suffix (eg. Rd), or sketches.HeavyHitters
+        :param street_prefixes: Dictionary of street type by prefix (eg. N), or sketches.HeavyHitters
+        :param street_suites: Dictionary of street names that correspond to suites, or sketches.HeavyHitters
         :param street_name: The name of the street
         :return: None
         """
@@ -112,7 +129,7 @@ class AuditXML(object):
             Find the match for the regular expression and add to dictionary
             :param regex: Input regular expression
             :param name: String to search
-            :param outdict: Output dictionary
+            :param outdict: Output dictionary of sets, or sketches.HeavyHitters to count it approximately
             :param street_type: True for street type (St, Rd, etc.), false for other data types
             :return: None
             """
@@ -120,44 +137,104 @@ class AuditXML(object):
             if re_results:
                 re_result = re_results.groups()[0]
                 if not street_type or re_result not in self.expected:
-                    outdict[re_result].add(name)
+                    if isinstance(outdict, HeavyHitters):
+                        outdict.add(re_result, name)
+                    else:
+                        outdict[re_result].add(name)
 
         find_match(self.street_type_re, street_name, street_types, True)
         find_match(self.street_pre_re, street_name, street_prefixes, False)
         find_match(self.suite_re, street_name, street_suites, False)
 
-        if re.search(r'[.]', street_name):
+        # The approximate audit only reports the street types, not every street name
+        if re.search(r'[.]', street_name) and not isinstance(street_types, HeavyHitters):
             print("Before: {0}\nAfter: {1}".format(street_name, re.sub(r'[.]', '', street_name)))
 
-    def audit(self):
+    def audit_element(self, elem, street_types, street_prefixes, street_suites, fixme, no_religion):
         """
-        Perform the auditing function
-        :return: street_types dictionary, street prefixes dictionary, street suites dictionary
+        Audit a single node or way element
+        :param elem: Node or way element
+        :param street_types: Dictionary of street type by suffix (eg. Rd)
+        :param street_prefixes: Dictionary of street type by prefix (eg. N)
+        :param street_suites: Dictionary of street names that correspond to suites
+        :param fixme: List containing node ID's that have FIXMEs, or sketches.HeavyHitters
+        :param no_religion: List of node id's that are places of worship without religion, or sketches.HeavyHitters
+        :return: None
         """
 
-        # Variables to populate
-        street_types = defaultdict(set)
-        street_prefixes = defaultdict(set)
-        street_suites = defaultdict(set)
-        fixme = []
-        no_religion = []
+        # Find fix_me
+        self.find_fixme(elem, fixme)
+
+        # Find and audit street names
+        for tag in elem.iter("tag"):
+            if self.is_street_name(tag):
+                self.audit_street_type(street_types, street_prefixes, street_suites, tag.attrib["v"])
 
-        osm_file = open(self.osmfile, "r")
+        # Find places of worship without religion
+        self.find_religion(elem, no_religion)
+
+        return
+
+    def audit_instrumented(self, osm_file, street_types, street_prefixes, street_suites, fixme, no_religion):
+        """
+        The audit loop, recording the time spent parsing and auditing in self.instrument
+        :param osm_file: Input file opened for binary reading
+        :return: None
+        """
+        instrument = self.instrument
+        # The size of a compressed file says nothing about how far the parse is
+        instrument.start(None if is_compressed(self.osmfile) else self.osmfile, osm_file)
+        last = clock()
         for event, elem in etree.iterparse(osm_file, events=("start",)):
+            now = clock()
+            instrument.add("parse", now - last)
+            last = now
             if elem.tag == "node" or elem.tag == "way":
+                self.audit_element(elem, street_types, street_prefixes, street_suites, fixme, no_religion)
+                last = clock()
+                instrument.add("audit", last - now)
+                instrument.element(len(elem.findall("tag")))
+        instrument.stop()
 
-                # Find fix_me
-                self.find_fixme(elem, fixme)
+        return
 
-                # Find and audit street names
-                for tag in elem.iter("tag"):
-                    if self.is_street_name(tag):
-                        self.audit_street_type(street_types, street_prefixes, street_suites, tag.attrib["v"])
+    def audit(self, approximate=False, top_k=20):
+        """
+        Perform the auditing function
+        :param approximate: True to count the street types in fixed memory with sketches.HeavyHitters
+                            instead of keeping every distinct street name, for very large extracts
+        :param top_k: Number of most frequent street types, prefixes and suites kept when approximate
+        :return: street_types dictionary, street prefixes dictionary, street suites dictionary, or
+                 three sketches.HeavyHitters when approximate
+        """
 
-                # Find places of worship without religion
-                self.find_religion(elem, no_religion)
+        # Variables to populate. The approximate audit counts the FIXMEs and places of worship
+        # without religion by element type, with a few example ids, instead of printing each one.
+        if approximate:
+            street_types = HeavyHitters(top_k)
+            street_prefixes = HeavyHitters(top_k)
+            street_suites = HeavyHitters(top_k)
+            fixme = HeavyHitters(top_k)
+            no_religion = HeavyHitters(top_k)
+        else:
+            street_types = defaultdict(set)
+            street_prefixes = defaultdict(set)
+            street_suites = defaultdict(set)
+            fixme = []
+            no_religion = []
+
+        osm_file = open_osm(self.osmfile)
+        if self.instrument is None:
+            for event, elem in etree.iterparse(osm_file, events=("start",)):
+                if elem.tag == "node" or elem.tag == "way":
+                    self.audit_element(elem, street_types, street_prefixes, street_suites, fixme, no_religion)
+        else:
+            self.audit_instrumented(osm_file, street_types, street_prefixes, street_suites, fixme, no_religion)
 
         osm_file.close()
+        if approximate:
+            fixme.print_report("Elements with FIXME")
+            no_religion.print_report("Places of worship without religion")
         return street_types, street_prefixes, street_suites
 
     def test(self):
@@ -178,19 +255,24 @@ class CleanXML(object):
     """This class performs the fixing of the data programatically before entering it into the MongoDB database
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, instrument=None, intern_strings=None):
         """
         Initialize the object
-        :param filename: The input .osm filename to process
+        :param filename: The input .osm filename to process, .osm.bz2 and .osm.gz are decompressed on the fly
+        :param instrument: Optional instrument.Instrumentation to record the time of each stage
+        :param intern_strings: True to share one copy of repeated low cardinality values between
+                               the shaped documents (see interning.StringInterner), False not to.
+                               None interns only when process_map keeps the documents in a list,
+                               streaming stays constant memory without the interner tables.
         :return: None
         """
 
         self.filename = filename
+        self.instrument = instrument
+        self.intern_strings = intern_strings
+        self.interner = StringInterner() if intern_strings else None
 
-        # Regular expressions
-        self.lower = re.compile(r'^([a-z]|_)*$')
-        self.lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-        self.problem_characters = re.compile(r'[=\+/&<>;\'"\?%#$@,\. \t\r\n]')
+        # Regular expressions, tag keys are classified by tagkeys.KEY_CLASSIFIER
         self.street_types_re = (
             (re.compile(r'\bCt\b', re.I), 'Court'),
             (re.compile(r'\b(?:[rR]d|Raod)\b', re.I), 'Road'),
@@ -209,12 +291,18 @@ class CleanXML(object):
             (re.compile(r'\bN\b', re.I), 'North'),
             (re.compile(r'\bW\b', re.I), 'West'),
         )
+        self.street_normalizer = StreetNormalizer(self.street_prefixes_re, self.street_types_re)
+        self.key_classifier = KEY_CLASSIFIER
 
         # Other variables
         self.created = ["version", "changeset", "timestamp", "user", "uid"]
+        self.top_level_tags = ("bounds", "node", "way", "relation")
         self.num_streets_corrected = defaultdict(int)
         self.num_streets_total = defaultdict(int)
 
+        # Measured [min_lat, max_lat, min_lon, max_lon] of the shaped elements, None until a position is seen
+        self.extent = None
+
     @staticmethod
     def get_lat_lon(element):
         """
@@ -230,6 +318,46 @@ class CleanXML(object):
 
         return lat_lon
 
+    def update_extent(self, lat_lon):
+        """
+        Grow the measured extent to include a position
+        :param lat_lon: [lat, lon]
+        :return: None
+        """
+        lat, lon = lat_lon
+        extent = self.extent
+        if extent is None:
+            self.extent = [lat, lat, lon, lon]
+            return
+
+        if lat < extent[0]:
+            extent[0] = lat
+        elif lat > extent[1]:
+            extent[1] = lat
+        if lon < extent[2]:
+            extent[2] = lon
+        elif lon > extent[3]:
+            extent[3] = lon
+
+        return
+
+    def merge_extent(self, extent):
+        """
+        Grow the measured extent to include another extent, eg. from a worker process
+        :param extent: [min_lat, max_lat, min_lon, max_lon], or None
+        :return: None
+        """
+        if extent is None:
+            return
+        if self.extent is None:
+            self.extent = list(extent)
+            return
+
+        self.extent = [min(self.extent[0], extent[0]), max(self.extent[1], extent[1]),
+                       min(self.extent[2], extent[2]), max(self.extent[3], extent[3])]
+
+        return
+
     def fix_created(self, element):
         """
         Fix the keys that should be in created sub-dict
@@ -237,10 +365,13 @@ class CleanXML(object):
         :return: dictionary with created sub-elements
         """
         created = {}
+        interner = self.interner
         for created_key in self.created:
             if created_key in element.attrib:
                 val = element.attrib[created_key]
                 # TODO Parse timestamp as python datetime object
+                if interner is not None:
+                    val = interner.value(created_key, val)
                 created[created_key] = val
 
         return created
@@ -253,22 +384,9 @@ class CleanXML(object):
         :return: Fixed string
         """
 
-        # First remove all periods (audit step showed all periods don't belong)
-        street = re.sub(r'[.]', '', street)
-
-        # Fix prefixes
-        for prefix_re, prefix_full in self.street_prefixes_re:
-            street, n = prefix_re.subn(prefix_full, street)
-            if n:
-                break
-
-        # Then fix the street types
-        for type_re, type_full in self.street_types_re:
-            street, n = type_re.subn(type_full, street)
-            if n:
-                break
-
-        return street
+        # Periods are removed first (audit step showed all periods don't belong), then the
+        # first matching prefix and street type rules are applied in a single cached pass
+        return self.street_normalizer.normalize(street)
 
     def shape_element(self, element):
         """
@@ -299,6 +417,7 @@ class CleanXML(object):
             lat_lon = self.get_lat_lon(element)
             if lat_lon:
                 node['pos'] = lat_lon
+                self.update_extent(lat_lon)
 
             # Type
             if element.tag == "node":
@@ -311,52 +430,42 @@ class CleanXML(object):
 
             # Visible
             node["visible"] = element.get("visible")
+            interner = self.interner
+            if interner is not None and node["visible"] is not None:
+                node["visible"] = interner.value("visible", node["visible"])
 
-            # Iterate through sub-values
+            # Iterate through sub-values, each distinct key is classified once (see tagkeys.classify_key)
+            classify = self.key_classifier.classify
             for tag in element.iter("tag"):
 
                 # Get key/value pair
                 k = tag.attrib['k']
                 v = tag.attrib['v']
 
-                # Ignore keys with problem characters
-                if re.search(self.problem_characters, k):
-                    continue
-
-                # Parse address and other with sub-elements
-                keys = k.split(':')
-                if len(keys) == 1:
-                    # If only one key just fill in place, all keys lower case
-                    # except NHS (National Highway System) and "FIX_ME" (underscore for editor only)
-                    if k.upper() == "FIXME" or k.upper() == "NHS":
-                        node[k.upper()] = v
+                _, action, field = classify(k)
+                if action == FIELD:
+                    if interner is not None:
+                        v = interner.value(field, v)
+                    node[field] = v
+                elif action == ADDRESS:
+                    if interner is not None:
+                        v = interner.value(field, v)
+                    node["address"][field] = v
+                elif action == STREET:
+                    # If street then fix street name and assign
+                    self.num_streets_total[v] += 1
+                    if self.instrument is None:
+                        corrected = self.fix_street(v)
                     else:
-                        node[k.lower()] = v
-                else:
-                    # If more than one then process according to extra rules
-
-                    if len(keys) == 2 and keys[0] == "addr":
-                        # Processing address
-                        if keys[1] == "street":
-                            # If street then fix street name and assign
-                            self.num_streets_total[v] += 1
-                            corrected = self.fix_street(v)
-                            if corrected != v:
-                                self.num_streets_corrected[v] += 1
-                                # print("original: {0}, corrected: {1}".format(v, corrected))
-                                v = corrected
-                        node["address"][keys[1]] = v
-
-                    elif len(keys) > 2 and keys[0] == "addr" and keys[1] == "street":
-                        # Ignore redundant sub-fields of address
-                        continue
-
-                    elif len(keys) > 1:
-                        # On other fields just
-                        merged_k = "_".join(keys)
-                        node[merged_k] = v
-                    else:
-                        assert "Should not arrive here"
+                        start = clock()
+                        corrected = self.fix_street(v)
+                        self.instrument.add("street", clock() - start)
+                    if corrected != v:
+                        self.num_streets_corrected[v] += 1
+                        v = corrected
+                    if interner is not None:
+                        v = interner.value(field, v)
+                    node["address"][field] = v
 
             # Add node refs
             if element.tag == "way":
@@ -380,42 +489,180 @@ class CleanXML(object):
         print("Number of streets corrected: {0}".format(len(self.num_streets_corrected)))
         print("Percent of streets corrected: {0:.1f}%".format(
             100.0 * float(len(self.num_streets_corrected)) / (float(len(self.num_streets_total)) + 1e-7)))
+        if self.extent is not None:
+            print("Measured extent: latitude {0} to {1}, longitude {2} to {3}".format(*self.extent))
+
+        return
+
+    @staticmethod
+    def free_element(element):
+        """
+        Release the memory held by a fully processed top level element. The
+        element's children are cleared and any preceding siblings still attached
+        to the root are deleted, so the parsed tree never grows past one element.
+        :param element: Top level XML element (node, way, relation or bounds)
+        :return: None
+        """
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
 
         return
 
-    def process_map(self, pretty=False):
-        # You do not need to change this file
-        file_out = "{0}.json".format(self.filename)
-        data = []
-        with codecs.open(file_out, "w") as fo:
-            for _, element in etree.iterparse(self.filename):
+    def iter_elements(self):
+        """
+        Generator over the shaped documents of the input file. Each top level
+        element is freed as soon as it has been shaped, so memory stays flat
+        regardless of the size of the input file.
+        :return: Generator of shaped dictionaries
+        """
+        if self.instrument is not None:
+            for el in self.iter_elements_instrumented():
+                yield el
+            return
+
+        with open_osm(self.filename) as source:
+            for _, element in etree.iterparse(source, events=("end",), tag=self.top_level_tags):
                 el = self.shape_element(element)
+                self.free_element(element)
                 if el:
-                    data.append(el)
-                    if pretty:
-                        fo.write(json.dumps(el, indent=2) + "\n")
-                    else:
-                        fo.write(json.dumps(el) + "\n")
-        return data
+                    yield el
+
+    def iter_elements_instrumented(self):
+        """
+        iter_elements, recording the time spent parsing, shaping and freeing in
+        self.instrument. Street fixing is recorded separately by shape_element and
+        is not included in the shape time. The time the consumer spends between
+        documents is not counted.
+        :return: Generator of shaped dictionaries
+        """
+        instrument = self.instrument
+        for stage in ("parse", "shape", "street", "free"):
+            instrument.add(stage, 0.0)
+
+        with open_osm(self.filename) as source:
+            instrument.start(None if is_compressed(self.filename) else self.filename, source)
+            last = clock()
+            for _, element in etree.iterparse(source, events=("end",), tag=self.top_level_tags):
+                parsed = clock()
+                instrument.add("parse", parsed - last)
+                street = instrument.stages["street"]
+                num_tags = len(element.findall("tag"))
+                el = self.shape_element(element)
+                shaped = clock()
+                instrument.add("shape", shaped - parsed - (instrument.stages["street"] - street))
+                self.free_element(element)
+                last = clock()
+                instrument.add("free", last - shaped)
+                if el:
+                    instrument.element(num_tags)
+                    yield el
+                    last = clock()
+            instrument.stop()
+
+    def stream_map(self, pretty=False, output_format="json", geometry=None):
+        """
+        Streaming version of process_map. The shaped documents are written to the
+        output file and yielded one at a time instead of being kept in a list.
+        :param pretty: True to indent the JSON output
+        :param output_format: Output serializer name, "json" or "bson" (see serializers.get_serializer)
+        :param geometry: Optional geometry.WayGeometry stage to attach length_km and bbox to ways
+        :return: Generator of shaped dictionaries
+        """
+        docs = self.iter_elements()
+        if geometry is not None:
+            docs = geometry.process(docs)
+
+        serializer = get_serializer(output_format, pretty)
+        instrument = self.instrument
+        with serializer.open(uncompressed_name(self.filename)) as fo:
+            if instrument is None:
+                for el in docs:
+                    fo.write(serializer.dumps(el))
+                    yield el
+            else:
+                for el in docs:
+                    start = clock()
+                    data = serializer.dumps(el)
+                    fo.write(data)
+                    instrument.add("serialize", clock() - start)
+                    instrument.bytes_written += len(data)
+                    yield el
+
+    def process_map(self, pretty=False, streaming=False, output_format="json", geometry=None):
+        """
+        Shape every element of the input file and write it to <filename>.json, or
+        <filename>.bson for the BSON output format
+        :param pretty: True to indent the JSON output
+        :param streaming: True to return a generator instead of building the full list
+        :param output_format: Output serializer name, "json" or "bson" (see serializers.get_serializer)
+        :param geometry: Optional geometry.WayGeometry stage to attach length_km and bbox to ways
+        :return: List of shaped dictionaries, or a generator of them when streaming
+        """
+        if streaming:
+            return self.stream_map(pretty, output_format, geometry)
+
+        if self.intern_strings is None and self.interner is None:
+            self.interner = StringInterner()
+
+        return list(self.stream_map(pretty, output_format, geometry))
 
     @staticmethod
-    def insert_into_mongo(database, collection, filename):
+    def insert_into_mongo(database, collection, filename, client=None):
         """
-        Insert the results from the process map method into a mongodb instance
+        Insert the results from the process map method into a mongodb instance, with
+        loader.MongoLoader rather than the mongoimport command line tool
         :param database: Name of the database to insert into
         :param collection: Name of the collection to use
-        :param filename: Name of input file
-        :return:
+        :param filename: Name of input file, without the .osm extension
+        :param client: Optional MongoClient (or mongomock stand-in), defaults to localhost
+        :return: The MongoLoader used, holding the load statistics
         """
-        sp.call("mongoimport -d {0} -c {1} --file {2}".format(
-            database, collection, filename + ".osm.json"), shell=True)
+        if client is None:
+            client = MongoClient('localhost:27017')
+        loader = MongoLoader(client[database][collection])
+        loader.load_file(filename + ".osm.json")
+        loader.print_stats()
 
-        return
+        return loader
+
+    def load_into_mongo(self, database, collection, batch_size=1000, ordered=False, write_concern=None,
+                        client=None, geometry=None, workers=None, queue_size=4):
+        """
+        Shape the input file and insert the documents directly into mongodb in
+        batches, without writing the intermediate JSON file
+        :param database: Name of the database to insert into
+        :param collection: Name of the collection to use
+        :param batch_size: Number of documents per insert_many call
+        :param ordered: True for ordered inserts
+        :param write_concern: Dictionary of write concern options, eg. {"w": 1}
+        :param client: Optional MongoClient (or mongomock stand-in), defaults to localhost
+        :param geometry: Optional geometry.WayGeometry stage to attach length_km and bbox to ways
+        :param workers: Number of insert threads working while the file is parsed (see
+                        pipeline.PipelinedLoader), None to insert in between parsing batches
+        :param queue_size: Maximum number of shaped batches waiting for an insert thread
+        :return: The MongoLoader or PipelinedLoader used, holding the load statistics
+        """
+        if client is None:
+            client = MongoClient('localhost:27017')
+        docs = self.iter_elements()
+        if geometry is not None:
+            docs = geometry.process(docs)
+        if workers:
+            loader = PipelinedLoader(client[database][collection], batch_size, ordered, write_concern, workers,
+                                     queue_size)
+        else:
+            loader = MongoLoader(client[database][collection], batch_size, ordered, write_concern)
+        loader.load(docs)
+        loader.print_stats()
+
+        return loader
 
     def test(self):
         # NOTE: if you are running this code on your computer, with a larger dataset,
         # call the process_map procedure with pretty=False. The pretty=True option adds
-        # additional spaces to the output, making it significantly larger.
+        # additional spaces to the output, making it significantly larger. For extracts too
+        # large to hold in memory use process_map(streaming=True) and consume the generator.
         data = self.process_map(False)
         # pprint.pprint(data)
 
@@ -423,18 +670,35 @@ class CleanXML(object):
 class FixAndAnalyzeDB(object):
     """
     This class performs the data analysis phase of the project. It looks
-    through the data imported into the database
+    through the data imported into the database. Each report is built from
+    query methods that return plain python values, so that other backends
+    (see offline.OfflineAnalyzeDB) can answer the same queries.
     """
 
-    def __init__(self, database, collection):
+    # Indexes needed by the analyses, and by incremental updates keyed on type and id
+    index_keys = [
+        [("type", 1)],
+        [("created.user", 1)],
+        [("amenity", 1)],
+        [("address.city", 1)],
+        [("FIXME", 1)],
+        [("type", 1), ("id", 1)],
+    ]
+
+    # Values of the bicycle tag for which bicycling is allowed
+    bicycle_allowed = ["yes", "designated", "permissive", "allowed"]
+
+    def __init__(self, database, collection, client=None):
         """
         Initialize the object
         :param database: The name of the database to connect to
         :param collection: The name of the collection to use
+        :param client: Optional MongoClient (or mongomock stand-in), defaults to localhost
         :return:
         """
 
-        client = MongoClient('localhost:27017')
+        if client is None:
+            client = MongoClient('localhost:27017')
         self.collection = client[database][collection]
         self.area_km = 0
         self.num_ways = 0
@@ -448,66 +712,133 @@ class FixAndAnalyzeDB(object):
         :return:
         """
         # First report on the cities to show which ones are wrong
-        res = self.collection.aggregate([{"$match": {"address.city": {"$exists": True}}},
-                                         {"$group": {"_id": "$address.city", "count": {"$sum": 1}}},
-                                         {"$sort": {"count": -1}}])
         print("City counts")
-        for doc in res:
-            print("City: {0:20s}, Count: {1}".format(doc["_id"], doc["count"]))
+        for city, count in self.city_counts():
+            print("City: {0:20s}, Count: {1}".format(city, count))
         print("")
 
-        # Now loop through all corrections that need to be done and perform each save
-        num_updated_cities = 0
-        for incorrect_city in cities_corrections:
-            res = self.collection.find({"address.city": incorrect_city})
-            for doc in res:
-                doc["address"]["city"] = cities_corrections[incorrect_city]
-                self.collection.save(doc)
-                num_updated_cities += 1
+        # Now perform all the corrections on the server in one batch
+        num_matched, num_updated_cities = self.apply_corrections({"address.city": cities_corrections})
         print("Number of city records fixed: {0}".format(num_updated_cities))
         print("")
 
         return
 
+    def city_counts(self):
+        """
+        :return: List of (city, count) pairs, most common first
+        """
+        res = self.collection.aggregate([{"$match": {"address.city": {"$exists": True}}},
+                                         {"$group": {"_id": "$address.city", "count": {"$sum": 1}}},
+                                         {"$sort": {"count": -1}}])
+
+        return [(doc["_id"], doc["count"]) for doc in res]
+
+    def apply_corrections(self, corrections):
+        """
+        Correct erroneous values of any fields on the server. All corrections are sent
+        as update_many operations in a single unordered bulk_write call, so a corrected
+        value should not itself be corrected by another entry.
+        :param corrections: Map of field path (eg. "address.city") to a map of erroneous to correct value
+        :return: number of documents matched, number of documents modified
+        """
+        operations = []
+        for field, mapping in corrections.items():
+            for incorrect, correct in mapping.items():
+                if incorrect != correct:
+                    operations.append(UpdateMany({field: incorrect}, {"$set": {field: correct}}))
+
+        if not operations:
+            return 0, 0
+
+        result = self.collection.bulk_write(operations, ordered=False)
+
+        return result.matched_count, result.modified_count
+
+    def create_indexes(self):
+        """
+        Create the indexes used by the analyses and the incremental updates. Run
+        right after loading the data.
+        :return: List of the index names
+        """
+        index_names = []
+        for keys in self.index_keys:
+            index_names.append(self.collection.create_index(keys))
+
+        return index_names
+
     def data_overview(self):
         """
         Report basic statistics of the data
         :return: None
         """
+        counts = self.overview_counts()
 
         # Number of documents
-        num_docs = self.collection.find().count()
+        num_docs = counts["docs"]
         print("Number of documents in the database: {0}".format(num_docs))
 
         # Number of nodes
-        num_nodes = self.collection.find({"type": "node"}).count()
-        print("Number of nodes in the database: {0}".format(num_nodes))
+        print("Number of nodes in the database: {0}".format(counts["nodes"]))
 
         # Number of ways
-        self.num_ways = self.collection.find({"type": "way"}).count()
+        self.num_ways = counts["ways"]
         print("Number of ways in the database: {0}".format(self.num_ways))
 
         # Number of edits by ecarl65 - my osm username
-        num_ecarl65 = self.collection.find({"created.user": "ecarl65"}).count()
+        num_ecarl65 = counts["ecarl65"]
         print("Number of edits by ecarl65: {0} ({1:.1f}%)".format(
             num_ecarl65, float(num_ecarl65) / num_docs * 100.0))
 
         # Total number of distinct users
-        users = self.collection.distinct("created.user")
-        print("Number of unique users: {0}".format(len(users)))
+        print("Number of unique users: {0}".format(counts["users"]))
 
         # Total number of documents with "FIX_ME" tag
-        num_fixme = self.collection.find({"FIXME": {"$exists": True}}).count()
-        print("Number of documents with FIXME: {0}".format(num_fixme))
+        print("Number of documents with FIXME: {0}".format(counts["fixme"]))
 
         # Find number churches
-        num_churches = self.collection.find({"amenity": "place_of_worship"}).count()
-        num_churches_wo_religion = self.collection.find(
-            {"amenity": "place_of_worship", "religion": {"$exists": 0}}).count()
-        print("Number of churches: {0}".format(num_churches))
-        print("Number of churches without religion: {0}".format(num_churches_wo_religion))
+        print("Number of churches: {0}".format(counts["churches"]))
+        print("Number of churches without religion: {0}".format(counts["churches_wo_religion"]))
         print("")
 
+    def overview_counts(self):
+        """
+        Basic counts of the data. The total comes from the collection metadata and
+        everything else from a single $facet aggregation.
+        :return: Dictionary with the counts of docs, nodes, ways, ecarl65, users, fixme,
+                 churches and churches_wo_religion
+        """
+
+        def count_stage(query):
+            """
+            Facet sub-pipeline counting the documents matching a query
+            :param query: Match query
+            :return: List of pipeline stages
+            """
+            return [{"$match": query}, {"$count": "count"}]
+
+        res = self.collection.aggregate([{"$facet": {
+            "types": [{"$match": {"type": {"$in": ["node", "way"]}}},
+                      {"$group": {"_id": "$type", "count": {"$sum": 1}}}],
+            "ecarl65": count_stage({"created.user": "ecarl65"}),
+            "users": [{"$match": {"created.user": {"$exists": True}}},
+                      {"$group": {"_id": "$created.user"}},
+                      {"$count": "count"}],
+            "fixme": count_stage({"FIXME": {"$exists": True}}),
+            "churches": count_stage({"amenity": "place_of_worship"}),
+            "churches_wo_religion": count_stage({"amenity": "place_of_worship", "religion": {"$exists": 0}}),
+        }}])
+        facets = list(res)[0]
+
+        counts = {"docs": self.collection.estimated_document_count()}
+        type_counts = dict((doc["_id"], doc["count"]) for doc in facets["types"])
+        counts["nodes"] = type_counts.get("node", 0)
+        counts["ways"] = type_counts.get("way", 0)
+        for name in ("ecarl65", "users", "fixme", "churches", "churches_wo_religion"):
+            counts[name] = facets[name][0]["count"] if facets[name] else 0
+
+        return counts
+
     def additional_ideas(self):
         """
         Print out results of additional queries
@@ -515,22 +846,15 @@ class FixAndAnalyzeDB(object):
         """
 
         # Report postal codes
-        res = self.collection.aggregate([
-            {"$match": {"type": "node", "address.postcode": {"$exists": True}}},
-            {"$group": {"_id": "$address.postcode", "count": {"$sum": 1}}},
-            {"$sort": {"_id": 1}},
-            {"$limit": 6}
-        ])
         print("Postcodes on nodes")
-        for doc in res:
-            print("Postcode: {0:7s}, Count: {1}".format(doc["_id"], doc["count"]))
+        for postcode, count in self.postcode_counts():
+            print("Postcode: {0:7s}, Count: {1}".format(postcode, count))
         print("")
 
         # self.measured_area()
 
         # Find the bounding box of the downloaded section
-        bounding_doc = self.collection.find({"type": "bounds"})
-        bounding_box = list(bounding_doc)[0]
+        bounding_box = self.reported_bounds()
         self.area_km, d_lat_km, d_lon_km = self.compute_area(bounding_box['maxlat'], bounding_box['maxlon'],
                                                              bounding_box['minlat'], bounding_box['minlon'])
         print("Reported Minimum Latitude: {0}".format(bounding_box["minlat"]))
@@ -543,55 +867,123 @@ class FixAndAnalyzeDB(object):
         print("")
 
         # Number of ways suitable for cycling
-        res = self.collection.aggregate([
-            {"$match": {"type": "way", "highway": {"$exists": True}}},
-            {"$group": {"_id": "$highway", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 12}
-        ])
         print("Highways")
-        for doc in res:
-            print("Highway: {0:20s}, Count: {1}".format(doc["_id"], doc["count"]))
+        for highway, count in self.highway_counts():
+            print("Highway: {0:20s}, Count: {1}".format(highway, count))
         print("")
 
         # Bicycle tag
-        res = self.collection.aggregate([
-            {"$match": {"type": "way"}},
-            {"$group": {"_id": "$bicycle", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            # {"$limit": 12}
-        ])
         print("Bicycle tags on ways")
-        for doc in res:
-            print("Bicycle: {0:20s}, Count: {1}".format(doc["_id"], doc["count"]))
+        for bicycle, count in self.bicycle_counts():
+            print("Bicycle: {0:20s}, Count: {1}".format(str(bicycle), count))
         print("")
 
         # Percentage of bicycle allowable roads
         print("Percentage of bicycle allowed ways:")
-        res = self.collection.aggregate([
-            {"$match": {"type": "way", "$or": [
-                    {"highway": "cycleway"},
-                    {"bicycle": {"$in": ["yes", "designated", "permissive", "allowed"]}}]}},
-            {"$group": {"_id": None, "count": {"$sum": 1}}}
-        ])
-        num_bike_ways = 0
-        for doc in res:
-            num_bike_ways = doc["count"]
+        num_bike_ways = self.num_bike_ways()
         print("Number of ways in which bicycling is allowed: {0}".format(num_bike_ways))
         print("Percent of ways in which bicycling is allowed: {0:.1f}%".format(
             100.0 * num_bike_ways / (self.num_ways + 1e-7)
         ))
 
+        # Length of the ways suitable for cycling, needs the geometry attached at ingest
+        print("Kilometres of bicycle allowed ways by highway type:")
+        total_bike_km = 0.0
+        for highway, length_km in self.bike_way_lengths():
+            total_bike_km += length_km
+            print("Highway: {0:20s}, Length: {1:.3f} (km)".format(str(highway), length_km))
+        print("Kilometres of ways in which bicycling is allowed: {0:.3f}".format(total_bike_km))
+
         # Find the number of bike shops
-        num_bike_shops = self.collection.find(
-            {"$or": [{"shop": "bicycle"}, {"shop_1": "bicycle"}]}
-        ).count()
+        num_bike_shops = self.num_bike_shops()
         print("Number of bike shops: {0}".format(num_bike_shops))
         print("Number of bike shops per km^2: {0:g}".format(float(num_bike_shops) / self.area_km))
 
         return
 
-    def measured_area(self):
+    def postcode_counts(self, limit=6):
+        """
+        :param limit: Maximum number of postcodes to return
+        :return: List of (postcode, count) pairs of nodes, sorted by postcode
+        """
+        res = self.collection.aggregate([
+            {"$match": {"type": "node", "address.postcode": {"$exists": True}}},
+            {"$group": {"_id": "$address.postcode", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}},
+            {"$limit": limit}
+        ])
+
+        return [(doc["_id"], doc["count"]) for doc in res]
+
+    def reported_bounds(self):
+        """
+        :return: The bounds document of the downloaded section
+        """
+        return self.collection.find_one({"type": "bounds"})
+
+    def highway_counts(self, limit=12):
+        """
+        :param limit: Maximum number of highway types to return
+        :return: List of (highway, count) pairs of ways, most common first
+        """
+        res = self.collection.aggregate([
+            {"$match": {"type": "way", "highway": {"$exists": True}}},
+            {"$group": {"_id": "$highway", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": limit}
+        ])
+
+        return [(doc["_id"], doc["count"]) for doc in res]
+
+    def bicycle_counts(self):
+        """
+        :return: List of (bicycle tag, count) pairs of ways, most common first. None for no tag.
+        """
+        res = self.collection.aggregate([
+            {"$match": {"type": "way"}},
+            {"$group": {"_id": "$bicycle", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            # {"$limit": 12}
+        ])
+
+        return [(doc["_id"], doc["count"]) for doc in res]
+
+    def bike_way_query(self):
+        """
+        :return: Match query of the ways in which bicycling is allowed
+        """
+        return {"type": "way", "$or": [
+            {"highway": "cycleway"},
+            {"bicycle": {"$in": self.bicycle_allowed}}]}
+
+    def num_bike_ways(self):
+        """
+        :return: Number of ways in which bicycling is allowed
+        """
+        return self.collection.count_documents(self.bike_way_query())
+
+    def bike_way_lengths(self):
+        """
+        :return: List of (highway, km) pairs of the ways in which bicycling is allowed,
+                 longest first. Only ways with geometry attached at ingest are counted.
+        """
+        query = self.bike_way_query()
+        query["length_km"] = {"$exists": True}
+        res = self.collection.aggregate([
+            {"$match": query},
+            {"$group": {"_id": "$highway", "length_km": {"$sum": "$length_km"}}},
+            {"$sort": {"length_km": -1}}
+        ])
+
+        return [(doc["_id"], doc["length_km"]) for doc in res]
+
+    def num_bike_shops(self):
+        """
+        :return: Number of bike shops
+        """
+        return self.collection.count_documents({"$or": [{"shop": "bicycle"}, {"shop_1": "bicycle"}]})
+
+    def measured_area(self, extent=None):
         """
         Measures the area of the data by taking the min/max lat/lon and
         finding the distance along the mid-points of the rectangle. It turns
@@ -600,43 +992,14 @@ class FixAndAnalyzeDB(object):
         ways went MUCH further than that area of interest. Althought some
         ways went further, that doesn't mean that all the data in that expanded
         region was collected, so this would give misleading further statistics.
+        :param extent: Optional (min_lat, max_lat, min_lon, max_lon) measured at ingest
+                       (see CleanXML.extent), otherwise it is queried from the database
         :return:
         """
-        def extract_lat_or_lon(lat_lon, sort_type=1):
-            """
-            Extract the latitude or longitude min or max
-            :param lat_lon: 'lat' or 'lon'
-            :param sort_type: 1 for minimum, -1 for maximum
-            :return: Extracted value
-            """
-
-            # Get minimum and maximum for latitude and longitude
-            element_pos = 0
-            if lat_lon == "lat":
-                element_pos = 0
-            elif lat_lon == "lon":
-                element_pos = 1
-            else:
-                print("Pass in either 'lat' or 'lon' for field")
-                return
-
-            query = [
-                {"$match": {"pos": {"$exists": 1}}},
-                {"$project": {"_id": 0, lat_lon: {"$arrayElemAt": ["$pos", element_pos]}}},
-                {"$sort": {lat_lon: sort_type}},
-                {"$limit": 1}
-            ]
-
-            out_doc = self.collection.aggregate(query)
-            val = [doc[lat_lon] for doc in out_doc][0]
-
-            return val
-
         # Compute the area based on the content
-        min_lat = extract_lat_or_lon("lat", 1)
-        max_lat = extract_lat_or_lon("lat", -1)
-        min_lon = extract_lat_or_lon("lon", 1)
-        max_lon = extract_lat_or_lon("lon", -1)
+        if extent is None:
+            extent = self.measured_extent()
+        min_lat, max_lat, min_lon, max_lon = extent
         area_km, dist_lat_km, dist_lon_km = self.compute_area(max_lat, max_lon, min_lat, min_lon)
         print("Minimum Measured Latitude: {0}".format(min_lat))
         print("Maximum Measured Latitude: {0}".format(max_lat))
@@ -648,6 +1011,24 @@ class FixAndAnalyzeDB(object):
 
         return
 
+    def measured_extent(self):
+        """
+        Find the minimum and maximum latitude and longitude of the positioned
+        documents in a single $group pass
+        :return: min_lat, max_lat, min_lon, max_lon
+        """
+        lat = {"$arrayElemAt": ["$pos", 0]}
+        lon = {"$arrayElemAt": ["$pos", 1]}
+        res = self.collection.aggregate([
+            {"$match": {"pos": {"$exists": 1}}},
+            {"$group": {"_id": None,
+                        "min_lat": {"$min": lat}, "max_lat": {"$max": lat},
+                        "min_lon": {"$min": lon}, "max_lon": {"$max": lon}}}
+        ])
+        doc = list(res)[0]
+
+        return doc["min_lat"], doc["max_lat"], doc["min_lon"], doc["max_lon"]
+
     @staticmethod
     def compute_area(max_lat, max_lon, min_lat, min_lon):
         """
@@ -662,8 +1043,8 @@ class FixAndAnalyzeDB(object):
         """
         mean_lat = (min_lat + max_lat) / 2.0
         mean_lon = (min_lon + max_lon) / 2.0
-        dist_lat_km = vincenty((mean_lat, min_lon), (mean_lat, max_lon)).km
-        dist_lon_km = vincenty((min_lat, mean_lon), (max_lat, mean_lon)).km
+        dist_lat_km, dist_lon_km = map(float, vincenty_km([mean_lat, min_lat], [min_lon, mean_lon],
+                                                          [mean_lat, max_lat], [max_lon, mean_lon]))
         area_km = dist_lat_km * dist_lon_km
 
         return area_km, dist_lat_km, dist_lon_km
@@ -686,12 +1067,12 @@ if __name__ == "__main__":
 
     # Format data for output
     clean_results = CleanXML(input_basename + ".osm")
-    clean_results.test()
+    clean_results.load_into_mongo(database_name, collection_name, geometry=WayGeometry())
     clean_results.print_stats()
-    clean_results.insert_into_mongo(database_name, collection_name, input_basename)
 
     # Analyze results
     analyze_results = FixAndAnalyzeDB(database_name, collection_name)
+    analyze_results.create_indexes()
     analyze_results.fix_cities({"Centenn": "Centennial"})
     analyze_results.data_overview()
     analyze_results.additional_ideas()
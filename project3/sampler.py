@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+"""Referentially consistent samples of .osm files.
+
+OSMSampler takes every k-th way, or a random fraction of the ways, together
+with every node those ways reference, so that a sample such as
+centennial_sample.osm has no way pointing at a missing node. Relations are
+kept only when all of their node and way members are in the sample.
+
+The file is read twice, in bounded memory. The first pass reads the ways and
+collects the ids of the sampled ways and of their nodes. In an uncompressed
+file the nodes all come before the ways, so the first pass starts at the
+first <way element instead of parsing the nodes. The ids are kept in IdSet,
+a sorted numpy array of 8 bytes per id. The second pass copies the sampled
+elements to the output.
+"""
+
+import os
+import re
+import sys
+import mmap
+import time
+import random
+from array import array
+import numpy as np
+from lxml import etree
+from project3 import CleanXML
+from compressed import open_osm, is_compressed, uncompressed_name
+from parallel import ChunkReader
+
+
+# Start of a way element, the tag name may be followed by any whitespace, "/" or ">"
+WAY_START_RE = re.compile(br"<way[\s/>]")
+
+
+class IdSet(object):
+    """Compact, immutable set of integer ids, stored as a sorted numpy array"""
+
+    def __init__(self, ids):
+        """
+        Build the set
+        :param ids: Iterable or array of integer ids, with duplicates
+        :return: None
+        """
+        self.ids = np.unique(np.asarray(ids, dtype=np.int64))
+
+    def __contains__(self, element_id):
+        i = np.searchsorted(self.ids, element_id)
+        return i < len(self.ids) and self.ids[i] == element_id
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes
+
+
+def first_way_offset(filename):
+    """
+    Byte offset of the first <way element of an uncompressed file
+    :param filename: Input .osm filename
+    :return: Byte offset, None if the file has no ways
+    """
+    if not os.path.getsize(filename):
+        return None
+
+    with open(filename, "rb") as fi:
+        data = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            match = WAY_START_RE.search(data)
+        finally:
+            data.close()
+
+    return match.start() if match else None
+
+
+class OSMSampler(object):
+    """Two pass sampler of the ways of an .osm file and the nodes they use"""
+
+    def __init__(self, filename, k=None, fraction=None, seed=1, relations=True):
+        """
+        Initialize the sampler, with either k or fraction
+        :param filename: The input .osm filename, .osm.bz2 and .osm.gz are decompressed on the fly
+        :param k: Take every k-th way
+        :param fraction: Take each way with this probability
+        :param seed: Seed of the random selection of ways
+        :param relations: True to keep the relations whose members are all in the sample
+        :return: None
+        """
+        if (k is None) == (fraction is None):
+            raise ValueError("Give either k or fraction")
+
+        self.filename = filename
+        self.k = k
+        self.fraction = fraction
+        self.seed = seed
+        self.relations = relations
+
+        self.way_ids = None
+        self.node_ids = None
+
+        # Statistics
+        self.num_ways_total = 0
+        self.num_written = {"bounds": 0, "node": 0, "way": 0, "relation": 0}
+        self.seconds = [0.0, 0.0]
+
+    def iter_ways(self):
+        """
+        Generator over the way elements of the input file, starting at the
+        first way when the file is not compressed
+        :return: Generator of way elements, freed after use
+        """
+        offset = None if is_compressed(self.filename) else first_way_offset(self.filename)
+        if offset is None and not is_compressed(self.filename):
+            return
+
+        if offset is None:
+            source = open_osm(self.filename)
+        else:
+            file_size = os.path.getsize(self.filename)
+            source = ChunkReader(self.filename, offset, file_size, file_size)
+        try:
+            for _, element in etree.iterparse(source, events=("end",), tag="way"):
+                yield element
+                CleanXML.free_element(element)
+        finally:
+            source.close()
+
+    def select_ways(self):
+        """
+        First pass, choose the ways and collect the ids of their nodes
+        :return: None
+        """
+        start = time.time()
+        rng = random.Random(self.seed)
+        way_ids = array("q")
+        node_ids = array("q")
+        for i, element in enumerate(self.iter_ways()):
+            if self.k is not None:
+                selected = i % self.k == 0
+            else:
+                selected = rng.random() < self.fraction
+            if selected:
+                way_ids.append(int(element.attrib["id"]))
+                node_ids.extend(int(nd.attrib["ref"]) for nd in element.iter("nd"))
+            self.num_ways_total += 1
+
+        self.way_ids = IdSet(way_ids)
+        self.node_ids = IdSet(node_ids)
+        self.seconds[0] = time.time() - start
+
+        return
+
+    def keep_relation(self, element):
+        """
+        :param element: Relation element
+        :return: True if every member of the relation is in the sample
+        """
+        for member in element.iter("member"):
+            member_type = member.attrib["type"]
+            if member_type == "node":
+                ids = self.node_ids
+            elif member_type == "way":
+                ids = self.way_ids
+            else:
+                return False
+            if int(member.attrib["ref"]) not in ids:
+                return False
+
+        return True
+
+    def write(self, output):
+        """
+        Second pass, copy the bounds and the sampled elements to the output
+        :param output: Output .osm filename
+        :return: None
+        """
+        start = time.time()
+        with open_osm(self.filename) as source, open(output, "wb") as fo:
+            root = None
+            for _, element in etree.iterparse(source, events=("end",), tag=("bounds", "node", "way", "relation")):
+                if root is None:
+                    root = element.getparent()
+                    fo.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+                    fo.write(etree.tostring(etree.Element(root.tag, root.attrib))[:-2] + b">\n")
+
+                tag = element.tag
+                if tag == "bounds":
+                    keep = True
+                elif tag == "node":
+                    keep = int(element.attrib["id"]) in self.node_ids
+                elif tag == "way":
+                    keep = int(element.attrib["id"]) in self.way_ids
+                else:
+                    keep = self.relations and self.keep_relation(element)
+
+                if keep:
+                    element.tail = "\n"
+                    fo.write(b" " + etree.tostring(element, encoding="UTF-8"))
+                    self.num_written[tag] += 1
+                CleanXML.free_element(element)
+
+            if root is None:
+                fo.write(b"<?xml version='1.0' encoding='UTF-8'?>\n<osm>\n")
+            fo.write(b"</osm>\n")
+        self.seconds[1] = time.time() - start
+
+        return
+
+    def sample(self, output=None):
+        """
+        Write the sample
+        :param output: Output .osm filename, defaults to the input name with "_sample", eg. centennial_sample.osm
+        :return: The output filename
+        """
+        if output is None:
+            base = uncompressed_name(self.filename)
+            if base.endswith(".osm"):
+                base = base[:-len(".osm")]
+            output = base + "_sample.osm"
+
+        self.select_ways()
+        self.write(output)
+
+        return output
+
+    def print_stats(self):
+        """
+        Print the size of the sample
+        :return: None
+        """
+        print("Ways sampled: {0} of {1}".format(self.num_written["way"], self.num_ways_total))
+        print("Nodes: {0}, relations: {1}".format(self.num_written["node"], self.num_written["relation"]))
+        print("Id sets: {0:.1f} MB".format((self.way_ids.nbytes + self.node_ids.nbytes) / 1e6))
+        print("Selection pass: {0:.2f} (s), copy pass: {1:.2f} (s)".format(*self.seconds))
+
+        return
+
+
+def test():
+    import shutil
+    import tempfile
+    import gzip
+    from benchmark import generate_osm
+
+    tmp_dir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmp_dir, "synthetic.osm")
+    generate_osm(osm_file, num_nodes=3000, num_ways=300, num_relations=20)
+
+    ids = IdSet([5, 3, 5, 1])
+    assert len(ids) == 3 and 3 in ids and 4 not in ids and 6 not in ids and 0 not in ids
+
+    def check(output):
+        # Every node reference and relation member of the sample is in the sample
+        nodes, ways, refs, members = set(), set(), set(), set()
+        for _, element in etree.iterparse(output, events=("end",), tag=("node", "way", "relation")):
+            if element.tag == "node":
+                nodes.add(element.attrib["id"])
+            elif element.tag == "way":
+                ways.add(element.attrib["id"])
+                refs.update(nd.attrib["ref"] for nd in element.iter("nd"))
+            else:
+                members.update((m.attrib["type"], m.attrib["ref"]) for m in element.iter("member"))
+        assert refs <= nodes and refs
+        assert all(ref in (nodes if kind == "node" else ways) for kind, ref in members)
+        return nodes, ways
+
+    sampler = OSMSampler(osm_file, k=10)
+    output = sampler.sample()
+    assert output == os.path.join(tmp_dir, "synthetic_sample.osm")
+    sampler.print_stats()
+    nodes, ways = check(output)
+    assert len(ways) == 30 and sampler.num_ways_total == 300 and sampler.num_written["node"] == len(nodes)
+    assert len(CleanXML(output).process_map()) == 1 + len(nodes) + len(ways)
+
+    # The random fraction is reproducible, and compressed input gives the same sample
+    with open(osm_file, "rb") as fi, gzip.open(osm_file + ".gz", "wb") as fo:
+        fo.write(fi.read())
+    samples = []
+    for filename in (osm_file, osm_file, osm_file + ".gz"):
+        output = OSMSampler(filename, fraction=0.2, seed=7).sample(os.path.join(tmp_dir, "fraction.osm"))
+        with open(output, "rb") as fi:
+            samples.append(fi.read())
+    assert samples[0] == samples[1] == samples[2]
+    nodes, ways = check(output)
+    assert 30 < len(ways) < 90
+
+    # Ways whose tag name is followed by a newline or a tab are found and sampled
+    with open(osm_file, "rb") as fi:
+        content = fi.read()
+    for separator in (b"\n", b"\t"):
+        with open(osm_file, "wb") as fo:
+            fo.write(content.replace(b"<way ", b"<way" + separator))
+        assert first_way_offset(osm_file) == content.index(b"<way ")
+        sampler = OSMSampler(osm_file, k=10)
+        check(sampler.sample())
+        assert sampler.num_written["way"] == 30
+    with open(osm_file, "wb") as fo:
+        fo.write(b"<osm><node id='1'/><wayside/><way>\n</way></osm>")
+    assert first_way_offset(osm_file) == len(b"<osm><node id='1'/><wayside/>")
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:]:
+        # python sampler.py <input.osm> <k> [output.osm]
+        osm_sampler = OSMSampler(sys.argv[1], k=int(sys.argv[2]))
+        print("Wrote {0}".format(osm_sampler.sample(sys.argv[3] if sys.argv[3:] else None)))
+        osm_sampler.print_stats()
+    else:
+        test()
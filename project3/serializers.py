@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Output serializers for the shaped documents.
+
+Every serializer turns one shaped document into bytes, and opens its output
+file with a large write buffer. The "json" format uses orjson when it is
+installed and falls back to the standard library json module otherwise. The
+"bson" format writes a .bson file of concatenated documents, which mongorestore
+can load directly without parsing any JSON:
+
+    mongorestore -d <database> -c <collection> <filename>.bson
+"""
+
+import io
+import json
+from bson import BSON
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Size of the write buffer of the output files
+BUFFER_SIZE = 1024 * 1024
+
+
+class Serializer(object):
+    """Base class of the output serializers"""
+
+    extension = None
+
+    def __init__(self, pretty=False):
+        """
+        Initialize the serializer
+        :param pretty: True to indent the output, where the format supports it
+        :return: None
+        """
+        self.pretty = pretty
+
+    def dumps(self, doc):
+        """
+        Serialize one document
+        :param doc: Shaped dictionary
+        :return: Bytes to write to the output file
+        """
+        raise NotImplementedError
+
+    def output_name(self, filename):
+        """
+        :param filename: Input .osm filename
+        :return: Name of the output file
+        """
+        return filename + self.extension
+
+    def open(self, filename):
+        """
+        Open the buffered output file for an input file
+        :param filename: Input .osm filename
+        :return: File object opened for binary writing
+        """
+        return open(self.output_name(filename), "wb", BUFFER_SIZE)
+
+
+class StdlibJSONSerializer(Serializer):
+    """Newline delimited JSON using the standard library"""
+
+    extension = ".json"
+
+    def dumps(self, doc):
+        if self.pretty:
+            return (json.dumps(doc, indent=2) + "\n").encode("utf-8")
+        return (json.dumps(doc) + "\n").encode("utf-8")
+
+
+class OrjsonSerializer(Serializer):
+    """Newline delimited JSON using orjson"""
+
+    extension = ".json"
+
+    def dumps(self, doc):
+        if self.pretty:
+            return orjson.dumps(doc, option=orjson.OPT_INDENT_2) + b"\n"
+        return orjson.dumps(doc) + b"\n"
+
+
+class BSONSerializer(Serializer):
+    """Concatenated BSON documents, the format of mongodump/mongorestore"""
+
+    extension = ".bson"
+
+    def dumps(self, doc):
+        return BSON.encode(doc)
+
+
+def get_serializer(output_format="json", pretty=False):
+    """
+    Get the serializer for an output format
+    :param output_format: "json" for the fastest JSON encoder available, "stdlib-json", "orjson" or "bson"
+    :param pretty: True to indent the output, where the format supports it
+    :return: Serializer instance
+    """
+    if output_format == "json":
+        output_format = "orjson" if orjson is not None else "stdlib-json"
+
+    if output_format == "stdlib-json":
+        return StdlibJSONSerializer(pretty)
+    elif output_format == "orjson":
+        if orjson is None:
+            raise ValueError("orjson is not installed")
+        return OrjsonSerializer(pretty)
+    elif output_format == "bson":
+        return BSONSerializer(pretty)
+    else:
+        raise ValueError("Unknown output format {0}".format(output_format))
+
+
+def test():
+    from bson import decode_file_iter
+
+    doc = {"id": "261114295", "type": "node", "pos": [41.9730791, -87.6866303],
+           "address": {"street": "North Lincoln Avenue"}, "name": u"Café"}
+
+    for output_format in ("stdlib-json", "json"):
+        for pretty in (False, True):
+            out = get_serializer(output_format, pretty).dumps(doc)
+            assert out.endswith(b"\n")
+            assert json.loads(out.decode("utf-8")) == doc
+
+    serializer = get_serializer("bson")
+    assert serializer.output_name("example5.osm") == "example5.osm.bson"
+    assert list(decode_file_iter(io.BytesIO(serializer.dumps(doc) * 2))) == [doc, doc]
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Fixed memory frequency sketches for auditing very large extracts.
+
+AuditXML.audit keeps every distinct street name of every street type in a
+set, which grows with the size of the extract. The approximate audit counts
+the street types in a CountMinSketch instead, and HeavyHitters keeps only
+the top_k most frequent types, each with a few example street names. The
+memory used is set by the sketch dimensions and top_k, whatever the size of
+the input.
+"""
+
+import hashlib
+from array import array
+
+
+class CountMinSketch(object):
+    """Count-min sketch with conservative update. Estimates never undercount,
+    and overcount by at most 2 * total / width with probability 1 - 0.5 ** depth.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        """
+        Initialize an empty sketch
+        :param width: Number of counters per row
+        :param depth: Number of rows, each with its own hash function
+        :return: None
+        """
+        self.width = width
+        self.depth = depth
+        self.rows = [array("q", bytes(8 * width)) for _ in range(depth)]
+        self.total = 0
+
+    def indexes(self, key):
+        """
+        Counter of the key in each row, from two halves of one hash (double hashing)
+        :param key: String key
+        :return: List of column indexes, one per row
+        """
+        h = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """
+        Count a key
+        :param key: String key
+        :param count: Number of occurrences to add
+        :return: The new estimate of the count of the key
+        """
+        indexes = self.indexes(key)
+        estimate = min(row[i] for row, i in zip(self.rows, indexes)) + count
+        # Conservative update: only raise the counters that are below the new estimate
+        for row, i in zip(self.rows, indexes):
+            if row[i] < estimate:
+                row[i] = estimate
+        self.total += count
+
+        return estimate
+
+    def estimate(self, key):
+        """
+        :param key: String key
+        :return: Estimated number of occurrences of the key
+        """
+        return min(row[i] for row, i in zip(self.rows, self.indexes(key)))
+
+    @property
+    def nbytes(self):
+        return sum(row.itemsize * len(row) for row in self.rows)
+
+
+class HeavyHitters(object):
+    """The top_k most frequent keys of a stream, with their estimated counts
+    from a CountMinSketch and up to `examples` example values each.
+    """
+
+    def __init__(self, top_k=20, examples=3, width=2048, depth=4):
+        """
+        Initialize an empty tracker
+        :param top_k: Number of keys tracked
+        :param examples: Maximum number of example values kept per key
+        :param width: Width of the count-min sketch
+        :param depth: Depth of the count-min sketch
+        :return: None
+        """
+        self.top_k = top_k
+        self.examples = examples
+        self.sketch = CountMinSketch(width, depth)
+        # Tracked key -> [estimated count, list of example values]
+        self.top = {}
+
+    def add(self, key, example=None):
+        """
+        Count one occurrence of a key
+        :param key: String key, eg. a street type
+        :param example: Value the key was found in, eg. the street name
+        :return: None
+        """
+        count = self.sketch.add(key)
+        entry = self.top.get(key)
+        if entry is None:
+            if len(self.top) >= self.top_k:
+                smallest = min(self.top, key=lambda k: self.top[k][0])
+                if self.top[smallest][0] >= count:
+                    return
+                del self.top[smallest]
+            entry = self.top[key] = [count, []]
+        entry[0] = count
+        if example is not None and len(entry[1]) < self.examples and example not in entry[1]:
+            entry[1].append(example)
+
+        return
+
+    def most_common(self, n=None):
+        """
+        :param n: Number of keys to return, all tracked keys when None
+        :return: List of (key, estimated count, examples), most frequent first
+        """
+        items = sorted(((key, count, examples) for key, (count, examples) in self.top.items()),
+                       key=lambda item: (-item[1], item[0]))
+        return items if n is None else items[:n]
+
+    def print_report(self, title, n=None):
+        """
+        Print the most frequent keys with their examples
+        :param title: Heading of the report
+        :param n: Number of keys to print, all tracked keys when None
+        :return: None
+        """
+        print("{0} (top {1} of {2} occurrences):".format(title, len(self.top), self.sketch.total))
+        for key, count, examples in self.most_common(n):
+            print("  {0:15s} ~{1:8d}  {2}".format(key, count, ", ".join(examples)))
+
+        return
+
+
+def test():
+    import io
+    import os
+    import random
+    from contextlib import redirect_stdout
+    import tempfile
+    from project3 import AuditXML
+    from benchmark import generate_osm
+
+    # Zipf distributed stream: the frequent keys are found, and estimates never undercount
+    rng = random.Random(1)
+    keys = ["key{0}".format(i) for i in range(5000)]
+    weights = [1.0 / (i + 1) ** 1.2 for i in range(len(keys))]
+    stream = rng.choices(keys, weights, k=50000)
+    exact = {}
+    for key in stream:
+        exact[key] = exact.get(key, 0) + 1
+    hitters = HeavyHitters(top_k=10, examples=2, width=1024)
+    for i, key in enumerate(stream):
+        hitters.add(key, "{0}-{1}".format(key, i % 3))
+    top = hitters.most_common()
+    assert [key for key, _, _ in top[:5]] == sorted(exact, key=exact.get, reverse=True)[:5]
+    for key, count, examples in top:
+        assert exact[key] <= count <= exact[key] + 2 * len(stream) / 1024
+        assert 1 <= len(examples) <= 2 and all(example.startswith(key + "-") for example in examples)
+    assert hitters.sketch.nbytes == 4 * 1024 * 8
+
+    # The approximate audit finds the unexpected street types of the exact audit
+    tmp_dir = tempfile.mkdtemp()
+    osm_file = os.path.join(tmp_dir, "synthetic.osm")
+    generate_osm(osm_file, num_nodes=5000, num_ways=500, tagged_fraction=0.5)
+    auditor = AuditXML(osm_file)
+    street_types, _, _ = auditor.audit()
+    output = io.StringIO()
+    with redirect_stdout(output):
+        approx_types, approx_prefixes, approx_suites = auditor.audit(approximate=True, top_k=5)
+    # Only the bounded reports are printed, not a line per FIXME, place of worship or street
+    report = output.getvalue()
+    assert "FIXME in" not in report and "No religion for" not in report and "Before:" not in report
+    assert "Elements with FIXME (top 1 of" in report and "Places of worship without religion" in report
+    assert 0 < len(approx_types.top) <= 5
+    for street_type, count, examples in approx_types.most_common():
+        assert street_type in street_types and set(examples) <= street_types[street_type]
+    approx_types.print_report("Unexpected street types")
+    approx_prefixes.print_report("Street prefixes", 3)
+    os.remove(osm_file)
+    os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    test()
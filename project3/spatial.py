@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""In-process spatial index over the positions of shaped nodes.
+
+The positions are bucketed into a regular latitude/longitude grid and sorted
+by cell, row by row, so that the cells of one grid row that overlap a query
+are a single contiguous slice of the sorted arrays. Bounding box, radius and
+k-nearest queries only visit the rows that overlap the query, and filter the
+candidates exactly with vectorized distances. Run "python spatial.py benchmark"
+to compare the queries against a linear scan.
+"""
+
+import sys
+import time
+import numpy as np
+from geodesic import EARTH_RADIUS_KM, haversine_km, grid_cell_areas
+
+
+# Kilometres per degree of latitude on the mean sphere
+KM_PER_DEGREE = EARTH_RADIUS_KM * np.pi / 180.0
+
+
+class GridIndex(object):
+    """Grid bucketed index of point positions"""
+
+    def __init__(self, ids, lat, lon, cell_deg=0.01):
+        """
+        Build the index
+        :param ids: Integer ids of the points
+        :param lat: Latitudes of the points in degrees
+        :param lon: Longitudes of the points in degrees
+        :param cell_deg: Size of a grid cell in degrees, about 1 km at mid latitudes
+        :return: None
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        self.cell_deg = float(cell_deg)
+
+        if len(lat):
+            self.min_lat, self.min_lon = float(lat.min()), float(lon.min())
+            self.num_rows = int((lat.max() - self.min_lat) // self.cell_deg) + 1
+            self.num_cols = int((lon.max() - self.min_lon) // self.cell_deg) + 1
+        else:
+            self.min_lat = self.min_lon = 0.0
+            self.num_rows = self.num_cols = 1
+
+        keys = self.row_of(lat) * self.num_cols + self.col_of(lon)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ids = ids[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+
+    @classmethod
+    def from_docs(cls, docs, where=None, cell_deg=0.01):
+        """
+        Build the index over the positioned nodes of a stream of shaped documents
+        :param docs: Iterable of shaped dictionaries, eg. CleanXML.iter_elements()
+        :param where: Optional predicate on a document, eg. to only index bike shops
+        :param cell_deg: Size of a grid cell in degrees
+        :return: GridIndex
+        """
+        ids = []
+        lat = []
+        lon = []
+        for doc in docs:
+            if doc.get("type") != "node" or "pos" not in doc:
+                continue
+            if where is not None and not where(doc):
+                continue
+            ids.append(int(doc["id"]))
+            lat.append(doc["pos"][0])
+            lon.append(doc["pos"][1])
+
+        return cls(ids, lat, lon, cell_deg)
+
+    def row_of(self, lat):
+        """
+        :param lat: Latitudes in degrees
+        :return: Grid rows of the latitudes, clipped to the grid
+        """
+        return np.clip(np.floor((np.asarray(lat) - self.min_lat) / self.cell_deg), 0,
+                       self.num_rows - 1).astype(np.int64)
+
+    def col_of(self, lon):
+        """
+        :param lon: Longitudes in degrees
+        :return: Grid columns of the longitudes, clipped to the grid
+        """
+        return np.clip(np.floor((np.asarray(lon) - self.min_lon) / self.cell_deg), 0,
+                       self.num_cols - 1).astype(np.int64)
+
+    def candidates(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Find the points in the grid cells overlapping a bounding box
+        :return: Array of positions into the sorted arrays
+        """
+        row_start, row_end = int(self.row_of(min_lat)), int(self.row_of(max_lat))
+        col_start, col_end = int(self.col_of(min_lon)), int(self.col_of(max_lon))
+        rows = np.arange(row_start, row_end + 1, dtype=np.int64) * self.num_cols
+        starts = np.searchsorted(self.keys, rows + col_start, side="left")
+        ends = np.searchsorted(self.keys, rows + col_end, side="right")
+        if not len(starts):
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Find the points inside a bounding box, edges included
+        :param min_lat: Southern edge in degrees
+        :param min_lon: Western edge in degrees
+        :param max_lat: Northern edge in degrees
+        :param max_lon: Eastern edge in degrees
+        :return: Array of ids
+        """
+        found = self.candidates(min_lat, min_lon, max_lat, max_lon)
+        lat, lon = self.lat[found], self.lon[found]
+        inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+
+        return self.ids[found[inside]]
+
+    def within(self, lat, lon, radius_km):
+        """
+        Find the points within a great circle distance of a position
+        :param lat: Latitude in degrees
+        :param lon: Longitude in degrees
+        :param radius_km: Distance in km
+        :return: Tuple of (ids, distances in km), nearest first
+        """
+        dlat = radius_km / KM_PER_DEGREE
+        cos_lat = np.cos(np.radians(min(abs(lat) + dlat, 90.0)))
+        dlon = 180.0 if cos_lat < 1e-9 else min(dlat / cos_lat, 180.0)
+        found = self.candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon)
+        distances = haversine_km(lat, lon, self.lat[found], self.lon[found])
+        inside = distances <= radius_km
+        found, distances = found[inside], distances[inside]
+        order = np.argsort(distances, kind="stable")
+
+        return self.ids[found[order]], distances[order]
+
+    def nearest(self, lat, lon, k=1):
+        """
+        Find the k points nearest to a position. The search radius starts at one
+        grid cell and doubles until it holds at least k points.
+        :param lat: Latitude in degrees
+        :param lon: Longitude in degrees
+        :param k: Number of points
+        :return: Tuple of (ids, distances in km), nearest first
+        """
+        radius_km = self.cell_deg * KM_PER_DEGREE
+        max_radius_km = np.pi * EARTH_RADIUS_KM
+        while True:
+            ids, distances = self.within(lat, lon, radius_km)
+            if len(ids) >= k or radius_km >= max_radius_km:
+                return ids[:k], distances[:k]
+            radius_km *= 2
+
+    def density(self, lat_edges, lon_edges):
+        """
+        Points per square km in each cell of a latitude/longitude grid
+        :param lat_edges: Increasing latitudes of the cell edges in degrees
+        :param lon_edges: Increasing longitudes of the cell edges in degrees
+        :return: Array of shape (len(lat_edges) - 1, len(lon_edges) - 1)
+        """
+        counts, _, _ = np.histogram2d(self.lat, self.lon, bins=(lat_edges, lon_edges))
+
+        return counts / grid_cell_areas(lat_edges, lon_edges)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def synthetic_points(n, seed=0):
+    """
+    Random points spread over an area the size of the Centennial extract
+    :param n: Number of points
+    :param seed: Random seed
+    :return: Tuple of (ids, lat, lon)
+    """
+    rng = np.random.RandomState(seed)
+    return np.arange(n, dtype=np.int64), rng.uniform(39.5, 39.7, n), rng.uniform(-105.0, -104.7, n)
+
+
+def benchmark(n=1000000, num_queries=200):
+    """
+    Time the index queries against a linear scan over the same points
+    :param n: Number of points
+    :param num_queries: Number of queries of each kind
+    :return: None
+    """
+    ids, lat, lon = synthetic_points(n)
+    rng = np.random.RandomState(1)
+    query_lat = rng.uniform(39.5, 39.7, num_queries)
+    query_lon = rng.uniform(-105.0, -104.7, num_queries)
+
+    start = time.time()
+    index = GridIndex(ids, lat, lon)
+    print("Build: {0:.3f} s for {1} points".format(time.time() - start, n))
+
+    def scan_bbox(qlat, qlon):
+        inside = (lat >= qlat) & (lat <= qlat + 0.01) & (lon >= qlon) & (lon <= qlon + 0.01)
+        return ids[inside]
+
+    def scan_within(qlat, qlon):
+        distances = haversine_km(qlat, qlon, lat, lon)
+        return ids[distances <= 2.0]
+
+    def scan_nearest(qlat, qlon):
+        distances = haversine_km(qlat, qlon, lat, lon)
+        return ids[np.argpartition(distances, 10)[:10]]
+
+    queries = (("bbox", lambda qlat, qlon: index.bbox(qlat, qlon, qlat + 0.01, qlon + 0.01), scan_bbox),
+               ("within 2 km", lambda qlat, qlon: index.within(qlat, qlon, 2.0)[0], scan_within),
+               ("nearest 10", lambda qlat, qlon: index.nearest(qlat, qlon, 10)[0], scan_nearest))
+    for name, indexed, scan in queries:
+        timings = []
+        for query in (indexed, scan):
+            start = time.time()
+            for qlat, qlon in zip(query_lat, query_lon):
+                query(qlat, qlon)
+            timings.append((time.time() - start) / num_queries * 1000.0)
+        print("{0:12s} index {1:8.3f} ms, linear scan {2:8.3f} ms, speedup {3:.1f}x".format(
+            name, timings[0], timings[1], timings[1] / timings[0]))
+
+    return
+
+
+def test():
+    from project3 import CleanXML
+
+    ids, lat, lon = synthetic_points(20000)
+    index = GridIndex(ids, lat, lon, cell_deg=0.02)
+    rng = np.random.RandomState(2)
+    for qlat, qlon in zip(rng.uniform(39.45, 39.75, 20), rng.uniform(-105.05, -104.65, 20)):
+        inside = (lat >= qlat) & (lat <= qlat + 0.05) & (lon >= qlon) & (lon <= qlon + 0.03)
+        assert sorted(index.bbox(qlat, qlon, qlat + 0.05, qlon + 0.03)) == sorted(ids[inside])
+
+        distances = haversine_km(qlat, qlon, lat, lon)
+        found, found_km = index.within(qlat, qlon, 3.0)
+        assert sorted(found) == sorted(ids[distances <= 3.0])
+        assert np.all(np.diff(found_km) >= 0)
+
+        found, found_km = index.nearest(qlat, qlon, 5)
+        assert np.allclose(found_km, np.sort(distances)[:5])
+
+    # More neighbours asked for than points
+    assert len(index.nearest(0.0, 0.0, 30000)[0]) == 20000
+
+    # Density over the whole extent adds back up to the number of points
+    lat_edges, lon_edges = np.linspace(39.5, 39.7, 5), np.linspace(-105.0, -104.7, 4)
+    counts = index.density(lat_edges, lon_edges) * grid_cell_areas(lat_edges, lon_edges)
+    assert abs(counts.sum() - 20000) < 1e-6
+
+    # Index the nodes of a shaped extract
+    docs = list(CleanXML("example5.osm").iter_elements())
+    nodes = [doc for doc in docs if doc["type"] == "node"]
+    index = GridIndex.from_docs(docs)
+    assert len(index) == len(nodes)
+    node = nodes[3]
+    found, found_km = index.nearest(node["pos"][0], node["pos"][1])
+    assert list(found) == [int(node["id"])] and found_km[0] == 0.0
+    assert len(GridIndex.from_docs(docs, where=lambda doc: doc["id"] == node["id"])) == 1
+    assert len(GridIndex([], [], []).bbox(0, 0, 1, 1)) == 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["benchmark"]:
+        benchmark()
+    else:
+        test()
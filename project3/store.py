@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+"""Compact array backed in-memory store of shaped nodes and ways.
+
+A shaped document costs hundreds of bytes per node as a dictionary of
+strings and lists. Here ids and node references are kept in int64 arrays,
+coordinates in float64 arrays (or int32 fixed point at the 1e-7 degree
+resolution of OpenStreetMap), and tags in offset indexed tables of interned
+string indices. Elements are appended while parsing and the store is frozen
+into numpy arrays for vectorized analysis once loading is done.
+"""
+
+import sys
+from array import array
+import numpy as np
+
+
+# Fixed point scale of OpenStreetMap coordinates
+FIXED_POINT_SCALE = 10000000
+
+# Stored coordinate of a node without a position
+MISSING_FIXED_POINT = -2 ** 31
+
+# Value index of a tag whose value is None
+NONE_VALUE = -1
+
+# Document keys held in dedicated arrays rather than in the tag table
+STRUCTURAL_KEYS = ("id", "type", "pos", "node_refs")
+
+
+def table_key(value):
+    """
+    Key of a value in the index of a StringTable. Numbers are keyed with their
+    type, so that 1, 1.0 and True, which compare equal, are stored separately.
+    :param value: String or other hashable value
+    :return: Dictionary key
+    """
+    if isinstance(value, str):
+        return value
+    return type(value), value
+
+
+class StringTable(object):
+    """Interned table of strings, each distinct string is stored once. Other
+    scalar values, such as the float length_km and bbox fields of
+    geometry.WayGeometry, are interned the same way.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def intern(self, value):
+        """
+        Get the index of a string, adding it to the table if new
+        :param value: String or number, or None
+        :return: Index into the table, NONE_VALUE for None
+        """
+        if value is None:
+            return NONE_VALUE
+        key = table_key(value)
+        try:
+            return self.index[key]
+        except KeyError:
+            self.index[key] = len(self.strings)
+            self.strings.append(value)
+            return self.index[key]
+
+    def lookup(self, index):
+        """
+        :param index: Index into the table
+        :return: The string at the index, or None for NONE_VALUE
+        """
+        if index == NONE_VALUE:
+            return None
+        return self.strings[index]
+
+    def find(self, value):
+        """
+        :param value: String to look for
+        :return: Index of the string, or None if it is not in the table
+        """
+        return self.index.get(table_key(value))
+
+    def nbytes(self):
+        """
+        :return: Approximate size of the stored values in bytes, the UTF-8 length of the
+                 strings and the object size of the other values
+        """
+        return sum(len(s.encode("utf-8")) if isinstance(s, str) else sys.getsizeof(s) for s in self.strings)
+
+
+class OffsetTable(object):
+    """Variable length rows of integers stored as one flat array plus an
+    array of row start offsets.
+    """
+
+    def __init__(self, typecode="q"):
+        self.offsets = array("q", [0])
+        self.values = array(typecode)
+
+    def append(self, values):
+        """
+        Append one row
+        :param values: Iterable of integers
+        :return: None
+        """
+        self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+    def freeze(self):
+        """
+        Convert the rows to numpy arrays
+        :return: None
+        """
+        self.offsets = np.frombuffer(self.offsets, dtype=np.int64).copy()
+        self.values = np.frombuffer(self.values, dtype=np.int64 if self.values.typecode == "q" else np.int32).copy()
+
+    def row(self, i):
+        """
+        :param i: Row number
+        :return: Values of the row
+        """
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def row_of_values(self):
+        """
+        :return: Array giving the row number of every value
+        """
+        return np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+
+    def nbytes(self):
+        """
+        :return: Size of the arrays in bytes
+        """
+        return len(self.offsets) * self.offsets.itemsize + len(self.values) * self.values.itemsize
+
+
+class TagTable(object):
+    """Tags of each element as rows of (key, value) string table indices"""
+
+    def __init__(self, strings):
+        self.strings = strings
+        self.keys = OffsetTable("i")
+        self.values = array("i")
+
+    def append(self, tags):
+        """
+        Append the tags of one element
+        :param tags: List of (key, value) pairs
+        :return: None
+        """
+        self.keys.append(self.strings.intern(k) for k, _ in tags)
+        self.values.extend(self.strings.intern(v) for _, v in tags)
+
+    def freeze(self):
+        """
+        Convert the tags to numpy arrays
+        :return: None
+        """
+        self.keys.freeze()
+        self.values = np.frombuffer(self.values, dtype=np.int32).copy()
+
+    def row(self, i):
+        """
+        :param i: Element row number
+        :return: List of (key, value) pairs of the element
+        """
+        start, end = self.keys.offsets[i], self.keys.offsets[i + 1]
+        return [(self.strings.lookup(k), self.strings.lookup(v))
+                for k, v in zip(self.keys.values[start:end], self.values[start:end])]
+
+    def value_counts(self, key):
+        """
+        Count the values of a tag key over all elements
+        :param key: Tag key, nested keys as "address.city"
+        :return: Dictionary of value to count
+        """
+        key_index = self.strings.find(key)
+        if key_index is None:
+            return {}
+        values, counts = np.unique(self.values[self.keys.values == key_index], return_counts=True)
+
+        return dict((self.strings.lookup(v), int(c)) for v, c in zip(values, counts))
+
+    def rows_with(self, key, value=None):
+        """
+        Find the elements that have a tag, optionally with a given value
+        :param key: Tag key, nested keys as "address.city"
+        :param value: Tag value to match, or None to match any value
+        :return: Sorted array of element row numbers
+        """
+        key_index = self.strings.find(key)
+        if key_index is None:
+            return np.zeros(0, dtype=np.int64)
+        mask = self.keys.values == key_index
+        if value is not None:
+            value_index = self.strings.find(value)
+            if value_index is None:
+                return np.zeros(0, dtype=np.int64)
+            mask &= self.values == value_index
+
+        return np.unique(self.keys.row_of_values()[mask])
+
+    def nbytes(self):
+        """
+        :return: Size of the arrays in bytes
+        """
+        return self.keys.nbytes() + len(self.values) * self.values.itemsize
+
+
+def flatten_tags(doc):
+    """
+    Flatten the non structural fields of a shaped document into tag pairs
+    :param doc: Shaped node or way dictionary
+    :return: List of (key, value) pairs, nested fields as ("address.city", value)
+    """
+    tags = []
+    for k, v in doc.items():
+        if k in STRUCTURAL_KEYS:
+            continue
+        if isinstance(v, dict):
+            for sub_k, sub_v in v.items():
+                tags.append(("{0}.{1}".format(k, sub_k), sub_v))
+        else:
+            tags.append((k, v))
+
+    return tags
+
+
+def unflatten_tags(tags):
+    """
+    Rebuild the nested fields of a shaped document from tag pairs
+    :param tags: List of (key, value) pairs
+    :return: Dictionary of fields
+    """
+    doc = {}
+    for k, v in tags:
+        if "." in k:
+            k, sub_k = k.split(".", 1)
+            doc.setdefault(k, {})[sub_k] = v
+        else:
+            doc[k] = v
+
+    return doc
+
+
+class ElementStore(object):
+    """Array backed store of shaped nodes and ways"""
+
+    def __init__(self, fixed_point=False):
+        """
+        Initialize an empty store
+        :param fixed_point: True to keep coordinates as int32 at 1e-7 degrees instead of float64
+        :return: None
+        """
+        self.fixed_point = fixed_point
+        self.strings = StringTable()
+        self.bounds = None
+        self.frozen = False
+
+        # Nodes
+        self.node_ids = array("q")
+        self.node_lat = array("i" if fixed_point else "d")
+        self.node_lon = array("i" if fixed_point else "d")
+        self.node_tags = TagTable(self.strings)
+
+        # Ways
+        self.way_ids = array("q")
+        self.way_refs = OffsetTable("q")
+        self.way_tags = TagTable(self.strings)
+
+        # Sorted node id index, built on first lookup
+        self.node_order = None
+
+    def add(self, doc):
+        """
+        Add one shaped document
+        :param doc: Dictionary from CleanXML.shape_element
+        :return: None
+        """
+        if self.frozen:
+            raise ValueError("Cannot add to a frozen store")
+
+        if doc["type"] == "bounds":
+            self.bounds = dict(doc)
+        elif doc["type"] == "node":
+            self.node_ids.append(int(doc["id"]))
+            pos = doc.get("pos")
+            if self.fixed_point:
+                self.node_lat.append(int(round(pos[0] * FIXED_POINT_SCALE)) if pos else MISSING_FIXED_POINT)
+                self.node_lon.append(int(round(pos[1] * FIXED_POINT_SCALE)) if pos else MISSING_FIXED_POINT)
+            else:
+                self.node_lat.append(pos[0] if pos else np.nan)
+                self.node_lon.append(pos[1] if pos else np.nan)
+            self.node_tags.append(flatten_tags(doc))
+        elif doc["type"] == "way":
+            self.way_ids.append(int(doc["id"]))
+            self.way_refs.append(int(ref) for ref in doc.get("node_refs", ()))
+            self.way_tags.append(flatten_tags(doc))
+
+        return
+
+    def load(self, docs):
+        """
+        Add all documents and freeze the store
+        :param docs: Iterable of shaped dictionaries, eg. CleanXML.iter_elements()
+        :return: self
+        """
+        for doc in docs:
+            self.add(doc)
+        self.freeze()
+
+        return self
+
+    def freeze(self):
+        """
+        Convert all the columns to numpy arrays. No more documents can be added.
+        :return: None
+        """
+        coord_dtype = np.int32 if self.fixed_point else np.float64
+        self.node_ids = np.frombuffer(self.node_ids, dtype=np.int64).copy()
+        self.node_lat = np.frombuffer(self.node_lat, dtype=coord_dtype).copy()
+        self.node_lon = np.frombuffer(self.node_lon, dtype=coord_dtype).copy()
+        self.node_tags.freeze()
+        self.way_ids = np.frombuffer(self.way_ids, dtype=np.int64).copy()
+        self.way_refs.freeze()
+        self.way_tags.freeze()
+        self.frozen = True
+
+        return
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_ways(self):
+        return len(self.way_ids)
+
+    def node_positions(self):
+        """
+        :return: Tuple of (lat, lon) float64 arrays, NaN for nodes without a position
+        """
+        if not self.fixed_point:
+            return self.node_lat, self.node_lon
+
+        missing = self.node_lat == MISSING_FIXED_POINT
+        lat = np.where(missing, np.nan, self.node_lat / float(FIXED_POINT_SCALE))
+        lon = np.where(missing, np.nan, self.node_lon / float(FIXED_POINT_SCALE))
+
+        return lat, lon
+
+    def node_rows(self, node_ids):
+        """
+        Find the rows of nodes by id
+        :param node_ids: Array of node ids
+        :return: Array of node row numbers, -1 where the id is not in the store
+        """
+        if self.node_order is None:
+            self.node_order = np.argsort(self.node_ids, kind="stable")
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        sorted_ids = self.node_ids[self.node_order]
+        found = np.searchsorted(sorted_ids, node_ids)
+        found = np.minimum(found, len(sorted_ids) - 1)
+        rows = self.node_order[found] if len(sorted_ids) else np.zeros(len(node_ids), dtype=np.int64)
+        hit = sorted_ids[found] == node_ids if len(sorted_ids) else np.zeros(len(node_ids), dtype=bool)
+
+        return np.where(hit, rows, -1)
+
+    def node_doc(self, i):
+        """
+        Rebuild the shaped document of a node
+        :param i: Node row number
+        :return: Shaped dictionary
+        """
+        doc = unflatten_tags(self.node_tags.row(i))
+        doc["type"] = "node"
+        doc["id"] = str(self.node_ids[i])
+        lat, lon = self.node_positions()
+        if not np.isnan(lat[i]):
+            doc["pos"] = [float(lat[i]), float(lon[i])]
+
+        return doc
+
+    def way_doc(self, i):
+        """
+        Rebuild the shaped document of a way
+        :param i: Way row number
+        :return: Shaped dictionary
+        """
+        doc = unflatten_tags(self.way_tags.row(i))
+        doc["type"] = "way"
+        doc["id"] = str(self.way_ids[i])
+        refs = self.way_refs.row(i)
+        if len(refs):
+            doc["node_refs"] = [str(ref) for ref in refs]
+
+        return doc
+
+    def nbytes(self):
+        """
+        :return: Approximate memory used by the store in bytes
+        """
+        return (self.node_ids.nbytes + self.node_lat.nbytes + self.node_lon.nbytes + self.node_tags.nbytes() +
+                self.way_ids.nbytes + self.way_refs.nbytes() + self.way_tags.nbytes() + self.strings.nbytes())
+
+    def print_stats(self):
+        """
+        Print the size of the store
+        :return: None
+        """
+        print("Nodes: {0}, ways: {1}, distinct strings: {2}".format(
+            self.num_nodes, self.num_ways, len(self.strings.strings)))
+        print("Store size: {0:.1f} (kB)".format(self.nbytes() / 1024.0))
+
+        return
+
+
+def test():
+    from project3 import CleanXML
+    from geometry import WayGeometry
+
+    data = list(CleanXML("example5.osm").iter_elements())
+    nodes = [doc for doc in data if doc["type"] == "node"]
+    ways = [doc for doc in data if doc["type"] == "way"]
+
+    for fixed_point in (False, True):
+        store = ElementStore(fixed_point).load(data)
+        store.print_stats()
+        assert store.num_nodes == len(nodes)
+        assert store.num_ways == len(ways)
+        assert store.bounds["minlat"] == 41.97045
+        assert [store.node_doc(i) for i in range(store.num_nodes)] == nodes
+        assert [store.way_doc(i) for i in range(store.num_ways)] == ways
+
+    assert store.way_tags.value_counts("building") == {"yes": 1}
+    assert list(store.node_tags.rows_with("created.user", "bbmiller")) == [
+        i for i, doc in enumerate(nodes) if doc["created"]["user"] == "bbmiller"]
+    assert list(store.node_rows([261114296, 1])) == [1, -1]
+
+    # Ways enriched by the geometry stage keep their float fields
+    way = {"type": "way", "id": "1", "highway": "residential", "node_refs": [doc["id"] for doc in nodes[:3]]}
+    geometry_data = list(WayGeometry().process(data + [way]))
+    geometry_ways = [doc for doc in geometry_data if doc["type"] == "way"]
+    assert isinstance(way["length_km"], float) and isinstance(way["bbox"]["minlat"], float)
+    store = ElementStore().load(geometry_data)
+    store.print_stats()
+    assert [store.way_doc(i) for i in range(store.num_ways)] == geometry_ways
+    assert store.strings.nbytes() > ElementStore().load(data).strings.nbytes()
+
+    # Values that compare equal but differ in type are stored separately
+    strings = StringTable()
+    assert [strings.intern(v) for v in ("1", 1, 1.0, True, 1.0)] == [0, 1, 2, 3, 2]
+    assert [type(strings.lookup(i)) for i in range(4)] == [str, int, float, bool]
+
+
+if __name__ == "__main__":
+    test()
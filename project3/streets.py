@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Memoized street name normalizer.
+
+CleanXML.fix_street applies the prefix rules and then the street type rules
+one regular expression at a time. The same few thousand street names repeat
+across every address of an extract, so here all the rules are combined into
+one regular expression that finds every abbreviation in a single pass, and
+the result for each distinct street name is kept in a bounded LRU cache.
+"""
+
+import re
+import random
+from collections import OrderedDict
+
+
+class StreetNormalizer(object):
+    """Single pass, cached version of the prefix and street type rules of
+    CleanXML. As in CleanXML.fix_street the first prefix rule that matches
+    and the first street type rule that matches are applied to every
+    occurrence in the name, and all other rules are ignored.
+    """
+
+    def __init__(self, prefix_rules, type_rules, max_size=8192):
+        """
+        Initialize the normalizer
+        :param prefix_rules: Ordered tuple of (compiled whole word regex, replacement) for prefixes
+        :param type_rules: Ordered tuple of (compiled whole word regex, replacement) for street types
+        :param max_size: Maximum number of distinct street names kept in the cache
+        :return: None
+        """
+        self.rules = tuple(prefix_rules) + tuple(type_rules)
+        self.num_prefix_rules = len(prefix_rules)
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # The rules are whole word patterns, so at most one of them matches at any
+        # position and the alternation finds exactly the matches of each rule
+        flags = set(regex.flags for regex, _ in self.rules)
+        if len(flags) != 1:
+            raise ValueError("All street rules must use the same regular expression flags")
+        self.combined_re = re.compile("|".join(
+            "(?P<r{0}>{1})".format(i, regex.pattern) for i, (regex, _) in enumerate(self.rules)), flags.pop())
+        self.period_re = re.compile(r'[.]')
+
+    def fix_street(self, street):
+        """
+        Apply the rules to a street name, without using the cache
+        :param street: String representing street (no housenumber)
+        :return: Fixed string
+        """
+
+        # First remove all periods
+        street = self.period_re.sub('', street)
+
+        matches = [(int(m.lastgroup[1:]), m.start(), m.end()) for m in self.combined_re.finditer(street)]
+        if not matches:
+            return street
+
+        # The first matching rule of each group wins
+        matched_rules = set(rule for rule, _, _ in matches)
+        chosen = set()
+        for first, last in ((0, self.num_prefix_rules), (self.num_prefix_rules, len(self.rules))):
+            for rule in range(first, last):
+                if rule in matched_rules:
+                    chosen.add(rule)
+                    break
+
+        # Rebuild the name with the chosen replacements
+        parts = []
+        pos = 0
+        for rule, start, end in matches:
+            if rule in chosen:
+                parts.append(street[pos:start])
+                parts.append(self.rules[rule][1])
+                pos = end
+        parts.append(street[pos:])
+
+        return "".join(parts)
+
+    def normalize(self, street):
+        """
+        Cached version of fix_street
+        :param street: String representing street (no housenumber)
+        :return: Fixed string
+        """
+        try:
+            fixed = self.cache.pop(street)
+            self.hits += 1
+        except KeyError:
+            fixed = self.fix_street(street)
+            self.misses += 1
+            if len(self.cache) >= self.max_size:
+                self.cache.popitem(last=False)
+
+        # Re-insert so the most recently used names are evicted last
+        self.cache[street] = fixed
+
+        return fixed
+
+    def print_stats(self):
+        """
+        Print the cache statistics
+        :return: None
+        """
+        print("Street name cache hits: {0}, misses: {1}, size: {2}".format(self.hits, self.misses, len(self.cache)))
+
+        return
+
+
+def test():
+    from project3 import CleanXML
+
+    cleaner = CleanXML("example5.osm")
+
+    def reference_fix_street(street):
+        """Sequential version of the rules, as originally written in CleanXML.fix_street"""
+        street = re.sub(r'[.]', '', street)
+        for prefix_re, prefix_full in cleaner.street_prefixes_re:
+            street, n = prefix_re.subn(prefix_full, street)
+            if n:
+                break
+        for type_re, type_full in cleaner.street_types_re:
+            street, n = type_re.subn(type_full, street)
+            if n:
+                break
+        return street
+
+    normalizer = StreetNormalizer(cleaner.street_prefixes_re, cleaner.street_types_re, max_size=50)
+    names = ["N. Lincoln Ave", "West Lexington St.", "Baldwin Rd.", "S Main St", "e colfax ave", "Dr. King Dr",
+             "St Paul St", "N S Rd", "Macy's Pl", "Arapahoe Raod", "W Ct Cir", "Broadway", "", "N.", "Pkwy Ln",
+             "County Road 7 Ste 100", "Santé St", "Strret", "St-Ave"]
+    assert normalizer.normalize("N. Lincoln Ave") == "North Lincoln Avenue"
+
+    # Random names built from the rule words and separators
+    words = ["S", "E", "N", "W", "s", "n.", "Ct", "rd", "Raod", "ST", "Strret", "Streer", "Pl", "Pkwy", "Ln", "Dr",
+             "Cir", "Blvd", "Ave", "Main", "Stone", "Avenue", "Elm", "14th", "Cr"]
+    separators = [" ", " ", ".", "-", "'", ". ", "/"]
+    rand = random.Random(0)
+    for _ in range(5000):
+        name = ""
+        for _ in range(rand.randint(1, 5)):
+            name += rand.choice(words) + rand.choice(separators)
+        names.append(name.strip())
+
+    for name in names + names:
+        assert normalizer.normalize(name) == reference_fix_street(name), name
+    assert len(normalizer.cache) == 50
+    normalizer.print_stats()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Shared, memoized classification of <tag> keys.
+
+Both the key audit (tags.key_type, passes.KeyTypeVisitor) and the shaping of
+elements (CleanXML.shape_element) look at every key of every tag with regular
+expressions and split(':'). An extract only has a few thousand distinct keys,
+so each one is classified once, and the audit category and the shaped field
+it maps to are looked up in a dictionary afterwards.
+"""
+
+import re
+from collections import namedtuple
+
+
+LOWER_RE = re.compile(r'^([a-z]|_)*$')
+LOWER_COLON_RE = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
+PROBLEMCHARS_RE = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+
+# What shape_element does with the value of a key
+SKIP = 0        # Dropped, the key has problem characters or is a redundant address sub-field
+FIELD = 1       # Stored in a top level field
+ADDRESS = 2     # Stored in the address sub-document
+STREET = 3      # Stored in address.street after fixing the street name
+
+# key_type: "lower", "lower_colon", "problemchars" or "other"
+# action: SKIP, FIELD, ADDRESS or STREET
+# field: Name of the shaped field, or None when skipped
+KeyClass = namedtuple("KeyClass", ("key_type", "action", "field"))
+
+
+def classify_key(k):
+    """
+    Classify a key, without using a cache
+    :param k: Tag key
+    :return: KeyClass
+    """
+    if LOWER_RE.match(k):
+        key_type = "lower"
+    elif LOWER_COLON_RE.match(k):
+        key_type = "lower_colon"
+    elif PROBLEMCHARS_RE.search(k):
+        key_type = "problemchars"
+    else:
+        key_type = "other"
+
+    # Keys with problem characters are ignored
+    if key_type == "problemchars":
+        return KeyClass(key_type, SKIP, None)
+
+    keys = k.split(':')
+    if len(keys) == 1:
+        # All keys lower case except NHS (National Highway System) and "FIX_ME" (underscore for editor only)
+        if k.upper() == "FIXME" or k.upper() == "NHS":
+            return KeyClass(key_type, FIELD, k.upper())
+        return KeyClass(key_type, FIELD, k.lower())
+
+    if len(keys) == 2 and keys[0] == "addr":
+        return KeyClass(key_type, STREET if keys[1] == "street" else ADDRESS, keys[1])
+
+    if len(keys) > 2 and keys[0] == "addr" and keys[1] == "street":
+        # Redundant sub-fields of the street address
+        return KeyClass(key_type, SKIP, None)
+
+    return KeyClass(key_type, FIELD, "_".join(keys))
+
+
+class KeyClassifier(object):
+    """Cache of classify_key results"""
+
+    def __init__(self, max_size=65536):
+        """
+        Initialize an empty cache
+        :param max_size: Maximum number of distinct keys cached, further keys are classified every time
+        :return: None
+        """
+        self.max_size = max_size
+        self.cache = {}
+
+    def classify(self, k):
+        """
+        :param k: Tag key
+        :return: KeyClass
+        """
+        try:
+            return self.cache[k]
+        except KeyError:
+            result = classify_key(k)
+            if len(self.cache) < self.max_size:
+                self.cache[k] = result
+            return result
+
+    def key_type(self, k):
+        """
+        :param k: Tag key
+        :return: "lower", "lower_colon", "problemchars" or "other"
+        """
+        return self.classify(k).key_type
+
+
+# Classifier shared by the audit and the shaping code
+KEY_CLASSIFIER = KeyClassifier()
+
+
+def test():
+    examples = {
+        "highway": KeyClass("lower", FIELD, "highway"),
+        "addr:street": KeyClass("lower_colon", STREET, "street"),
+        "addr:city": KeyClass("lower_colon", ADDRESS, "city"),
+        "addr:street:name": KeyClass("other", SKIP, None),
+        "tiger:name_base": KeyClass("lower_colon", FIELD, "tiger_name_base"),
+        "gnis:feature_id:1": KeyClass("other", FIELD, "gnis_feature_id_1"),
+        "FIXME": KeyClass("other", FIELD, "FIXME"),
+        "fixme": KeyClass("lower", FIELD, "FIXME"),
+        "NHS": KeyClass("other", FIELD, "NHS"),
+        "Name": KeyClass("other", FIELD, "name"),
+        "note key": KeyClass("problemchars", SKIP, None),
+        "addr.street": KeyClass("problemchars", SKIP, None),
+    }
+    classifier = KeyClassifier(max_size=4)
+    for k, expected in sorted(examples.items()):
+        assert classifier.classify(k) == expected, k
+        assert classifier.classify(k) == expected, k
+    assert len(classifier.cache) == 4
+
+    # The audit categories are those of tags.key_type
+    for k in examples:
+        if LOWER_RE.match(k):
+            assert classifier.key_type(k) == "lower"
+        elif LOWER_COLON_RE.match(k):
+            assert classifier.key_type(k) == "lower_colon"
+        elif PROBLEMCHARS_RE.search(k):
+            assert classifier.key_type(k) == "problemchars"
+        else:
+            assert classifier.key_type(k) == "other"
+
+
+if __name__ == "__main__":
+    test()
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 import xml.etree.cElementTree as ET
 import pprint
-import re
+from tagkeys import KEY_CLASSIFIER, LOWER_RE, LOWER_COLON_RE, PROBLEMCHARS_RE
 
 """
 Your task is to explore the data a bit more.
@@ -27,23 +27,17 @@ See the 'process_map' and 'test' functions for examples of the expected format.
 """
 
 
-lower = re.compile(r'^([a-z]|_)*$')
-lower_colon = re.compile(r'^([a-z]|_)*:([a-z]|_)*$')
-problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
+# The 3 regular expressions, defined once in tagkeys
+lower = LOWER_RE
+lower_colon = LOWER_COLON_RE
+problemchars = PROBLEMCHARS_RE
 
 
 def key_type(element, keys):
     if element.tag == "tag":
         # YOUR CODE HERE
-        k = element.get('k')
-        if re.match(lower, k):
-            keys['lower'] += 1
-        elif re.match(lower_colon, k):
-            keys['lower_colon'] += 1
-        elif re.search(problemchars, k):
-            keys['problemchars'] += 1
-        else:
-            keys['other'] += 1
+        # Each distinct key is only run through the regular expressions once
+        keys[KEY_CLASSIFIER.key_type(element.get('k'))] += 1
 
     return keys
 